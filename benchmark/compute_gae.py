@@ -0,0 +1,62 @@
+"""Benchmarks `compute_gae` against the step-by-step loop of the PPO scripts.
+
+    python benchmark/compute_gae.py --num-steps 256 --num-envs 24
+"""
+import argparse
+import time
+
+import torch
+from gym_microrts.rollout_buffer import compute_gae
+
+
+def python_loop(rewards, values, dones, last_value, next_done, gamma, gae_lambda):
+    num_steps = len(rewards)
+    advantages = torch.zeros_like(rewards)
+    lastgaelam = 0
+    for t in reversed(range(num_steps)):
+        if t == num_steps - 1:
+            nextnonterminal = 1.0 - next_done
+            nextvalues = last_value
+        else:
+            nextnonterminal = 1.0 - dones[t + 1]
+            nextvalues = values[t + 1]
+        delta = rewards[t] + gamma * nextvalues * nextnonterminal - values[t]
+        advantages[t] = lastgaelam = delta + gamma * gae_lambda * nextnonterminal * lastgaelam
+    return advantages, advantages + values
+
+
+def bench(fn, inputs, device, repeats):
+    for _ in range(3):
+        fn(*inputs)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn(*inputs)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / repeats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num-steps", type=int, default=256)
+    parser.add_argument("--num-envs", type=int, default=24)
+    parser.add_argument("--repeats", type=int, default=100)
+    parser.add_argument("--cuda", action="store_true")
+    args = parser.parse_args()
+
+    device = torch.device("cuda" if args.cuda and torch.cuda.is_available() else "cpu")
+    shape = (args.num_steps, args.num_envs)
+    inputs = (
+        torch.randn(shape, device=device),
+        torch.randn(shape, device=device),
+        (torch.rand(shape, device=device) < 0.01).float(),
+        torch.randn(1, args.num_envs, device=device),
+        torch.zeros(args.num_envs, device=device),
+        0.99,
+        0.95,
+    )
+    reference = bench(python_loop, inputs, device, args.repeats)
+    candidate = bench(compute_gae, inputs, device, args.repeats)
+    print(f"{shape} on {device}: python loop {reference * 1e3:.2f} ms, compute_gae {candidate * 1e3:.2f} ms, speedup {reference / candidate:.2f}x")
@@ -0,0 +1,247 @@
+"""Measures the throughput of `MicroRTSGridModeVecEnv` phase by phase over a grid of configurations.
+
+Every step is split by the env's `timers` into the mask fetch (`getMasks`), the action conversion
+to Java arrays, the JVM `gameStep`, the reward and done conversion and the observation encoding,
+plus the policy inference timed here; the GC, JIT and thread CPU time the JVM spent during the
+measured steps are recorded too, so opponents can be compared by their JVM cost. Each
+configuration runs in a fresh process, as `close` shuts the JVM down.
+
+    python benchmark/env_throughput.py --num-envs 1 8 24 --output results.json
+    python benchmark/env_throughput.py --num-envs 24 --num-threads 1 2 4 8 --output scaling.json
+    python benchmark/env_throughput.py --output new.json --baseline results.json
+
+With `--baseline`, the results are compared to those of the same configurations in a previous
+output and the script exits with 1 if the SPS of any of them dropped or the time of any of its
+phases grew by more than `--tolerance`.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+PHASES = ["mask_fetch", "inference", "action_conversion", "game_step", "reward_conversion", "obs_encoding"]
+DEFAULT_MAP_PATHS = [
+    "maps/8x8/basesWorkers8x8A.xml",
+    "maps/16x16/basesWorkers16x16A.xml",
+    "maps/24x24/basesWorkers24x24A.xml",
+    "maps/32x32/basesWorkers32x32A.xml",
+    "maps/BroodWar/(4)BloodBath.scmB.xml",
+]
+
+
+def parse_args():
+    # fmt: off
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--map-paths', nargs='+', default=DEFAULT_MAP_PATHS,
+        help='the maps to benchmark, relative to the microrts folder')
+    parser.add_argument('--num-envs', type=int, nargs='+', default=[1, 8, 24],
+        help='the numbers of envs to benchmark; self-play envs count both players')
+    parser.add_argument('--opponents', nargs='+', default=["selfplay", "randomAI", "coacAI"],
+        help='`selfplay` or the names of the `microrts_ai` bots the envs play against')
+    parser.add_argument('--policy', type=str, default="random",
+        help='`random` for `RandomMaskedPolicy`, or a policy exported by `experiments/export_agent.py`')
+    parser.add_argument('--num-threads', type=int, nargs='+', default=[1],
+        help='the numbers of vec clients the games are split over and stepped by in parallel')
+    parser.add_argument('--bot-time-budget-ms', type=int, default=None,
+        help='the time budget per action of the search-based bots')
+    parser.add_argument('--partial-obs', action='store_true',
+        help='if toggled, the game will have partial observability')
+    parser.add_argument('--delta-obs', action='store_true',
+        help='if toggled, the envs only re-encode the cells that changed every step')
+    parser.add_argument('--obs-features', nargs='+', default=None,
+        help='the observation feature groups to encode (all if not set), e.g. `hp owner unit_type`')
+    parser.add_argument('--torch-outputs', action='store_true',
+        help='if toggled, the envs return float32 tensors over their own buffers')
+    parser.add_argument('--num-steps', type=int, default=500,
+        help='the number of measured steps of every configuration')
+    parser.add_argument('--warmup-steps', type=int, default=50,
+        help='the number of steps run before measuring, to let the JIT compile the hot paths')
+    parser.add_argument('--seed', type=int, default=1,
+        help='seed of the policy')
+    parser.add_argument('--output', type=str, default="env_throughput.json",
+        help='the JSON file the results are written to')
+    parser.add_argument('--baseline', type=str, default=None,
+        help='a previous output to compare the results to')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+        help='the relative slowdown beyond which a configuration is flagged as a regression')
+    # fmt: on
+    return parser.parse_args()
+
+
+def config_key(config):
+    return f"{config['map_path']} num_envs={config['num_envs']} opponent={config['opponent']} num_threads={config.get('num_threads', 1)}"
+
+
+def run_config(config, args):
+    """Runs one configuration and returns its SPS and per-phase timings."""
+    import torch
+    from gym_microrts import microrts_ai
+    from gym_microrts.envs.new_vec_env import MicroRTSGridModeVecEnv
+    from gym_microrts.exported_policy import load_policy
+    from gym_microrts.random_policy import RandomMaskedPolicy
+
+    torch.set_num_threads(1)
+    if config["opponent"] == "selfplay":
+        num_selfplay_envs, ai2s = config["num_envs"], []
+    else:
+        num_selfplay_envs, ai2s = 0, [getattr(microrts_ai, config["opponent"]) for _ in range(config["num_envs"])]
+    envs = MicroRTSGridModeVecEnv(
+        num_selfplay_envs=num_selfplay_envs,
+        num_bot_envs=len(ai2s),
+        partial_obs=args.partial_obs,
+        max_steps=2000,
+        ai2s=ai2s,
+        map_paths=[config["map_path"]],
+        reward_weight=np.array([10.0, 1.0, 1.0, 0.2, 1.0, 4.0, 0.0, 0.0, 0.0]),
+        timers=True,
+        num_threads=config["num_threads"],
+        bot_time_budget_ms=args.bot_time_budget_ms,
+        delta_obs=args.delta_obs,
+        obs_features=args.obs_features,
+        torch_outputs=args.torch_outputs,
+    )
+    if args.policy == "random":
+        random_policy = RandomMaskedPolicy(envs.action_plane_space.nvec, seed=args.seed)
+
+        def policy(obs, masks):
+            return random_policy(masks)
+
+    else:
+        exported = load_policy(args.policy)
+
+        def policy(obs, masks):
+            with torch.no_grad():
+                action, _, _ = exported(torch.as_tensor(obs, dtype=torch.float32), torch.from_numpy(masks))
+            return action.numpy()
+
+    policy = envs.timers.wrap("inference", policy)
+    obs = envs.reset()
+    for step in range(-args.warmup_steps, args.num_steps):
+        if step == 0:
+            envs.reset_stats()
+            jvm_start = envs.telemetry()
+            start = time.perf_counter()
+        masks = envs.get_action_mask()
+        obs, _, _, _ = envs.step(policy(obs, masks).reshape(envs.num_envs, -1))
+    elapsed = time.perf_counter() - start
+    phases = envs.stats()
+    jvm_end = envs.telemetry()
+    envs.close()
+
+    return dict(
+        config,
+        height=envs.height,
+        width=envs.width,
+        sps=args.num_steps * envs.num_envs / elapsed,
+        step_ms=elapsed / args.num_steps * 1e3,
+        phases={phase: phases[phase] for phase in PHASES},
+        # the JVM work of the measured steps, on the stepping thread and the threads stepping
+        # the shards of `num_threads > 1`, see `gym_microrts.jvm_telemetry`
+        jvm={
+            "gc_count": jvm_end["jvm/gc_count"] - jvm_start["jvm/gc_count"],
+            "gc_time_ms": jvm_end["jvm/gc_time_ms"] - jvm_start["jvm/gc_time_ms"],
+            "jit_time_ms": jvm_end["jvm/jit_time_ms"] - jvm_start["jvm/jit_time_ms"],
+            "thread_cpu_time_ms": jvm_end.get("jvm/thread_cpu_time_ms", 0) - jvm_start.get("jvm/thread_cpu_time_ms", 0),
+            "heap_used_mb": jvm_end["jvm/heap_used_mb"],
+        },
+    )
+
+
+def compare(results, baseline, tolerance):
+    """Prints the relative change of every configuration found in `baseline` and returns the
+    number of regressions."""
+    baseline = {config_key(result): result for result in baseline["results"]}
+    num_regressions = 0
+    for result in results:
+        key = config_key(result)
+        if key not in baseline:
+            print(f"{key}: not in the baseline")
+            continue
+        old = baseline[key]
+        changes = [("sps", old["sps"] / result["sps"] - 1)]
+        changes += [(phase, result["phases"][phase]["mean_ms"] / max(old["phases"][phase]["mean_ms"], 1e-6) - 1) for phase in PHASES]
+        regressions = [name for name, change in changes if change > tolerance]
+        num_regressions += len(regressions) > 0
+        print(
+            f"{'REGRESSION' if regressions else 'ok'} {key}: sps {old['sps']:.0f} -> {result['sps']:.0f}",
+            " ".join(f"{name} {change:+.1%}" for name, change in changes[1:]),
+        )
+    return num_regressions
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    configs = [
+        dict(map_path=map_path, num_envs=num_envs, opponent=opponent, num_threads=num_threads)
+        for map_path in args.map_paths
+        for num_envs in args.num_envs
+        for opponent in args.opponents
+        for num_threads in args.num_threads
+        # self-play envs come in pairs of players
+        if opponent != "selfplay" or num_envs % 2 == 0
+    ]
+
+    results = []
+    ctx = multiprocessing.get_context("spawn")
+    for config in configs:
+        with ctx.Pool(1) as pool:
+            try:
+                result = pool.apply(run_config, (config, args))
+            except Exception as e:
+                print(f"{config_key(config)}: failed with {e!r}")
+                continue
+        results += [result]
+        print(
+            f"{config_key(config)}: {result['sps']:.0f} SPS,",
+            " ".join(f"{phase} {result['phases'][phase]['mean_ms']:.3f}ms" for phase in PHASES),
+        )
+
+    with open(args.output, "w") as f:
+        json.dump(
+            {
+                "meta": {
+                    "commit": git_commit(),
+                    "python": platform.python_version(),
+                    "platform": platform.platform(),
+                    "policy": args.policy,
+                    "bot_time_budget_ms": args.bot_time_budget_ms,
+                    "partial_obs": args.partial_obs,
+                    "delta_obs": args.delta_obs,
+                    "obs_features": args.obs_features,
+                    "torch_outputs": args.torch_outputs,
+                    "num_steps": args.num_steps,
+                    "warmup_steps": args.warmup_steps,
+                },
+                "results": results,
+            },
+            f,
+            indent=2,
+        )
+    print(f"wrote {len(results)} results to {args.output}")
+
+    # the scaling curve of `num_threads`, relative to a single thread
+    single_thread = {config_key(dict(result, num_threads=1)): result for result in results if result["num_threads"] == 1}
+    for result in results:
+        reference = single_thread.get(config_key(dict(result, num_threads=1)))
+        if result["num_threads"] > 1 and reference is not None:
+            print(f"{config_key(result)}: {result['sps'] / reference['sps']:.2f}x the SPS of 1 thread")
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        num_regressions = compare(results, baseline, args.tolerance)
+        print(f"{num_regressions} regressions beyond {args.tolerance:.0%}")
+        sys.exit(1 if num_regressions > 0 else 0)
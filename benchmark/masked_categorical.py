@@ -0,0 +1,85 @@
+"""Benchmarks the gridnet policy head distribution: the per-component `CategoricalMasked`
+of `experiments/new_ppo_gridnet.py` against the fused `MaskedMultiCategorical`.
+
+    python benchmark/masked_categorical.py --num-envs 24 --mapsize 256
+"""
+import argparse
+import time
+
+import numpy as np
+import torch
+from torch.distributions.categorical import Categorical
+from gym_microrts.distributions import MaskedMultiCategorical
+
+
+class CategoricalMasked(Categorical):
+    def __init__(self, probs=None, logits=None, validate_args=None, masks=[], device=None):
+        self.masks = masks.bool()
+        self.device = device
+        logits = torch.where(self.masks, logits, torch.tensor(-1e8, device=self.device))
+        super(CategoricalMasked, self).__init__(probs, logits, validate_args)
+
+    def entropy(self):
+        p_log_p = self.logits * self.probs
+        p_log_p = torch.where(self.masks, p_log_p, torch.tensor(0.0).to(self.device))
+        return -p_log_p.sum(-1)
+
+
+def per_component(logits, masks, nvec, device):
+    split_logits = torch.split(logits, nvec.tolist(), dim=1)
+    split_masks = torch.split(masks, nvec.tolist(), dim=1)
+    multi_categoricals = [
+        CategoricalMasked(logits=logits, masks=iam, device=device) for (logits, iam) in zip(split_logits, split_masks)
+    ]
+    action = torch.stack([categorical.sample() for categorical in multi_categoricals])
+    logprob = torch.stack([categorical.log_prob(a) for a, categorical in zip(action, multi_categoricals)])
+    entropy = torch.stack([categorical.entropy() for categorical in multi_categoricals])
+    return action.T, logprob.T, entropy.T
+
+
+def fused(logits, masks, nvec, device):
+    distribution = MaskedMultiCategorical(logits, masks, nvec)
+    action = distribution.sample()
+    return action, distribution.log_prob(action), distribution.entropy()
+
+
+def bench(fn, logits, masks, nvec, device, backward, repeats):
+    def run():
+        out = fn(logits, masks, nvec, device)
+        if backward:
+            (out[1].sum() + out[2].sum()).backward()
+
+    for _ in range(3):
+        run()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        run()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / repeats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num-envs", type=int, default=24)
+    parser.add_argument("--mapsize", type=int, default=16 * 16)
+    parser.add_argument("--repeats", type=int, default=50)
+    parser.add_argument("--cuda", action="store_true")
+    args = parser.parse_args()
+
+    device = torch.device("cuda" if args.cuda and torch.cuda.is_available() else "cpu")
+    nvec = np.array([6, 4, 4, 4, 4, 7, 49])
+    rows = args.num_envs * args.mapsize
+    logits = torch.randn(rows, nvec.sum(), device=device, requires_grad=True)
+    masks = (torch.rand(rows, nvec.sum(), device=device) > 0.5).float()
+
+    print(f"logits {tuple(logits.shape)} on {device}")
+    for phase, backward in [("rollout (sample, log_prob, entropy)", False), ("update (+ backward)", True)]:
+        reference = bench(per_component, logits, masks, nvec, device, backward, args.repeats)
+        candidate = bench(fused, logits, masks, nvec, device, backward, args.repeats)
+        print(
+            f"{phase}: CategoricalMasked x{len(nvec)} {reference * 1e3:.2f} ms, "
+            f"MaskedMultiCategorical {candidate * 1e3:.2f} ms, speedup {reference / candidate:.2f}x"
+        )
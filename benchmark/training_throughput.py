@@ -0,0 +1,103 @@
+"""Compares the training throughput of `experiments/impala_gridnet.py` and `experiments/new_ppo_gridnet.py`.
+
+Both scripts train for `--total-timesteps` on the same number of self-play envs: PPO steps them
+all in one vec env, IMPALA splits them evenly over `--num-actors` actor processes. The SPS each
+script prints after its last update (env steps since its start over wall time, learning
+included) is reported, together with the wall time of the whole run. The runs log to wandb in
+offline mode, as both scripts only log through wandb.
+
+    python benchmark/training_throughput.py --num-envs 24 --num-actors 4 --output training.json
+"""
+import argparse
+import json
+import os
+import platform
+import re
+import subprocess
+import sys
+import time
+from distutils.util import strtobool
+
+EXPERIMENTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "experiments")
+
+
+def parse_args():
+    # fmt: off
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num-envs', type=int, default=24,
+        help='the number of self-play envs of both scripts; 2 self play envs means 1 game')
+    parser.add_argument('--num-actors', type=int, default=4,
+        help='the number of IMPALA actors the envs are split over')
+    parser.add_argument('--total-timesteps', type=int, default=300000,
+        help='the number of env steps each script trains for')
+    parser.add_argument('--cuda', type=lambda x: bool(strtobool(x)), default=True, nargs='?', const=True,
+        help='if toggled, the learners use cuda when available')
+    parser.add_argument('--seed', type=int, default=1,
+        help='seed of the runs')
+    parser.add_argument('--output', type=str, default="training_throughput.json",
+        help='the JSON file the results are written to')
+    # fmt: on
+    args = parser.parse_args()
+    assert args.num_envs % args.num_actors == 0 and (args.num_envs // args.num_actors) % 2 == 0, \
+        "every actor needs the same, even number of self-play envs"
+    return args
+
+
+def run_script(script, script_args):
+    """Runs `script` to completion and returns the last SPS it printed and its wall time."""
+    command = [sys.executable, os.path.join(EXPERIMENTS, script)] + [str(arg) for arg in script_args]
+    start = time.perf_counter()
+    process = subprocess.run(
+        command, cwd=EXPERIMENTS, env=dict(os.environ, WANDB_MODE="offline"),
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True,
+    )
+    wall_time = time.perf_counter() - start
+    sps = re.findall(r"^SPS: (\d+)$", process.stdout, re.MULTILINE)
+    if process.returncode != 0 or len(sps) == 0:
+        raise RuntimeError(f"{script} failed with exit code {process.returncode}:\n{process.stdout[-2000:]}")
+    return dict(script=script, args=script_args, sps=int(sps[-1]), wall_time_s=wall_time)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    common_args = ["--prod-mode", "--total-timesteps", args.total_timesteps, "--seed", args.seed, "--cuda", args.cuda]
+    runs = [
+        ("new_ppo_gridnet.py", common_args + ["--num-selfplay-envs", args.num_envs, "--num-bot-envs", 0]),
+        ("impala_gridnet.py", common_args + [
+            "--num-actors", args.num_actors,
+            "--num-selfplay-envs-per-actor", args.num_envs // args.num_actors,
+            "--num-bot-envs-per-actor", 0,
+        ]),
+    ]
+
+    results = []
+    for script, script_args in runs:
+        result = run_script(script, script_args)
+        results += [result]
+        print(f"{script}: {result['sps']} SPS, {result['wall_time_s']:.0f}s")
+    print(f"impala_gridnet.py: {results[1]['sps'] / results[0]['sps']:.2f}x the SPS of new_ppo_gridnet.py")
+
+    with open(args.output, "w") as f:
+        json.dump(
+            {
+                "meta": {
+                    "commit": git_commit(),
+                    "python": platform.python_version(),
+                    "platform": platform.platform(),
+                    "num_envs": args.num_envs,
+                    "num_actors": args.num_actors,
+                    "total_timesteps": args.total_timesteps,
+                },
+                "results": results,
+            },
+            f,
+            indent=2,
+        )
+    print(f"wrote {len(results)} results to {args.output}")
@@ -0,0 +1,90 @@
+import argparse
+import os
+import time
+from distutils.util import strtobool
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+from gym_microrts.exported_policy import GridnetPolicy, load_policy
+
+from new_ppo_gridnet import Agent
+
+
+def parse_args():
+    # fmt: off
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--agent-model-path', type=str, default="agent_sota.pt",
+        help="the path to the agent's state dict")
+    parser.add_argument('--output', type=str, default=None,
+        help='the exported file; `.ts` for TorchScript or `.onnx` for ONNX (defaults to the model path with `.ts`)')
+    parser.add_argument('--greedy', type=lambda x: bool(strtobool(x)), default=False, nargs='?', const=True,
+        help='if toggled, the exported policy takes the most likely valid action instead of sampling')
+    parser.add_argument('--partial-obs', type=lambda x: bool(strtobool(x)), default=False, nargs='?', const=True,
+        help='if toggled, the agent was trained with partial observability')
+    parser.add_argument('--map-size', type=int, nargs=2, default=[16, 16],
+        help='the height and width of the maps the agent plays')
+    parser.add_argument('--num-envs', type=int, default=24,
+        help='the batch size of the accuracy and speed check')
+    args = parser.parse_args()
+    if args.output is None:
+        args.output = os.path.splitext(args.agent_model_path)[0] + ".ts"
+    # fmt: on
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    torch.manual_seed(1)
+
+    # the `Agent` only needs the shapes of the vec env it was trained on
+    h, w = args.map_size
+    num_planes = 27 + (2 if args.partial_obs else 0)
+    nvec = np.array([6, 4, 4, 4, 4, 7, 49])
+    envs = SimpleNamespace(
+        observation_space=SimpleNamespace(shape=(h, w, num_planes)),
+        action_plane_space=SimpleNamespace(nvec=nvec),
+    )
+    agent = Agent(envs, mapsize=h * w)
+    agent.load_state_dict(torch.load(args.agent_model_path, map_location="cpu"))
+    agent.eval()
+    policy = GridnetPolicy(agent, nvec, greedy=args.greedy)
+    policy.eval()
+
+    obs = (torch.rand((args.num_envs, h, w, num_planes)) > 0.8).float()
+    masks = torch.rand((args.num_envs, h * w, nvec.sum())) > 0.5
+    if args.output.endswith(".onnx"):
+        torch.onnx.export(
+            policy,
+            (obs, masks),
+            args.output,
+            input_names=["obs", "masks"],
+            output_names=["action", "logprob", "value"],
+            dynamic_axes={name: {0: "batch"} for name in ["obs", "masks", "action", "logprob", "value"]},
+            opset_version=11,
+        )
+    else:
+        torch.jit.script(policy).save(args.output)
+    print(f"exported {args.agent_model_path} to {args.output}")
+
+    # the exported policy must agree with the eager `Agent`
+    exported = load_policy(args.output)
+    with torch.no_grad():
+        _, _, value = exported(obs, masks)
+        _, _, _, _, expected_value = agent.get_action_and_value(obs, invalid_action_masks=masks, envs=envs)
+        action, logprob, _ = exported(obs, masks)
+        _, expected_logprob, _, _, _ = agent.get_action_and_value(obs, action, masks, envs)
+    print("max value difference:", (value - expected_value).abs().max().item())
+    print("max log-probability difference:", (logprob - expected_logprob).abs().max().item())
+
+    repeats = 20
+    for name, fn in [
+        ("eager Agent", lambda: agent.get_action_and_value(obs, invalid_action_masks=masks, envs=envs)),
+        ("exported", lambda: exported(obs, masks)),
+    ]:
+        with torch.no_grad():
+            fn()
+            start = time.perf_counter()
+            for _ in range(repeats):
+                fn()
+        print(f"{name}: {(time.perf_counter() - start) / repeats * 1e3:.2f} ms per batch of {args.num_envs}")
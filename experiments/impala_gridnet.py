@@ -0,0 +1,322 @@
+import argparse
+import os
+import queue
+import random
+import time
+from distutils.util import strtobool
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+import torch.nn as nn
+import torch.optim as optim
+from gym_microrts import microrts_ai
+from gym_microrts.envs.new_vec_env import MicroRTSGridModeVecEnv
+from gym_microrts.rollout_buffer import compute_vtrace, pack_bits, unpack_bits
+from stable_baselines3.common.vec_env import VecMonitor
+
+from new_ppo_gridnet import Agent, MicroRTSStatsRecorder
+
+
+def parse_args():
+    # fmt: off
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--exp-name', type=str, default=os.path.basename(__file__).rstrip(".py"),
+        help='the name of this experiment')
+    parser.add_argument('--learning-rate', type=float, default=2.5e-4,
+        help='the learning rate of the optimizer')
+    parser.add_argument('--seed', type=int, default=1,
+        help='seed of the experiment')
+    parser.add_argument('--total-timesteps', type=int, default=100000000,
+        help='total timesteps of the experiments')
+    parser.add_argument('--cuda', type=lambda x: bool(strtobool(x)), default=True, nargs='?', const=True,
+        help='if toggled, cuda will not be enabled by default')
+    parser.add_argument('--prod-mode', type=lambda x: bool(strtobool(x)), default=False, nargs='?', const=True,
+        help='run the script in production mode and use wandb to log outputs')
+    parser.add_argument('--wandb-project-name', type=str, default="cleanRL",
+        help="the wandb's project name")
+    parser.add_argument('--wandb-entity', type=str, default=None,
+        help="the entity (team) of wandb's project")
+
+    # Algorithm specific arguments
+    parser.add_argument('--partial-obs', type=lambda x: bool(strtobool(x)), default=False, nargs='?', const=True,
+        help='if toggled, the game will have partial observability')
+    parser.add_argument('--num-actors', type=int, default=4,
+        help='the number of actor processes, each stepping its own vec env')
+    parser.add_argument('--num-bot-envs-per-actor', type=int, default=0,
+        help='the number of bot game environments of each actor')
+    parser.add_argument('--num-selfplay-envs-per-actor', type=int, default=6,
+        help='the number of self play envs of each actor; 2 self play envs means 1 game')
+    parser.add_argument('--num-steps', type=int, default=32,
+        help='the number of steps of each trajectory')
+    parser.add_argument('--num-trajectories-per-batch', type=int, default=2,
+        help='the number of actor trajectories the learner trains on at once')
+    parser.add_argument('--max-queued-trajectories', type=int, default=8,
+        help='the number of trajectories actors may queue ahead of the learner')
+    parser.add_argument('--inference-batch-timeout', type=float, default=0.002,
+        help='how long (in seconds) the inference server waits for more actors to batch their requests')
+    parser.add_argument('--gamma', type=float, default=0.99,
+        help='the discount factor gamma')
+    parser.add_argument('--rho-bar', type=float, default=1.0,
+        help='the clipping threshold of the V-trace importance weights')
+    parser.add_argument('--c-bar', type=float, default=1.0,
+        help='the clipping threshold of the V-trace trace-cutting coefficients')
+    parser.add_argument('--ent-coef', type=float, default=0.01,
+        help="coefficient of the entropy")
+    parser.add_argument('--vf-coef', type=float, default=0.5,
+        help="coefficient of the value function")
+    parser.add_argument('--max-grad-norm', type=float, default=0.5,
+        help='the maximum norm for the gradient clipping')
+    args = parser.parse_args()
+    if not args.seed:
+        args.seed = int(time.time())
+    args.num_envs_per_actor = args.num_selfplay_envs_per_actor + args.num_bot_envs_per_actor
+    args.batch_size = int(args.num_envs_per_actor * args.num_trajectories_per_batch * args.num_steps)
+    # fmt: on
+    return args
+
+
+def make_envs(args, num_selfplay_envs, num_bot_envs):
+    envs = MicroRTSGridModeVecEnv(
+        num_selfplay_envs=num_selfplay_envs,
+        num_bot_envs=num_bot_envs,
+        partial_obs=args.partial_obs,
+        max_steps=2000,
+        render_theme=2,
+        ai2s=[[microrts_ai.heavyRushAI, microrts_ai.lightRushAI, microrts_ai.workerRushAI][i % 3] for i in range(num_bot_envs)],
+        map_paths=["maps/16x16/basesWorkers16x16.xml"],
+        reward_weight=np.array([10.0, 1.0, 1.0, 4.0, 4.0, 4.0, 0.2, 0.2, 1.0]),
+    )
+    envs = MicroRTSStatsRecorder(envs)
+    return VecMonitor(envs)
+
+
+def run_actor(actor_id, args, buffers, request_queue, ready, trajectory_queue, stop):
+    """Steps one env shard: observations and masks go to the inference server through the
+    shared `buffers`, and every `num_steps` the trajectory goes to the learner."""
+    torch.set_num_threads(1)
+    random.seed(args.seed + actor_id)
+    np.random.seed(args.seed + actor_id)
+    envs = make_envs(args, args.num_selfplay_envs_per_actor, args.num_bot_envs_per_actor)
+    next_obs = torch.Tensor(envs.reset())
+    next_done = torch.zeros(args.num_envs_per_actor)
+    while not stop.is_set():
+        obs, masks, actions, logprobs, rewards, dones, episode_rewards = [], [], [], [], [], [], []
+        for step in range(args.num_steps):
+            step_masks = torch.tensor(np.array(envs.get_action_mask()))
+            buffers.obs[actor_id] = next_obs
+            buffers.masks[actor_id] = step_masks
+            ready.clear()
+            request_queue.put(actor_id)
+            while not ready.wait(1.0):
+                if stop.is_set():
+                    trajectory_queue.cancel_join_thread()
+                    envs.close()
+                    return
+            action = buffers.actions[actor_id].clone()
+            obs += [pack_bits(next_obs)]
+            masks += [pack_bits(step_masks)]
+            actions += [action.to(torch.int8)]
+            logprobs += [buffers.logprobs[actor_id].clone()]
+            dones += [next_done]
+
+            next_obs, rs, ds, infos = envs.step(action.numpy().reshape(args.num_envs_per_actor, -1))
+            next_obs, next_done = torch.Tensor(next_obs), torch.Tensor(ds)
+            rewards += [torch.Tensor(rs)]
+            episode_rewards += [info["episode"]["r"] for info in infos if "episode" in info.keys()]
+
+        trajectory = dict(
+            obs=torch.stack(obs),
+            masks=torch.stack(masks),
+            actions=torch.stack(actions),
+            logprobs=torch.stack(logprobs),
+            rewards=torch.stack(rewards),
+            dones=torch.stack(dones),
+            next_obs=pack_bits(next_obs),
+            next_done=next_done,
+            episode_rewards=episode_rewards,
+        )
+        while not stop.is_set():
+            try:
+                trajectory_queue.put(trajectory, timeout=1.0)
+                break
+            except queue.Full:
+                pass
+    # trajectories left in the queue at shutdown are dropped instead of blocking the exit
+    trajectory_queue.cancel_join_thread()
+    envs.close()
+
+
+def run_inference_server(args, env_spaces, shared_agent, version, lock, buffers, request_queue, ready_events, stop):
+    """Answers the actors' policy requests in batches with the latest published parameters."""
+    device = torch.device("cuda" if torch.cuda.is_available() and args.cuda else "cpu")
+    h, w, c = env_spaces.observation_space.shape
+    agent = Agent(env_spaces, mapsize=h * w).to(device)
+    agent.eval()
+    agent_version = -1
+    while not stop.is_set():
+        try:
+            actor_ids = [request_queue.get(timeout=0.1)]
+        except queue.Empty:
+            continue
+        # wait briefly for the other actors so that their requests share one forward pass
+        deadline = time.time() + args.inference_batch_timeout
+        while len(actor_ids) < args.num_actors:
+            try:
+                actor_ids += [request_queue.get(timeout=max(deadline - time.time(), 0))]
+            except queue.Empty:
+                break
+        if version.value != agent_version:
+            with lock:
+                agent.load_state_dict(shared_agent.state_dict())
+                agent_version = version.value
+
+        idxs = torch.tensor(actor_ids)
+        with torch.no_grad():
+            action, logprob, _, _, _ = agent.get_action_and_value(
+                buffers.obs[idxs].view(-1, h, w, c).to(device),
+                invalid_action_masks=buffers.masks[idxs].view(-1, h * w, buffers.masks.shape[-1]).to(device),
+                envs=env_spaces,
+                device=device,
+            )
+        buffers.actions[idxs] = action.view(buffers.actions[idxs].shape).cpu()
+        buffers.logprobs[idxs] = logprob.view(len(actor_ids), -1).cpu()
+        for actor_id in actor_ids:
+            ready_events[actor_id].set()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    experiment_name = f"{args.exp_name}__{args.seed}__{int(time.time())}"
+    if args.prod_mode:
+        import wandb
+
+        wandb.init(
+            project=args.wandb_project_name,
+            entity=args.wandb_entity,
+            config=vars(args),
+            name=experiment_name,
+            save_code=True,
+        )
+    device = torch.device("cuda" if torch.cuda.is_available() and args.cuda else "cpu")
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+
+    # read the spaces from a one-game env; the learner process does not step any game
+    envs = make_envs(args, 2, 0)
+    env_spaces = SimpleNamespace(observation_space=envs.observation_space, action_plane_space=envs.action_plane_space)
+    envs.close()
+    h, w, c = env_spaces.observation_space.shape
+    nvec = env_spaces.action_plane_space.nvec
+    mapsize = h * w
+
+    agent = Agent(env_spaces, mapsize=mapsize).to(device)
+    optimizer = optim.Adam(agent.parameters(), lr=args.learning_rate, eps=1e-5)
+    shared_agent = Agent(env_spaces, mapsize=mapsize)
+    shared_agent.load_state_dict(agent.state_dict())
+    shared_agent.share_memory()
+
+    # actors and the inference server exchange observations, masks and actions through
+    # shared memory; the queues only carry actor ids and finished trajectories
+    ctx = mp.get_context("spawn")
+    buffers = SimpleNamespace(
+        obs=torch.zeros((args.num_actors, args.num_envs_per_actor, h, w, c)).share_memory_(),
+        masks=torch.zeros((args.num_actors, args.num_envs_per_actor, mapsize, nvec.sum()), dtype=torch.bool).share_memory_(),
+        actions=torch.zeros((args.num_actors, args.num_envs_per_actor, mapsize, len(nvec)), dtype=torch.long).share_memory_(),
+        logprobs=torch.zeros((args.num_actors, args.num_envs_per_actor)).share_memory_(),
+    )
+    version = ctx.Value("i", 0)
+    lock = ctx.Lock()
+    stop = ctx.Event()
+    request_queue = ctx.Queue()
+    ready_events = [ctx.Event() for _ in range(args.num_actors)]
+    trajectory_queue = ctx.Queue(maxsize=args.max_queued_trajectories)
+    processes = [
+        ctx.Process(
+            target=run_inference_server,
+            args=(args, env_spaces, shared_agent, version, lock, buffers, request_queue, ready_events, stop),
+        )
+    ]
+    for actor_id in range(args.num_actors):
+        processes += [
+            ctx.Process(
+                target=run_actor,
+                args=(actor_id, args, buffers, request_queue, ready_events[actor_id], trajectory_queue, stop),
+            )
+        ]
+    for process in processes:
+        process.start()
+
+    global_step = 0
+    start_time = time.time()
+    num_updates = args.total_timesteps // args.batch_size
+    for update in range(1, num_updates + 1):
+        trajectories = [trajectory_queue.get() for _ in range(args.num_trajectories_per_batch)]
+        batch = {key: torch.cat([t[key] for t in trajectories], 1 if key not in ["next_obs", "next_done"] else 0)
+                 for key in ["obs", "masks", "actions", "logprobs", "rewards", "dones", "next_obs", "next_done"]}
+        global_step += args.batch_size
+        for trajectory in trajectories:
+            for episode_reward in trajectory["episode_rewards"]:
+                print(f"global_step={global_step}, episode_reward={episode_reward}")
+                if args.prod_mode:
+                    wandb.log({"charts/episode_reward": episode_reward}, step=global_step)
+
+        num_steps, num_envs = batch["rewards"].shape
+        b_obs = unpack_bits(batch["obs"], c).float().to(device).view(-1, h, w, c)
+        b_masks = unpack_bits(batch["masks"], nvec.sum()).to(device).view(-1, mapsize, nvec.sum())
+        b_actions = batch["actions"].long().to(device).view(-1, mapsize, len(nvec))
+        _, target_logprobs, entropy, _, values = agent.get_action_and_value(b_obs, b_actions, b_masks, env_spaces, device)
+        target_logprobs, values = target_logprobs.view(num_steps, num_envs), values.view(num_steps, num_envs)
+        with torch.no_grad():
+            last_value = agent.get_value(unpack_bits(batch["next_obs"], c).float().to(device))
+            vs, pg_advantages = compute_vtrace(
+                batch["logprobs"].to(device),
+                target_logprobs,
+                batch["rewards"].to(device),
+                values,
+                batch["dones"].to(device),
+                last_value,
+                batch["next_done"].to(device),
+                args.gamma,
+                args.rho_bar,
+                args.c_bar,
+            )
+
+        pg_loss = -(pg_advantages * target_logprobs).mean()
+        v_loss = 0.5 * ((vs - values) ** 2).mean()
+        entropy_loss = entropy.mean()
+        loss = pg_loss - args.ent_coef * entropy_loss + v_loss * args.vf_coef
+        optimizer.zero_grad()
+        loss.backward()
+        nn.utils.clip_grad_norm_(agent.parameters(), args.max_grad_norm)
+        optimizer.step()
+
+        # publish the new parameters to the inference server
+        with lock:
+            shared_agent.load_state_dict(agent.state_dict())
+            version.value += 1
+
+        sps = int(global_step / (time.time() - start_time))
+        print("SPS:", sps)
+        if args.prod_mode:
+            wandb.log(
+                {
+                    "charts/update": update,
+                    "charts/sps": sps,
+                    "losses/value_loss": v_loss.item(),
+                    "losses/policy_loss": pg_loss.item(),
+                    "losses/entropy": entropy_loss.item(),
+                    "debug/mean_rho": (target_logprobs - batch["logprobs"].to(device)).exp().mean().item(),
+                },
+                step=global_step,
+            )
+            if update % 50 == 0:
+                torch.save(agent.state_dict(), f"{wandb.run.dir}/agent.pt")
+                wandb.save(f"{wandb.run.dir}/agent.pt", policy="now")
+
+    stop.set()
+    for process in processes:
+        process.join()
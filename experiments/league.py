@@ -13,12 +13,17 @@ import torch
 from gym.spaces import MultiDiscrete
 from gym_microrts.envs.vec_env import MicroRTSGridModeVecEnv, MicroRTSBotVecEnv
 from gym_microrts import microrts_ai
+from gym_microrts.exported_policy import EXPORTED_POLICY_EXTENSIONS, load_policy
 from stable_baselines3.common.vec_env import VecMonitor, VecVideoRecorder
 from torch.utils.tensorboard import SummaryWriter
-from trueskill import TrueSkill, Rating, rate_1vs1, quality_1vs1
+from trueskill import quality_1vs1
 from ppo_gridnet import Agent, MicroRTSStatsRecorder, CategoricalMasked
 from jpype.types import JArray, JInt
 import itertools
+import multiprocessing
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from match_cache import MatchCache, player_key
+from league_ratings import LeagueRatings
 
 def parse_args():
     # fmt: off
@@ -34,12 +39,22 @@ def parse_args():
 
     parser.add_argument('--partial-obs', type=lambda x: bool(strtobool(x)), default=False, nargs='?', const=True,
         help='if toggled, the game will have partial observability')
-    parser.add_argument('--rl-ais', nargs='+', default= ['agent_sota.pt'], #
+    parser.add_argument('--rl-ais', nargs='+', default= ['agent_sota.pt'], # `.pt` state dicts or policies exported by `export_agent.py`
         help='the ais')
     parser.add_argument('--built-in-ais', nargs='+', default=["randomBiasedAI","workerRushAI","lightRushAI","coacAI"],
         help='the ais')
     parser.add_argument('--num-matches', type=int, default=10,
         help='seed of the experiment')
+    parser.add_argument('--num-bot-envs', type=int, default=16,
+        help='the number of games the built-in-ai vs built-in-ai engine plays at once')
+    parser.add_argument('--num-workers', type=int, default=min(4, os.cpu_count()),
+        help='the number of worker processes playing matchups in parallel; each worker owns a JVM, a bot engine and the rl-ais it loads')
+    parser.add_argument('--min-match-quality', type=float, default=0.05,
+        help='matchups whose `quality_1vs1` drops below this value are not played further, their outcome being predictable; 0 plays all games')
+    parser.add_argument('--target-sigma', type=float, default=0.0,
+        help='stop scheduling games once the TrueSkill sigma of every ai is at most this value; 0 plays all games')
+    parser.add_argument('--match-cache', type=str, default="match_cache.sqlite",
+        help='the sqlite file where finished games are cached across runs')
     # default=["randomBiasedAI","workerRushAI","lightRushAI","coacAI","randomAI","passiveAI","naiveMCTSAI","mixedBot","rojo","izanagi","tiamat","droplet","guidedRojoA3N"]
     args = parser.parse_args()
     # fmt: on
@@ -82,6 +97,36 @@ def create_envs(mode: int, partial_obs: bool, built_in_ais=None, built_in_ais2=N
         )
         
 
+class ExportedAgent:
+    """Plays a policy exported by `export_agent.py` through the `get_action_and_value`
+    interface of `ppo_gridnet.Agent`, which reads the action masks from the env."""
+
+    def __init__(self, path, device):
+        self.policy = load_policy(path, device)
+
+    def eval(self):
+        return self
+
+    def get_action_and_value(self, x, envs=None, device=None):
+        invalid_action_masks = torch.tensor(np.array(envs.vec_client.getMasks(0))).to(device)
+        invalid_action_masks = invalid_action_masks.view(x.shape[0], -1, invalid_action_masks.shape[-1])
+        action, logprob, value = self.policy(x, invalid_action_masks[:, :, 1:])
+        return action.to(device), logprob, None, invalid_action_masks, value
+
+
+def load_agent(rl_ai, envs, device):
+    if rl_ai.endswith(EXPORTED_POLICY_EXTENSIONS):
+        return ExportedAgent(rl_ai, device)
+    agent = Agent(envs).to(device)
+    agent.load_state_dict(torch.load(rl_ai))
+    agent.eval()
+    return agent
+
+
+def is_rl_ai(ai):
+    return ai.endswith((".pt",) + EXPORTED_POLICY_EXTENSIONS)
+
+
 class Match:
     def __init__(self, mode: int, partial_obs: bool, built_in_ais=None, built_in_ais2=None, rl_ai=None, rl_ai2=None):
         # mode 0: rl-ai vs built-in-ai
@@ -106,9 +151,7 @@ class Match:
                 map_path="maps/16x16/basesWorkers16x16A.xml",
                 reward_weight=np.array([10.0, 1.0, 1.0, 0.2, 1.0, 4.0]),
             )
-            self.agent = Agent(self.envs).to(self.device)
-            self.agent.load_state_dict(torch.load(self.rl_ai))
-            self.agent.eval()
+            self.agent = load_agent(self.rl_ai, self.envs, self.device)
         elif mode == 1:
             self.envs = MicroRTSGridModeVecEnv(
                 num_selfplay_envs=2,
@@ -118,12 +161,8 @@ class Match:
                 map_path="maps/16x16/basesWorkers16x16A.xml",
                 reward_weight=np.array([10.0, 1.0, 1.0, 0.2, 1.0, 4.0]),
             )
-            self.agent = Agent(self.envs).to(self.device)
-            self.agent.load_state_dict(torch.load(self.rl_ai))
-            self.agent.eval()
-            self.agent2 = Agent(self.envs).to(self.device)
-            self.agent2.load_state_dict(torch.load(self.rl_ai2))
-            self.agent2.eval()
+            self.agent = load_agent(self.rl_ai, self.envs, self.device)
+            self.agent2 = load_agent(self.rl_ai2, self.envs, self.device)
         else:
             self.envs = MicroRTSBotVecEnv(
                 ai1s=built_in_ais,
@@ -133,9 +172,14 @@ class Match:
                 map_path="maps/16x16/basesWorkers16x16.xml",
                 reward_weight=np.array([10.0, 1.0, 1.0, 0.2, 1.0, 4.0])
             )
+        self.vec_env = self.envs
         self.envs = MicroRTSStatsRecorder(self.envs)
         self.envs = VecMonitor(self.envs)
 
+    def close(self):
+        # only the games are closed: closing the env would shut down the JVM of the process
+        self.vec_env.vec_client.close()
+
     def run(self, num_matches=7):
         if self.mode == 0:
             return self.run_m0(num_matches)
@@ -223,6 +267,149 @@ class Match:
                     if len(results) >= num_matches:
                         return results
 
+
+class BotMatchEngine:
+    """Plays built-in-ai vs built-in-ai games on one long-lived `MicroRTSBotVecEnv`.
+
+    Every env slot is assigned a pairing and a number of games to play; all slots
+    advance with a single batched `gameStep` per tick. Once every slot has played
+    its games, the next pairings are loaded with `swap_ais` on the running client
+    instead of building a new env per matchup.
+    """
+
+    def __init__(self, num_envs=16, max_steps=5000, map_path="maps/16x16/basesWorkers16x16.xml"):
+        self.num_envs = num_envs
+        self.max_steps = max_steps
+        self.map_path = map_path
+        self.envs = None
+        self.dummy_actions = [[[0, 0, 0, 0, 0, 0, 0, 0], [0, 0, 0, 0, 0, 0, 0, 0]] for _ in range(num_envs)]
+
+    def load(self, pairings):
+        ai1s = [eval(f"microrts_ai.{p0}") for p0, _ in pairings]
+        ai2s = [eval(f"microrts_ai.{p1}") for _, p1 in pairings]
+        if self.envs is None:
+            self.bot_envs = MicroRTSBotVecEnv(
+                ai1s=ai1s,
+                ai2s=ai2s,
+                max_steps=self.max_steps,
+                render_theme=2,
+                map_path=self.map_path,
+                reward_weight=np.array([10.0, 1.0, 1.0, 0.2, 1.0, 4.0])
+            )
+            self.envs = MicroRTSStatsRecorder(self.bot_envs)
+            self.envs = VecMonitor(self.envs)
+        else:
+            self.bot_envs.swap_ais(ai1s, ai2s)
+        self.envs.reset()
+
+    def play(self, pairings, num_matches):
+        """Plays `num_matches` games for each `(p0, p1)` pairing of built-in ai names;
+        `num_matches` is either one number for all pairings or a list with one per pairing.
+
+        Returns a dict mapping each pairing to the list of `WinLossRewardFunction`
+        results from the perspective of `p0`.
+        """
+        if np.isscalar(num_matches):
+            num_matches = [num_matches] * len(pairings)
+        results = {pairing: [] for pairing in pairings}
+        total_games = sum(num_matches)
+        games_per_slot = max(1, int(np.ceil(total_games / self.num_envs)))
+        assignments = []
+        for pairing, pairing_matches in zip(pairings, num_matches):
+            for start in range(0, pairing_matches, games_per_slot):
+                assignments += [(pairing, min(games_per_slot, pairing_matches - start))]
+
+        for wave_start in range(0, len(assignments), self.num_envs):
+            wave = assignments[wave_start : wave_start + self.num_envs]
+            # pad the last wave with slots whose games are not recorded
+            wave += [(wave[-1][0], 0)] * (self.num_envs - len(wave))
+            self.load([pairing for pairing, _ in wave])
+            remaining = np.array([quota for _, quota in wave])
+            while remaining.sum() > 0:
+                _, _, _, infos = self.envs.step(self.dummy_actions)
+                for idx, info in enumerate(infos):
+                    if "episode" in info.keys() and remaining[idx] > 0:
+                        item = info["microrts_stats"]["WinLossRewardFunction"]
+                        assert item != -2.0
+                        assert item != 2.0
+                        print(wave[idx][0], item)
+                        results[wave[idx][0]] += [item]
+                        remaining[idx] -= 1
+        return results
+
+
+# each worker process keeps its JVM and bot match engine alive across jobs
+worker_engine = None
+
+
+def init_worker(num_bot_envs):
+    global worker_engine
+    worker_engine = BotMatchEngine(num_envs=num_bot_envs)
+
+
+def play_match_ups(mode, pairings, num_matches):
+    """Plays `num_matches[i]` games of every `(p0, p1)` pairing and returns the results of
+    each pairing; built-in-ai pairings share the env slots of the worker's `BotMatchEngine`."""
+    if mode == 0:
+        (p0, p1), = pairings
+        match = Match(0, False, rl_ai=p0, built_in_ais=[eval(f"microrts_ai.{p1}")])
+        try:
+            return {(p0, p1): match.run(num_matches[0])}
+        finally:
+            match.close()
+    return worker_engine.play(pairings, num_matches)
+
+
+def match_settings(mode):
+    # the (map_path, max_steps, partial_obs) that `Match` and `BotMatchEngine` play with
+    map_path = "maps/16x16/basesWorkers16x16A.xml" if mode == 0 else "maps/16x16/basesWorkers16x16.xml"
+    return map_path, 5000, False
+
+
+def next_match_up(remaining_games, in_flight, ratings):
+    """Picks the matchup with games left whose outcome is the least predictable,
+    preferring matchups that are not already being played by another worker."""
+    candidates = [match_up for match_up in remaining_games if remaining_games[match_up] > 0]
+    idle_candidates = [match_up for match_up in candidates if match_up not in in_flight]
+    if len(idle_candidates) > 0:
+        candidates = idle_candidates
+    return max(candidates, key=lambda match_up: quality_1vs1(ratings[match_up[1]], ratings[match_up[2]]))
+
+
+def prune_match_ups(remaining_games, ratings, min_match_quality, target_sigma):
+    """Drops the games left of the matchups whose outcome is predictable, and of all matchups
+    once every rating is certain enough, so the leaderboard converges with fewer games."""
+    if target_sigma > 0 and all(rating.sigma <= target_sigma for rating in ratings.values()):
+        for match_up in remaining_games:
+            remaining_games[match_up] = 0
+        return
+    for match_up in remaining_games:
+        _, p0, p1 = match_up
+        if remaining_games[match_up] > 0 and quality_1vs1(ratings[p0], ratings[p1]) < min_match_quality:
+            print("dropping", match_up, "with", remaining_games[match_up], "games left")
+            remaining_games[match_up] = 0
+
+
+def next_job(remaining_games, in_flight, ratings, num_bot_envs):
+    """Returns the `(match_up, num_games)` of the next job. An rl-ai matchup is played in
+    full by one job; built-in-ai matchups fill the `num_bot_envs` slots of a job together,
+    starting with `next_match_up` and then the least predictable other matchups."""
+    match_up = next_match_up(remaining_games, in_flight, ratings)
+    if match_up[0] == 0:
+        return [(match_up, remaining_games[match_up])]
+    others = [other for other in remaining_games if other[0] == 2 and other != match_up and remaining_games[other] > 0]
+    others.sort(key=lambda other: (other in in_flight, -quality_1vs1(ratings[other[1]], ratings[other[2]])))
+    job = []
+    free_slots = num_bot_envs
+    for other in [match_up] + others:
+        if free_slots == 0:
+            break
+        num_games = min(free_slots, remaining_games[other])
+        job += [(other, num_games)]
+        free_slots -= num_games
+    return job
+
+
 if __name__ == "__main__":
     args = parse_args()
     # m = Match(0, False, built_in_ais=built_in_ais, rl_ai=rl_ai)
@@ -232,65 +419,72 @@ if __name__ == "__main__":
     # m = Match(2, False, built_in_ais=built_in_ais, built_in_ais2=built_in_ais)
     # r = m.run()
     all_ais = args.built_in_ais + args.rl_ais
-    ratings = dict(zip(all_ais, [Rating() for _ in range (len(all_ais))]))
-    match_historys = dict(zip(all_ais, [{} for _ in range (len(all_ais))]))
+    league_ratings = LeagueRatings(all_ais)
+    ratings, match_historys = league_ratings.ratings, league_ratings.match_historys
     match_ups = list(itertools.combinations(all_ais, 2))
     np.random.shuffle(match_ups)
+
+    # the games of every oriented matchup: both orientations of a built-in-ai pair are
+    # distinct matchups, while an rl-ai always plays as p0, so both orientations of an
+    # rl-ai vs built-in-ai pair are one matchup with the games of both
+    match_up_games = {}
     for idx in range(2):
         for match_up in match_ups:
             if idx == 0:
                 match_up = list(reversed(match_up))
-            rl_ais = []
-            built_in_ais = []
-            for ai in match_up:
-                if ai[-3:] == ".pt":
-                    rl_ais += [ai]
-                else:
-                    built_in_ais += [ai]
-            
+            rl_ais = [ai for ai in match_up if is_rl_ai(ai)]
+            built_in_ais = [ai for ai in match_up if not is_rl_ai(ai)]
             if len(rl_ais) == 1:
-                print("mode0")
-                p0 = rl_ais[0]
-                p1 = built_in_ais[0]
-                m = Match(0, False, rl_ai=p0, built_in_ais=[eval(f"microrts_ai.{p1}")])
+                match_up = (0, rl_ais[0], built_in_ais[0])
             else:
-                print("mode2")
-                p0 = built_in_ais[0]
-                p1 = built_in_ais[1]
-                m = Match(2, False, built_in_ais=[eval(f"microrts_ai.{p0}")], built_in_ais2=[eval(f"microrts_ai.{p1}")])
-            
-            r = m.run(args.num_matches // 2)
-            for item in r:
-                if item == 1:
-                    ratings[p0], ratings[p1] = rate_1vs1(ratings[p0], ratings[p1])
-                    if p1 not in match_historys[p0]:
-                        match_historys[p0][p1] = [1, 0, 0]
-                    else:
-                        match_historys[p0][p1][0] += 1
-                    if p0 not in match_historys[p1]:
-                        match_historys[p1][p0] = [0, 0, 1]
-                    else:
-                        match_historys[p1][p0][2] += 1
-                elif item == 0:
-                    ratings[p0], ratings[p1] = rate_1vs1(ratings[p0], ratings[p1], drawn=True)
-                    if p1 not in match_historys[p0]:
-                        match_historys[p0][p1] = [0, 1, 0]
-                    else:
-                        match_historys[p0][p1][1] += 1
-                    if p0 not in match_historys[p1]:
-                        match_historys[p1][p0] = [0, 1, 0]
-                    else:
-                        match_historys[p1][p0][1] += 1
-                else:
-                    ratings[p1], ratings[p0] = rate_1vs1(ratings[p1], ratings[p0])
-                    if p1 not in match_historys[p0]:
-                        match_historys[p0][p1] = [0, 0, 1]
-                    else:
-                        match_historys[p0][p1][2] += 1
-                    if p0 not in match_historys[p1]:
-                        match_historys[p1][p0] = [1, 0, 0]
-                    else:
-                        match_historys[p1][p0][0] += 1
+                match_up = (2, built_in_ais[0], built_in_ais[1])
+            match_up_games[match_up] = match_up_games.get(match_up, 0) + args.num_matches // 2
+
+    # matchups are spread over a pool of worker processes, each holding its own JVM;
+    # ratings are updated as soon as a job returns and the next job always goes to
+    # the matchup with the highest `quality_1vs1`, i.e. the most uncertain outcome
+    # matchups falling below `--min-match-quality` are dropped, and scheduling stops
+    # altogether once every sigma is under `--target-sigma`
+    # games already in the cache are replayed into the ratings, once and in the order they
+    # were played, and not played again
+    cache = MatchCache(args.match_cache)
+    keys = {ai: player_key(ai) for ai in all_ais}
+    remaining_games = {}
+    cached_games = []
+    for match_up, num_games in match_up_games.items():
+        mode, p0, p1 = match_up
+        cached = cache.games(keys[p0], keys[p1], *match_settings(mode), num_matches=num_games)
+        cached_games += [(order, p0, p1, item) for order, item in cached]
+        remaining_games[match_up] = num_games - len(cached)
+    league_ratings.replay(cached_games)
+    in_flight = {}
+    with ProcessPoolExecutor(
+        max_workers=args.num_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_worker,
+        initargs=(args.num_bot_envs,),
+    ) as executor:
+        while len(in_flight) > 0 or sum(remaining_games.values()) > 0:
+            prune_match_ups(remaining_games, ratings, args.min_match_quality, args.target_sigma)
+            while len(in_flight) < args.num_workers and sum(remaining_games.values()) > 0:
+                in_flight_match_ups = [match_up for job in in_flight.values() for match_up, _ in job]
+                job = next_job(remaining_games, in_flight_match_ups, ratings, args.num_bot_envs)
+                for match_up, num_games in job:
+                    remaining_games[match_up] -= num_games
+                pairings = [(p0, p1) for (_, p0, p1), _ in job]
+                future = executor.submit(play_match_ups, job[0][0][0], pairings, [num_games for _, num_games in job])
+                in_flight[future] = job
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                job = in_flight.pop(future)
+                results = future.result()
+                for (mode, p0, p1), _ in job:
+                    r = results[(p0, p1)]
+                    cache.add(keys[p0], keys[p1], *match_settings(mode), r)
+                    for item in r:
+                        league_ratings.record(p0, p1, item)
+                    print(f"mode{mode}", p0, "vs", p1, ratings[p0], ratings[p1])
+    cache.close()
     leaderboard = sorted(ratings, key=lambda item: ratings[item].mu - 3 *ratings[item].sigma, reverse=True)
     leaderboard = [(item, round(ratings[item].mu - 3 *ratings[item].sigma,2), ratings[item])  for item in leaderboard]
     
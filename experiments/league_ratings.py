@@ -0,0 +1,53 @@
+from trueskill import Rating, rate_1vs1
+
+
+class LeagueRatings:
+    """The TrueSkill ratings and the `[win, tie, loss]` histories of the ais of a league.
+
+    TrueSkill updates depend on the order of the games, so `replay` records cached games
+    in the order they were added to the cache, i.e. the order the run that played them
+    recorded them in.
+    """
+
+    def __init__(self, ais):
+        self.ratings = dict(zip(ais, [Rating() for _ in range(len(ais))]))
+        self.match_historys = dict(zip(ais, [{} for _ in range(len(ais))]))
+
+    def record(self, p0, p1, item):
+        """Records a game with `WinLossRewardFunction` result `item` from the perspective of `p0`."""
+        ratings, match_historys = self.ratings, self.match_historys
+        if item == 1:
+            ratings[p0], ratings[p1] = rate_1vs1(ratings[p0], ratings[p1])
+            if p1 not in match_historys[p0]:
+                match_historys[p0][p1] = [1, 0, 0]
+            else:
+                match_historys[p0][p1][0] += 1
+            if p0 not in match_historys[p1]:
+                match_historys[p1][p0] = [0, 0, 1]
+            else:
+                match_historys[p1][p0][2] += 1
+        elif item == 0:
+            ratings[p0], ratings[p1] = rate_1vs1(ratings[p0], ratings[p1], drawn=True)
+            if p1 not in match_historys[p0]:
+                match_historys[p0][p1] = [0, 1, 0]
+            else:
+                match_historys[p0][p1][1] += 1
+            if p0 not in match_historys[p1]:
+                match_historys[p1][p0] = [0, 1, 0]
+            else:
+                match_historys[p1][p0][1] += 1
+        else:
+            ratings[p1], ratings[p0] = rate_1vs1(ratings[p1], ratings[p0])
+            if p1 not in match_historys[p0]:
+                match_historys[p0][p1] = [0, 0, 1]
+            else:
+                match_historys[p0][p1][2] += 1
+            if p0 not in match_historys[p1]:
+                match_historys[p1][p0] = [1, 0, 0]
+            else:
+                match_historys[p1][p0][0] += 1
+
+    def replay(self, games):
+        """Records cached `(order, p0, p1, item)` games, `order` coming from `MatchCache.games`."""
+        for _, p0, p1, item in sorted(games, key=lambda game: game[0]):
+            self.record(p0, p1, item)
@@ -0,0 +1,81 @@
+import hashlib
+import os
+import sqlite3
+
+from gym_microrts.exported_policy import EXPORTED_POLICY_EXTENSIONS
+
+
+def player_key(ai):
+    """Identifies an ai in the cache: the content hash of a `.pt` checkpoint (or of an
+    exported policy), or the name of a built-in ai. Retrained checkpoints saved to the
+    same path therefore never reuse stale results."""
+    if not ai.endswith((".pt",) + EXPORTED_POLICY_EXTENSIONS):
+        return ai
+    sha256 = hashlib.sha256()
+    with open(ai, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+class MatchCache:
+    """Persistent store of finished games.
+
+    Each game is keyed by (player, opponent, map_path, max_steps, partial_obs, seed),
+    where `player`/`opponent` come from `player_key` and `result` is the
+    `WinLossRewardFunction` value from the player's perspective. microrts games are
+    not seedable, so `seed` is the index of the game within its matchup: asking for
+    `n` games of a matchup means seeds `0..n-1`, and only the missing ones are played.
+    """
+
+    def __init__(self, path="match_cache.sqlite"):
+        self.path = path
+        self.conn = sqlite3.connect(os.path.expanduser(path))
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS matches (
+                player TEXT NOT NULL,
+                opponent TEXT NOT NULL,
+                map_path TEXT NOT NULL,
+                max_steps INTEGER NOT NULL,
+                partial_obs INTEGER NOT NULL,
+                seed INTEGER NOT NULL,
+                result REAL NOT NULL,
+                PRIMARY KEY (player, opponent, map_path, max_steps, partial_obs, seed)
+            )"""
+        )
+        self.conn.commit()
+
+    def results(self, player, opponent, map_path, max_steps, partial_obs, num_matches=None):
+        """Returns the cached results of a matchup ordered by seed, at most `num_matches` of them."""
+        return [result for _, result in self.games(player, opponent, map_path, max_steps, partial_obs, num_matches)]
+
+    def games(self, player, opponent, map_path, max_steps, partial_obs, num_matches=None):
+        """Like `results`, but returns `(order, result)` pairs, where `order` ranks the games of
+        all matchups by when they were added to the cache."""
+        rows = self.conn.execute(
+            """SELECT rowid, result FROM matches
+            WHERE player = ? AND opponent = ? AND map_path = ? AND max_steps = ? AND partial_obs = ?
+            ORDER BY seed""",
+            (player, opponent, map_path, max_steps, int(partial_obs)),
+        ).fetchall()
+        games = [(row[0], row[1]) for row in rows]
+        if num_matches is not None:
+            games = games[:num_matches]
+        return games
+
+    def add(self, player, opponent, map_path, max_steps, partial_obs, results):
+        """Appends newly played games of a matchup under the next free seeds."""
+        key = (player, opponent, map_path, max_steps, int(partial_obs))
+        with self.conn:
+            num_cached = self.conn.execute(
+                """SELECT COUNT(*) FROM matches
+                WHERE player = ? AND opponent = ? AND map_path = ? AND max_steps = ? AND partial_obs = ?""",
+                key,
+            ).fetchone()[0]
+            self.conn.executemany(
+                "INSERT INTO matches VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [key + (num_cached + i, float(result)) for i, result in enumerate(results)],
+            )
+
+    def close(self):
+        self.conn.close()
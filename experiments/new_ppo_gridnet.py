@@ -12,7 +12,9 @@ from gym.spaces import MultiDiscrete
 from gym_microrts import microrts_ai
 from gym_microrts.envs.new_vec_env import MicroRTSGridModeVecEnv
 from stable_baselines3.common.vec_env import VecEnvWrapper, VecMonitor, VecVideoRecorder
-from torch.distributions.categorical import Categorical
+from gym_microrts.distributions import MaskedMultiCategorical
+from gym_microrts.profiling import TorchProfile, span
+from gym_microrts.rollout_buffer import RolloutBuffer, compute_gae, prefetch_minibatches
 
 
 def parse_args():
@@ -44,12 +46,24 @@ def parse_args():
     # Algorithm specific arguments
     parser.add_argument('--partial-obs', type=lambda x: bool(strtobool(x)), default=False, nargs='?', const=True,
         help='if toggled, the game will have partial observability')
+    parser.add_argument('--delta-obs', type=lambda x: bool(strtobool(x)), default=False, nargs='?', const=True,
+        help='if toggled, the envs only re-encode the cells that changed every step')
+    parser.add_argument('--obs-features', nargs='+', default=None,
+        help='the observation feature groups the agent sees (all if not set), e.g. `hp owner unit_type`')
+    parser.add_argument('--torch-outputs', type=lambda x: bool(strtobool(x)), default=False, nargs='?', const=True,
+        help='if toggled, the envs return float32 tensors over their own buffers, pinned when training on the GPU')
     parser.add_argument('--n-minibatch', type=int, default=4,
         help='the number of mini batch')
     parser.add_argument('--num-bot-envs', type=int, default=0,
         help='the number of bot game environment; 16 bot envs measn 16 games')
     parser.add_argument('--num-selfplay-envs', type=int, default=24,
         help='the number of self play envs; 16 self play envs means 8 games')
+    parser.add_argument('--num-threads', type=int, default=1,
+        help='the number of vec clients the games are split over and stepped by in parallel')
+    parser.add_argument('--bot-threads', type=int, default=1,
+        help='the number of vec clients the bot envs are split over and stepped by in parallel')
+    parser.add_argument('--bot-time-budget-ms', type=int, default=None,
+        help='the time budget per action of the search-based bots (their own budgets if not set)')
     parser.add_argument('--num-steps', type=int, default=256,
         help='the number of steps per game environment')
     parser.add_argument('--gamma', type=float, default=0.99,
@@ -80,6 +94,14 @@ def parse_args():
         help="Toggle learning rate annealing for policy and value networks")
     parser.add_argument('--clip-vloss', type=lambda x: bool(strtobool(x)), default=True, nargs='?', const=True,
         help='Toggles wheter or not to use a clipped loss for the value function, as per the paper.')
+    parser.add_argument('--sparse-policy', type=lambda x: bool(strtobool(x)), default=False, nargs='?', const=True,
+        help='if toggled, the policy head is only evaluated and stored at cells with a source unit')
+    parser.add_argument('--prefetch-minibatches', type=lambda x: bool(strtobool(x)), default=True, nargs='?', const=True,
+        help='if toggled, the next minibatches are gathered from CPU storage on a background thread')
+    parser.add_argument('--profile', type=lambda x: bool(strtobool(x)), default=False, nargs='?', const=True,
+        help='if toggled, the first updates are profiled with the env, rollout and agent ranges into a Chrome trace')
+    parser.add_argument('--profile-updates', type=int, default=2,
+        help='the number of updates profiled with `--profile`')
 
     args = parser.parse_args()
     if not args.seed:
@@ -114,25 +136,6 @@ class MicroRTSStatsRecorder(VecEnvWrapper):
 
 
 # ALGO LOGIC: initialize agent here:
-class CategoricalMasked(Categorical):
-    def __init__(self, probs=None, logits=None, validate_args=None, masks=[], device=None):
-        self.masks = masks
-        self.device = device
-        if len(self.masks) == 0:
-            super(CategoricalMasked, self).__init__(probs, logits, validate_args)
-        else:
-            self.masks = masks.bool()
-            logits = torch.where(self.masks, logits, torch.tensor(-1e8, device=self.device))
-            super(CategoricalMasked, self).__init__(probs, logits, validate_args)
-
-    def entropy(self):
-        if len(self.masks) == 0:
-            return super(CategoricalMasked, self).entropy()
-        p_log_p = self.logits * self.probs
-        p_log_p = torch.where(self.masks, p_log_p, torch.tensor(0.0).to(self.device))
-        return -p_log_p.sum(-1)
-
-
 class Scale(nn.Module):
     def __init__(self, scale):
         super().__init__()
@@ -195,38 +198,50 @@ class Agent(nn.Module):
         )
 
     def get_action_and_value(self, x, action=None, invalid_action_masks=None, envs=None, device=None):
-        hidden = self.encoder(x)
-        logits = self.actor(hidden)
-        grid_logits = logits.reshape(-1, envs.action_plane_space.nvec.sum())
-        split_logits = torch.split(grid_logits, envs.action_plane_space.nvec.tolist(), dim=1)
-
-        if action is None:
-            # invalid_action_masks = torch.tensor(np.array(envs.vec_client.getMasks(0))).to(device)
-            invalid_action_masks = invalid_action_masks.view(-1, invalid_action_masks.shape[-1])
-            split_invalid_action_masks = torch.split(invalid_action_masks, envs.action_plane_space.nvec.tolist(), dim=1)
-            multi_categoricals = [
-                CategoricalMasked(logits=logits, masks=iam, device=device)
-                for (logits, iam) in zip(split_logits, split_invalid_action_masks)
-            ]
-            action = torch.stack([categorical.sample() for categorical in multi_categoricals])
-        else:
+        with span("agent.get_action_and_value"):
+            hidden = self.encoder(x)
+            logits = self.actor(hidden)
+            grid_logits = logits.reshape(-1, envs.action_plane_space.nvec.sum())
             invalid_action_masks = invalid_action_masks.view(-1, invalid_action_masks.shape[-1])
-            action = action.view(-1, action.shape[-1]).T
-            split_invalid_action_masks = torch.split(invalid_action_masks, envs.action_plane_space.nvec.tolist(), dim=1)
-            multi_categoricals = [
-                CategoricalMasked(logits=logits, masks=iam, device=device)
-                for (logits, iam) in zip(split_logits, split_invalid_action_masks)
-            ]
-        logprob = torch.stack([categorical.log_prob(a) for a, categorical in zip(action, multi_categoricals)])
-        entropy = torch.stack([categorical.entropy() for categorical in multi_categoricals])
-        num_predicted_parameters = len(envs.action_plane_space.nvec)
-        logprob = logprob.T.view(-1, self.mapsize, num_predicted_parameters)
-        entropy = entropy.T.view(-1, self.mapsize, num_predicted_parameters)
-        action = action.T.view(-1, self.mapsize, num_predicted_parameters)
-        return action, logprob.sum(1).sum(1), entropy.sum(1).sum(1), invalid_action_masks, self.critic(hidden)
+            multi_categorical = MaskedMultiCategorical(grid_logits, invalid_action_masks, envs.action_plane_space.nvec)
+            if action is None:
+                action = multi_categorical.sample()
+            else:
+                action = action.view(-1, action.shape[-1])
+            logprob = multi_categorical.log_prob(action)
+            entropy = multi_categorical.entropy()
+            num_predicted_parameters = len(envs.action_plane_space.nvec)
+            logprob = logprob.view(-1, self.mapsize, num_predicted_parameters)
+            entropy = entropy.view(-1, self.mapsize, num_predicted_parameters)
+            action = action.view(-1, self.mapsize, num_predicted_parameters)
+            return action, logprob.sum(1).sum(1), entropy.sum(1).sum(1), invalid_action_masks, self.critic(hidden)
+
+    def get_sparse_action_and_value(self, x, unit_idxs, unit_masks, unit_actions=None, envs=None):
+        """Like `get_action_and_value`, but the action distributions are only built at the
+        source-unit cells `unit_idxs` (flat indices into the `x.shape[0] * mapsize` cells).
+
+        Cells without a source unit have no valid action: the dense path gives each of them a
+        log-probability that does not depend on the logits (-sum(log(nvec)) for their uniform
+        distribution, rounded to 0 next to the -1e8 mask in float32), which cancels in the PPO
+        ratio, and a zero entropy, so both paths train the same policy.
+        Returns the `(num_units, len(nvec))` actions and the per-env log-probabilities,
+        entropies and values.
+        """
+        with span("agent.get_sparse_action_and_value"):
+            hidden = self.encoder(x)
+            logits = self.actor(hidden)
+            unit_logits = logits.reshape(-1, envs.action_plane_space.nvec.sum())[unit_idxs]
+            multi_categorical = MaskedMultiCategorical(unit_logits, unit_masks, envs.action_plane_space.nvec)
+            if unit_actions is None:
+                unit_actions = multi_categorical.sample()
+            unit_envs = unit_idxs // self.mapsize
+            logprob = torch.zeros(x.shape[0], device=x.device).index_add_(0, unit_envs, multi_categorical.log_prob(unit_actions).sum(1))
+            entropy = torch.zeros(x.shape[0], device=x.device).index_add_(0, unit_envs, multi_categorical.entropy().sum(1))
+            return unit_actions, logprob, entropy, self.critic(hidden)
 
     def get_value(self, x):
-        return self.critic(self.encoder(x))
+        with span("agent.get_value"):
+            return self.critic(self.encoder(x))
 
 
 if __name__ == "__main__":
@@ -264,6 +279,14 @@ if __name__ == "__main__":
         + [microrts_ai.workerRushAI for _ in range(int(args.num_bot_envs/3))],
         map_paths=["maps/16x16/basesWorkers16x16.xml"],
         reward_weight=np.array([10.0, 1.0, 1.0, 4.0, 4.0, 4.0, 0.2, 0.2, 1.0]),
+        profile=args.profile,
+        num_threads=args.num_threads,
+        bot_threads=args.bot_threads,
+        bot_time_budget_ms=args.bot_time_budget_ms,
+        delta_obs=args.delta_obs,
+        obs_features=args.obs_features,
+        torch_outputs=args.torch_outputs,
+        pin_memory=args.torch_outputs and device.type == "cuda",
     )
     envs = MicroRTSStatsRecorder(envs)
     envs = VecMonitor(envs)
@@ -284,19 +307,16 @@ if __name__ == "__main__":
     action_space_shape = (mapsize, len(envs.action_plane_space.nvec))
     invalid_action_shape = (mapsize, envs.action_plane_space.nvec.sum())
 
-    obs = torch.zeros((args.num_steps, args.num_envs) + envs.observation_space.shape).to(device)
-    actions = torch.zeros((args.num_steps, args.num_envs) + action_space_shape).to(device)
-    logprobs = torch.zeros((args.num_steps, args.num_envs)).to(device)
-    rewards = torch.zeros((args.num_steps, args.num_envs)).to(device)
-    dones = torch.zeros((args.num_steps, args.num_envs)).to(device)
-    values = torch.zeros((args.num_steps, args.num_envs)).to(device)
-    invalid_action_masks = torch.zeros((args.num_steps, args.num_envs) + invalid_action_shape).to(device)
+    rollouts = RolloutBuffer(
+        args.num_steps, args.num_envs, envs.observation_space.shape, envs.action_plane_space.nvec, device, args.sparse_policy,
+        storage_device="cpu" if args.prefetch_minibatches else device,
+    )
     # TRY NOT TO MODIFY: start the game
     global_step = 0
     start_time = time.time()
     # Note how `next_obs` and `next_done` are used; their usage is equivalent to
     # https://github.com/ikostrikov/pytorch-a2c-ppo-acktr-gail/blob/84a7582477fb0d5c82ad6d850fe476829dddd2e1/a2c_ppo_acktr/storage.py#L60
-    next_obs = torch.Tensor(envs.reset()).to(device)
+    next_obs = torch.as_tensor(envs.reset(), dtype=torch.float32).to(device, non_blocking=True)
     next_done = torch.zeros(args.num_envs).to(device)
     num_updates = args.total_timesteps // args.batch_size
 
@@ -321,146 +341,156 @@ if __name__ == "__main__":
     total_params = sum([param.nelement() for param in agent.parameters()])
     print("Model's total parameters:", total_params)
 
-    for update in range(starting_update, num_updates + 1):
-        # Annealing the rate if instructed to do so.
-        if args.anneal_lr:
-            frac = 1.0 - (update - 1.0) / num_updates
-            lrnow = lr(frac)
-            optimizer.param_groups[0]["lr"] = lrnow
-
-        # TRY NOT TO MODIFY: prepare the execution of the game.
-        for step in range(0, args.num_steps):
-            #envs.render()
-            global_step += 1 * args.num_envs
-            obs[step] = next_obs
-            dones[step] = next_done
-            # ALGO LOGIC: put action logic here
+    profile = None
+    if args.profile:
+        # Java stepping, Python encoding and torch kernels on one timeline
+        profile = TorchProfile(f"runs/{experiment_name}/trace.json", use_cuda=device.type == "cuda")
+        profile.start()
+
+    try:
+        for update in range(starting_update, num_updates + 1):
+            # Annealing the rate if instructed to do so.
+            if args.anneal_lr:
+                frac = 1.0 - (update - 1.0) / num_updates
+                lrnow = lr(frac)
+                optimizer.param_groups[0]["lr"] = lrnow
+
+            rollouts.reset()
+            # TRY NOT TO MODIFY: prepare the execution of the game.
+            for step in range(0, args.num_steps):
+                #envs.render()
+                global_step += 1 * args.num_envs
+                # ALGO LOGIC: put action logic here
+                with torch.no_grad():
+                    if args.sparse_policy:
+                        # only the cells with a source unit are evaluated and stored
+                        step_masks = np.array(envs.get_action_mask()).reshape(-1, invalid_action_shape[-1])
+                        step_unit_idxs = np.flatnonzero(envs.source_unit_mask)
+                        step_unit_masks = torch.tensor(step_masks[step_unit_idxs]).to(device)
+                        step_unit_idxs = torch.tensor(step_unit_idxs).to(device)
+                        step_unit_actions, logproba, _, vs = agent.get_sparse_action_and_value(
+                            next_obs, step_unit_idxs, step_unit_masks, envs=envs
+                        )
+                        rollouts.add(step, next_obs, next_done, vs.flatten(), logproba, step_unit_actions, step_unit_masks, step_unit_idxs)
+                        action = torch.zeros((args.num_envs * mapsize, action_space_shape[-1]), dtype=torch.long).to(device)
+                        action[step_unit_idxs] = step_unit_actions
+                    else:
+                        step_masks = torch.tensor(np.array(envs.get_action_mask())).to(device)
+                        action, logproba, _, _, vs = agent.get_action_and_value(
+                            next_obs, envs=envs, invalid_action_masks=step_masks, device=device
+                        )
+                        rollouts.add(step, next_obs, next_done, vs.flatten(), logproba, action, step_masks)
+
+                try:
+                    next_obs, rs, ds, infos = envs.step(action.cpu().numpy().reshape(envs.num_envs, -1))
+                    next_obs = torch.as_tensor(next_obs, dtype=torch.float32).to(device, non_blocking=True)
+                except Exception as e:
+                    e.printStackTrace()
+                    raise
+                rollouts.rewards[step], next_done = torch.Tensor(rs).to(device), torch.Tensor(ds).to(device)
+
+                for info in infos:
+                    if "episode" in info.keys():
+                        print(f"global_step={global_step}, episode_reward={info['episode']['r']}")
+                        run.log({"charts/episode_reward": info['episode']['r']}, step=global_step)
+                        for key in info["microrts_stats"]:
+                            run.log({f"rewards/{key}": info["microrts_stats"][key]}, step=global_step)
+                        break
+
+            rollouts.finish()
+            rewards, dones, values, logprobs = rollouts.rewards, rollouts.dones, rollouts.values, rollouts.logprobs
+            # bootstrap reward if not done. reached the batch limit
             with torch.no_grad():
-                invalid_action_masks[step] = torch.tensor(np.array(envs.get_action_mask())).to(device)
-                action, logproba, _, _, vs = agent.get_action_and_value(
-                    next_obs, envs=envs, invalid_action_masks=invalid_action_masks[step], device=device
+                last_value = agent.get_value(next_obs.to(device)).reshape(1, -1)
+                advantages, returns = compute_gae(
+                    rewards, values, dones, last_value, next_done, args.gamma, args.gae_lambda, args.gae
                 )
-                values[step] = vs.flatten()
-
-            actions[step] = action
-            logprobs[step] = logproba
-            try:
-                next_obs, rs, ds, infos = envs.step(action.cpu().numpy().reshape(envs.num_envs, -1))
-                next_obs = torch.Tensor(next_obs).to(device)
-            except Exception as e:
-                e.printStackTrace()
-                raise
-            rewards[step], next_done = torch.Tensor(rs).to(device), torch.Tensor(ds).to(device)
-
-            for info in infos:
-                if "episode" in info.keys():
-                    print(f"global_step={global_step}, episode_reward={info['episode']['r']}")
-                    run.log({"charts/episode_reward": info['episode']['r']}, step=global_step)
-                    for key in info["microrts_stats"]:
-                        run.log({f"rewards/{key}": info["microrts_stats"][key]}, step=global_step)
-                    break
-
-        # bootstrap reward if not done. reached the batch limit
-        with torch.no_grad():
-            last_value = agent.get_value(next_obs.to(device)).reshape(1, -1)
-            if args.gae:
-                advantages = torch.zeros_like(rewards).to(device)
-                lastgaelam = 0
-                for t in reversed(range(args.num_steps)):
-                    if t == args.num_steps - 1:
-                        nextnonterminal = 1.0 - next_done
-                        nextvalues = last_value
+
+            # flatten the batch
+            b_logprobs = logprobs.reshape(-1)
+            b_advantages = advantages.reshape(-1)
+            b_returns = returns.reshape(-1)
+            b_values = values.reshape(-1)
+
+            # Optimizaing the policy and value network
+            inds = np.arange(
+                args.batch_size,
+            )
+            for i_epoch_pi in range(args.update_epochs):
+                np.random.shuffle(inds)
+                minibatch_inds = [inds[start : start + args.minibatch_size] for start in range(0, args.batch_size, args.minibatch_size)]
+                if args.prefetch_minibatches:
+                    minibatches = prefetch_minibatches(rollouts, minibatch_inds, device)
+                else:
+                    minibatches = (rollouts.minibatch(minibatch_ind) for minibatch_ind in minibatch_inds)
+                for minibatch_ind, (mb_obs, mb_actions, mb_invalid_action_masks, mb_unit_idxs) in zip(minibatch_inds, minibatches):
+                    mb_advantages = b_advantages[minibatch_ind]
+                    if args.norm_adv:
+                        mb_advantages = (mb_advantages - mb_advantages.mean()) / (mb_advantages.std() + 1e-8)
+                    if args.sparse_policy:
+                        _, newlogproba, entropy, new_values = agent.get_sparse_action_and_value(
+                            mb_obs, mb_unit_idxs, mb_invalid_action_masks, mb_actions, envs
+                        )
                     else:
-                        nextnonterminal = 1.0 - dones[t + 1]
-                        nextvalues = values[t + 1]
-                    delta = rewards[t] + args.gamma * nextvalues * nextnonterminal - values[t]
-                    advantages[t] = lastgaelam = delta + args.gamma * args.gae_lambda * nextnonterminal * lastgaelam
-                returns = advantages + values
-            else:
-                returns = torch.zeros_like(rewards).to(device)
-                for t in reversed(range(args.num_steps)):
-                    if t == args.num_steps - 1:
-                        nextnonterminal = 1.0 - next_done
-                        next_return = last_value
+                        _, newlogproba, entropy, _, new_values = agent.get_action_and_value(
+                            mb_obs, mb_actions, mb_invalid_action_masks, envs, device
+                        )
+                    ratio = (newlogproba - b_logprobs[minibatch_ind]).exp()
+
+                    # Stats
+                    approx_kl = (b_logprobs[minibatch_ind] - newlogproba).mean()
+
+                    # Policy loss
+                    pg_loss1 = -mb_advantages * ratio
+                    pg_loss2 = -mb_advantages * torch.clamp(ratio, 1 - args.clip_coef, 1 + args.clip_coef)
+                    pg_loss = torch.max(pg_loss1, pg_loss2).mean()
+                    entropy_loss = entropy.mean()
+
+                    # Value loss
+                    new_values = new_values.view(-1)
+                    if args.clip_vloss:
+                        v_loss_unclipped = (new_values - b_returns[minibatch_ind]) ** 2
+                        v_clipped = b_values[minibatch_ind] + torch.clamp(
+                            new_values - b_values[minibatch_ind], -args.clip_coef, args.clip_coef
+                        )
+                        v_loss_clipped = (v_clipped - b_returns[minibatch_ind]) ** 2
+                        v_loss_max = torch.max(v_loss_unclipped, v_loss_clipped)
+                        v_loss = 0.5 * v_loss_max.mean()
                     else:
-                        nextnonterminal = 1.0 - dones[t + 1]
-                        next_return = returns[t + 1]
-                    returns[t] = rewards[t] + args.gamma * nextnonterminal * next_return
-                advantages = returns - values
-
-        # flatten the batch
-        b_obs = obs.reshape((-1,) + envs.observation_space.shape)
-        b_logprobs = logprobs.reshape(-1)
-        b_actions = actions.reshape((-1,) + action_space_shape)
-        b_advantages = advantages.reshape(-1)
-        b_returns = returns.reshape(-1)
-        b_values = values.reshape(-1)
-        b_invalid_action_masks = invalid_action_masks.reshape((-1,) + invalid_action_shape)
-
-        # Optimizaing the policy and value network
-        inds = np.arange(
-            args.batch_size,
-        )
-        for i_epoch_pi in range(args.update_epochs):
-            np.random.shuffle(inds)
-            for start in range(0, args.batch_size, args.minibatch_size):
-                end = start + args.minibatch_size
-                minibatch_ind = inds[start:end]
-                mb_advantages = b_advantages[minibatch_ind]
-                if args.norm_adv:
-                    mb_advantages = (mb_advantages - mb_advantages.mean()) / (mb_advantages.std() + 1e-8)
-                _, newlogproba, entropy, _, new_values = agent.get_action_and_value(
-                    b_obs[minibatch_ind], b_actions.long()[minibatch_ind], b_invalid_action_masks[minibatch_ind], envs, device
-                )
-                ratio = (newlogproba - b_logprobs[minibatch_ind]).exp()
-
-                # Stats
-                approx_kl = (b_logprobs[minibatch_ind] - newlogproba).mean()
-
-                # Policy loss
-                pg_loss1 = -mb_advantages * ratio
-                pg_loss2 = -mb_advantages * torch.clamp(ratio, 1 - args.clip_coef, 1 + args.clip_coef)
-                pg_loss = torch.max(pg_loss1, pg_loss2).mean()
-                entropy_loss = entropy.mean()
-
-                # Value loss
-                new_values = new_values.view(-1)
-                if args.clip_vloss:
-                    v_loss_unclipped = (new_values - b_returns[minibatch_ind]) ** 2
-                    v_clipped = b_values[minibatch_ind] + torch.clamp(
-                        new_values - b_values[minibatch_ind], -args.clip_coef, args.clip_coef
-                    )
-                    v_loss_clipped = (v_clipped - b_returns[minibatch_ind]) ** 2
-                    v_loss_max = torch.max(v_loss_unclipped, v_loss_clipped)
-                    v_loss = 0.5 * v_loss_max.mean()
-                else:
-                    v_loss = 0.5 * ((new_values - b_returns[minibatch_ind]) ** 2)
-
-                loss = pg_loss - args.ent_coef * entropy_loss + v_loss * args.vf_coef
-
-                optimizer.zero_grad()
-                loss.backward()
-                nn.utils.clip_grad_norm_(agent.parameters(), args.max_grad_norm)
-                optimizer.step()
-
-        ## CRASH AND RESUME LOGIC:
-        if args.prod_mode:
-            # make sure to tune `CHECKPOINT_FREQUENCY` so models are not saved too frequently
-            if update % CHECKPOINT_FREQUENCY == 0:
-                torch.save(agent.state_dict(), f"{wandb.run.dir}/agent.pt")
-                wandb.save(f"{wandb.run.dir}/agent.pt", policy="now")
-                print("model saved")
-
-        # TRY NOT TO MODIFY: record rewards for plotting purposes
-        run.log({"charts/learning_rate": optimizer.param_groups[0]["lr"]}, step=global_step)
-        run.log({"charts/update": update}, step=global_step)
-        run.log({"losses/value_loss": v_loss.item()}, step=global_step)
-        run.log({"losses/policy_loss": pg_loss.item()}, step=global_step)
-        run.log({"losses/entropy": entropy.mean().item()}, step=global_step)
-        run.log({"losses/approx_kl": approx_kl.item()}, step=global_step)
-        if args.kle_stop or args.kle_rollback:
-            run.log({"debug/pg_stop_iter": i_epoch_pi}, step=global_step)
-        run.log({"charts/sps": int(global_step / (time.time() - start_time))}, step=global_step)
-        print("SPS:", int(global_step / (time.time() - start_time)))
+                        v_loss = 0.5 * ((new_values - b_returns[minibatch_ind]) ** 2)
+
+                    loss = pg_loss - args.ent_coef * entropy_loss + v_loss * args.vf_coef
+
+                    optimizer.zero_grad()
+                    loss.backward()
+                    nn.utils.clip_grad_norm_(agent.parameters(), args.max_grad_norm)
+                    optimizer.step()
+
+            ## CRASH AND RESUME LOGIC:
+            if args.prod_mode:
+                # make sure to tune `CHECKPOINT_FREQUENCY` so models are not saved too frequently
+                if update % CHECKPOINT_FREQUENCY == 0:
+                    torch.save(agent.state_dict(), f"{wandb.run.dir}/agent.pt")
+                    wandb.save(f"{wandb.run.dir}/agent.pt", policy="now")
+                    print("model saved")
+
+            # TRY NOT TO MODIFY: record rewards for plotting purposes
+            run.log({"charts/learning_rate": optimizer.param_groups[0]["lr"]}, step=global_step)
+            run.log({"charts/update": update}, step=global_step)
+            run.log({"losses/value_loss": v_loss.item()}, step=global_step)
+            run.log({"losses/policy_loss": pg_loss.item()}, step=global_step)
+            run.log({"losses/entropy": entropy.mean().item()}, step=global_step)
+            run.log({"losses/approx_kl": approx_kl.item()}, step=global_step)
+            if args.kle_stop or args.kle_rollback:
+                run.log({"debug/pg_stop_iter": i_epoch_pi}, step=global_step)
+            run.log({"charts/sps": int(global_step / (time.time() - start_time))}, step=global_step)
+            run.log(envs.telemetry(), step=global_step)
+            print("SPS:", int(global_step / (time.time() - start_time)))
+
+            if profile is not None and update == starting_update + args.profile_updates - 1:
+                profile.stop()
+    finally:
+        if profile is not None:
+            profile.stop()
 
     envs.close()
@@ -13,6 +13,7 @@ import torch.optim as optim
 from gym.spaces import MultiDiscrete
 from gym_microrts import microrts_ai
 from gym_microrts.envs.new_vec_env import MicroRTSGridModeVecEnv
+from gym_microrts.exported_policy import EXPORTED_POLICY_EXTENSIONS, load_policy
 from stable_baselines3.common.vec_env import VecEnvWrapper, VecMonitor, VecVideoRecorder
 from torch.distributions.categorical import Categorical
 
@@ -57,7 +58,7 @@ def parse_args():
     parser.add_argument('--num-steps', type=int, default=256,
         help='the number of steps per game environment')
     parser.add_argument("--agent-model-path", type=str, default="agent.pt",
-        help="the path to the agent's model")
+        help="the path to the agent's model; a `.pt` state dict or a policy exported by `export_agent.py`")
     parser.add_argument('--ai', type=str, default="lightRushAI",
         help='the number of steps per game environment')
 
@@ -147,7 +148,11 @@ if __name__ == "__main__":
 
     # CRASH AND RESUME LOGIC:
     starting_update = 1
-    agent.load_state_dict(torch.load(args.agent_model_path))
+    if args.agent_model_path.endswith(EXPORTED_POLICY_EXTENSIONS):
+        policy = load_policy(args.agent_model_path, device)
+    else:
+        policy = None
+        agent.load_state_dict(torch.load(args.agent_model_path))
     agent.eval()
 
     print("Model's state_dict:")
@@ -167,10 +172,13 @@ if __name__ == "__main__":
             with torch.no_grad():
                 invalid_action_masks[step] = torch.tensor(
                     np.array(envs.get_action_mask())).to(device)
-                action, logproba, _, _, vs = agent.get_action_and_value(
-                    next_obs, envs=envs, invalid_action_masks=invalid_action_masks[
-                        step], device=device
-                )
+                if policy is not None:
+                    action, logproba, vs = policy(next_obs, invalid_action_masks[step])
+                else:
+                    action, logproba, _, _, vs = agent.get_action_and_value(
+                        next_obs, envs=envs, invalid_action_masks=invalid_action_masks[
+                            step], device=device
+                    )
                 values[step] = vs.flatten()
 
             actions[step] = action
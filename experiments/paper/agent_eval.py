@@ -2,7 +2,9 @@
 
 import argparse
 import glob
+import os
 import random
+import sys
 import time
 from distutils.util import strtobool
 
@@ -17,6 +19,10 @@ from stable_baselines3.common.vec_env import VecEnvWrapper, VecVideoRecorder
 from torch.distributions.categorical import Categorical
 from torch.utils.tensorboard import SummaryWriter
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from match_cache import MatchCache, player_key
+from win_rate import win_rate_decided
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="PPO agent")
     # Common arguments
@@ -79,6 +85,22 @@ if __name__ == "__main__":
         help="the path to the agent's model",
     )
     parser.add_argument("--max-steps", type=int, default=2000, help="the maximum number of game steps in microrts")
+    parser.add_argument(
+        "--num-envs-per-opponent", type=int, default=2, help="the number of env slots each opponent gets in the batched gridnet evaluation"
+    )
+    parser.add_argument(
+        "--eval-precision",
+        type=float,
+        default=0.25,
+        help="stop playing an opponent once its score rate is known within +/- this value; 0 plays all `--num-eval-runs` games. "
+        "With the default 10 runs only one-sided matchups stop early (a sweep after 8 games); close matchups need a larger `--num-eval-runs`",
+    )
+    parser.add_argument(
+        "--eval-confidence", type=float, default=0.95, help="the confidence level of the `--eval-precision` stopping rule"
+    )
+    parser.add_argument(
+        "--match-cache", type=str, default="match_cache.sqlite", help="the sqlite file where finished games are cached across runs"
+    )
 
     args = parser.parse_args()
     if not args.seed:
@@ -183,7 +205,9 @@ all_ais = {
     "guidedRojoA3N": microrts_ai.guidedRojoA3N,
 }
 ai_names, ais = list(all_ais.keys()), list(all_ais.values())
-ai_match_stats = dict(zip(ai_names, np.zeros((len(ais), 3))))
+# rows are [loss, tie, win]; the dict values are views into `ai_match_stats_array`
+ai_match_stats_array = np.zeros((len(ais), 3))
+ai_match_stats = dict(zip(ai_names, ai_match_stats_array))
 args.num_envs = len(ais)
 ai_envs = []
 gridnet_exps = [
@@ -198,23 +222,27 @@ gridnet_exps = [
     "ppo_gridnet_selfplay_encode_decode",
     "ppo_gridnet_selfplay_diverse_encode_decode",
 ]
-for i in range(len(ais)):
-    if args.exp_name in gridnet_exps:
-        envs = MicroRTSGridModeVecEnv(
-            num_bot_envs=1,
-            num_selfplay_envs=0,
-            max_steps=args.max_steps,
-            render_theme=2,
-            ai2s=[ais[i]],
-            map_path="maps/16x16/basesWorkers16x16A.xml",
-            reward_weight=np.array([10.0, 1.0, 1.0, 0.2, 1.0, 4.0]),
-        )
-        envs = MicroRTSStatsRecorder(envs)
-        envs = VecMonitor(envs)
-        envs = VecVideoRecorder(
-            envs, f"videos/{experiment_name}/{ai_names[i]}", record_video_trigger=lambda x: x % 4000 == 0, video_length=2000
-        )
-    else:
+if args.exp_name in gridnet_exps:
+    # all opponents share one vec env with `--num-envs-per-opponent` slots each, so the
+    # agent evaluates every opponent with a single batched forward pass
+    args.num_envs = len(ais) * args.num_envs_per_opponent
+    slot_opponents = np.repeat(np.arange(len(ais)), args.num_envs_per_opponent)
+    batched_envs = MicroRTSGridModeVecEnv(
+        num_bot_envs=args.num_envs,
+        num_selfplay_envs=0,
+        max_steps=args.max_steps,
+        render_theme=2,
+        ai2s=[ais[i] for i in slot_opponents],
+        map_path="maps/16x16/basesWorkers16x16A.xml",
+        reward_weight=np.array([10.0, 1.0, 1.0, 0.2, 1.0, 4.0]),
+    )
+    envs = MicroRTSStatsRecorder(batched_envs)
+    envs = VecMonitor(envs)
+    envs = VecVideoRecorder(
+        envs, f"videos/{experiment_name}", record_video_trigger=lambda x: x % 4000 == 0, video_length=2000
+    )
+else:
+    for i in range(len(ais)):
         envs = MicroRTSVecEnv(
             num_envs=1,
             max_steps=args.max_steps,
@@ -228,7 +256,7 @@ for i in range(len(ais)):
         envs = VecVideoRecorder(
             envs, f"videos/{experiment_name}/{ai_names[i]}", record_video_trigger=lambda x: x % 4000 == 0, video_length=2000
         )
-    ai_envs += [envs]
+        ai_envs += [envs]
 assert isinstance(envs.action_space, MultiDiscrete), "only MultiDiscrete action space is supported"
 
 # ALGO LOGIC: initialize agent here:
@@ -1116,10 +1144,102 @@ invalid_action_masks = torch.zeros((args.num_steps, args.num_envs) + invalid_act
 global_step = 0
 start_time = time.time()
 
+# games already in the cache are counted and not played again
+match_cache = MatchCache(args.match_cache)
+agent_key = player_key(args.agent_model_path)
+eval_map_path = "maps/16x16/basesWorkers16x16A.xml" if args.exp_name in gridnet_exps else "maps/16x16/basesWorkers16x16.xml"
+cached_game_counts = []
+for ai_name in ai_names:
+    cached = match_cache.results(agent_key, ai_name, eval_map_path, args.max_steps, False, num_matches=args.num_eval_runs)
+    for item in cached:
+        ai_match_stats[ai_name][int(item) + 1] += 1
+    cached_game_counts += [len(cached)]
+
+if args.exp_name in gridnet_exps:
+    game_counts = np.array(cached_game_counts)
+    decided = np.array([
+        game_counts[i] >= args.num_eval_runs
+        or win_rate_decided(ai_match_stats_array[i], args.eval_precision, args.eval_confidence, args.num_eval_runs)
+        for i in range(len(ais))
+    ])
+    undecided = np.nonzero(~decided)[0]
+    # the slots are dealt round-robin to the undecided opponents once, and the remaining games
+    # of an opponent are spread evenly over its slots; every slot counts the first games it
+    # finishes up to its quota, so early-finishing games are not over-represented, and slots
+    # move on to their next game as soon as one ends instead of waiting for the whole batch.
+    # Moving a single slot to another opponent would restart every game (`swap_ais`), so the
+    # slots of an opponent that gets decided simply stop counting
+    if len(undecided) > 0:
+        new_slot_opponents = np.array([undecided[slot % len(undecided)] for slot in range(args.num_envs)])
+        if not np.array_equal(new_slot_opponents, slot_opponents):
+            slot_opponents = new_slot_opponents
+            batched_envs.swap_ais([ais[i] for i in slot_opponents])
+    slot_quotas = np.zeros(args.num_envs, dtype=int)
+    for i in undecided:
+        slots = np.nonzero(slot_opponents == i)[0]
+        remaining = args.num_eval_runs - game_counts[i]
+        slot_quotas[slots] = [remaining // len(slots) + (k < remaining % len(slots)) for k in range(len(slots))]
+    slot_game_counts = np.zeros(args.num_envs, dtype=int)
+    next_obs = torch.Tensor(envs.reset()).to(device)
+    from jpype.types import JArray, JInt
+
+    while ((slot_game_counts < slot_quotas) & ~decided[slot_opponents]).any():
+        with torch.no_grad():
+            action, logproba, _, invalid_action_mask = agent.get_action(next_obs, envs=envs)
+        real_action = torch.cat(
+            [torch.stack([torch.arange(0, mapsize, device=device) for i in range(envs.num_envs)]).unsqueeze(2), action], 2
+        )
+        real_action = real_action.cpu().numpy()
+        valid_actions = real_action[invalid_action_mask[:, :, 0].bool().cpu().numpy()]
+        valid_actions_counts = invalid_action_mask[:, :, 0].sum(1).long().cpu().numpy()
+        java_valid_actions = []
+        valid_action_idx = 0
+        for env_idx, valid_action_count in enumerate(valid_actions_counts):
+            java_valid_action = []
+            for c in range(valid_action_count):
+                java_valid_action += [JArray(JInt)(valid_actions[valid_action_idx])]
+                valid_action_idx += 1
+            java_valid_actions += [JArray(JArray(JInt))(java_valid_action)]
+        java_valid_actions = JArray(JArray(JArray(JInt)))(java_valid_actions)
+
+        try:
+            next_obs, rs, ds, infos = envs.step(java_valid_actions)
+            next_obs = torch.Tensor(next_obs).to(device)
+        except Exception as e:
+            e.printStackTrace()
+            raise
+
+        # tally win/tie/loss per opponent from the `WinLossRewardFunction` reward of the final step
+        finished = np.array(ds, dtype=bool) & (slot_game_counts < slot_quotas) & ~decided[slot_opponents]
+        if finished.any():
+            slot_game_counts[finished] += 1
+            win_loss = np.array([info["raw_rewards"][0] for info in infos])[finished].astype(int)
+            np.add.at(ai_match_stats_array, (slot_opponents[finished], win_loss + 1), 1)
+            np.add.at(game_counts, slot_opponents[finished], 1)
+            for i, item in zip(slot_opponents[finished], win_loss):
+                print("against", ai_names[i], item)
+                match_cache.add(agent_key, ai_names[i], eval_map_path, args.max_steps, False, [item])
+            for i in np.unique(slot_opponents[finished]):
+                decided[i] = win_rate_decided(ai_match_stats_array[i], args.eval_precision, args.eval_confidence, args.num_eval_runs)
+
+    for i in range(len(ais)):
+        for (label, val) in zip(["loss", "tie", "win"], ai_match_stats_array[i]):
+            writer.add_scalar(f"charts/{ai_names[i]}/{label}", val, 0)
+    if args.prod_mode and args.capture_video:
+        for video_file in glob.glob(f"videos/{experiment_name}/*.mp4"):
+            wandb.log({"RL agent against all opponents": wandb.Video(video_file)})
+
 for envs_idx, envs in enumerate(ai_envs):
+    game_count = cached_game_counts[envs_idx]
+    if game_count >= args.num_eval_runs or win_rate_decided(
+        ai_match_stats[ai_names[envs_idx]], args.eval_precision, args.eval_confidence, args.num_eval_runs
+    ):
+        envs.close()
+        for (label, val) in zip(["loss", "tie", "win"], ai_match_stats[ai_names[envs_idx]]):
+            writer.add_scalar(f"charts/{ai_names[envs_idx]}/{label}", val, 0)
+        continue
     next_obs = torch.Tensor(envs.reset()).to(device)
     next_done = torch.zeros(args.num_envs).to(device)
-    game_count = 0
     from jpype.types import JArray, JInt
 
     while True:
@@ -1173,13 +1293,23 @@ for envs_idx, envs in enumerate(ai_envs):
                     ai_match_stats[ai_names[envs_idx]][1] += 1
                 elif info["microrts_stats"]["WinLossRewardFunction"] == 1.0:
                     ai_match_stats[ai_names[envs_idx]][2] += 1
+                match_cache.add(
+                    agent_key,
+                    ai_names[envs_idx],
+                    eval_map_path,
+                    args.max_steps,
+                    False,
+                    [info["microrts_stats"]["WinLossRewardFunction"]],
+                )
                 game_count += 1
                 # writer.add_scalar(f"charts/episode_reward/{key}", , global_step)
                 # for key in info['microrts_stats']:
                 #     writer.add_scalar(f"charts/episode_reward/{key}", info['microrts_stats'][key], global_step)
                 # print("=============================================")
                 # break
-        if game_count >= args.num_eval_runs:
+        if game_count >= args.num_eval_runs or win_rate_decided(
+            ai_match_stats[ai_names[envs_idx]], args.eval_precision, args.eval_confidence, args.num_eval_runs
+        ):
             envs.close()
             for (label, val) in zip(["loss", "tie", "win"], ai_match_stats[ai_names[envs_idx]]):
                 writer.add_scalar(f"charts/{ai_names[envs_idx]}/{label}", val, 0)
@@ -1216,5 +1346,6 @@ if args.prod_mode:
     # wandb.log({"cumulative": wandb.plot.bar(table, "cumulative match result", "number of games", title="RL agent cumulative results")})
 
 
+match_cache.close()
 envs.close()
 writer.close()
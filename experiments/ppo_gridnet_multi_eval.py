@@ -0,0 +1,238 @@
+import argparse
+import os
+import random
+import time
+from distutils.util import strtobool
+
+import numpy as np
+import torch
+import torch.nn as nn
+from gym.spaces import MultiDiscrete
+from gym_microrts.envs.vec_env import MicroRTSGridModeVecEnv
+from gym_microrts import microrts_ai
+from stable_baselines3.common.vec_env import VecMonitor
+
+from ppo_gridnet import Agent, MicroRTSStatsRecorder
+
+
+def parse_args():
+    # fmt: off
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--exp-name', type=str, default=os.path.basename(__file__).rstrip(".py"),
+        help='the name of this experiment')
+    parser.add_argument('--seed', type=int, default=1,
+        help='seed of the experiment')
+    parser.add_argument('--torch-deterministic', type=lambda x: bool(strtobool(x)), default=True, nargs='?', const=True,
+        help='if toggled, `torch.backends.cudnn.deterministic=False`')
+    parser.add_argument('--cuda', type=lambda x: bool(strtobool(x)), default=True, nargs='?', const=True,
+        help='if toggled, cuda will not be enabled by default')
+    parser.add_argument('--prod-mode', type=lambda x: bool(strtobool(x)), default=False, nargs='?', const=True,
+        help='run the script in production mode and use wandb to log outputs')
+    parser.add_argument('--wandb-project-name', type=str, default="cleanRL",
+        help="the wandb's project name")
+    parser.add_argument('--wandb-entity', type=str, default=None,
+        help="the entity (team) of wandb's project")
+
+    parser.add_argument('--partial-obs', type=lambda x: bool(strtobool(x)), default=False, nargs='?', const=True,
+        help='if toggled, the game will have partial observability')
+    parser.add_argument('--agent-model-paths', nargs='+', default=["agent_sota.pt"],
+        help="the paths to the checkpoints to evaluate; they must share the `Agent` architecture")
+    parser.add_argument('--ais', nargs='+', default=["coacAI"],
+        help='the built-in ais every checkpoint plays against')
+    parser.add_argument('--num-envs-per-agent', type=int, default=2,
+        help='the number of games each checkpoint plays at once')
+    parser.add_argument('--num-eval-runs', type=int, default=10,
+        help='the number of games each checkpoint plays in total, spread evenly over its envs')
+    args = parser.parse_args()
+    if not args.seed:
+        args.seed = int(time.time())
+    # fmt: on
+    return args
+
+
+def stack_conv(layers):
+    """Merges the same `Conv2d`/`ConvTranspose2d` of K networks into one grouped convolution
+    over inputs whose channels are the K networks' channels concatenated."""
+    layer = layers[0]
+    conv_class = type(layer)
+    kwargs = dict(kernel_size=layer.kernel_size, stride=layer.stride, padding=layer.padding, groups=len(layers))
+    if conv_class == nn.ConvTranspose2d:
+        kwargs["output_padding"] = layer.output_padding
+    conv = conv_class(layer.in_channels * len(layers), layer.out_channels * len(layers), **kwargs)
+    # grouped weights are laid out group after group along the first dimension for both
+    # `Conv2d` (out, in / groups, ...) and `ConvTranspose2d` (in, out / groups, ...)
+    conv.weight.data.copy_(torch.cat([layer.weight.data for layer in layers]))
+    conv.bias.data.copy_(torch.cat([layer.bias.data for layer in layers]))
+    return conv
+
+
+class StackedLinear(nn.Module):
+    """Applies the same `Linear` of K networks to inputs of shape (n, K, in_features)."""
+
+    def __init__(self, layers):
+        super().__init__()
+        self.weight = nn.Parameter(torch.stack([layer.weight.data for layer in layers]))
+        self.bias = nn.Parameter(torch.stack([layer.bias.data for layer in layers]))
+
+    def forward(self, x):
+        return torch.einsum("nki,koi->nko", x, self.weight) + self.bias
+
+
+def stack_sequential(sequentials):
+    stacked = []
+    for layers in zip(*sequentials):
+        if isinstance(layers[0], (nn.Conv2d, nn.ConvTranspose2d)):
+            stacked += [stack_conv(layers)]
+        elif isinstance(layers[0], nn.Linear):
+            stacked += [StackedLinear(layers)]
+        else:
+            # pooling and activations act on each channel independently
+            stacked += [layers[0]]
+    return nn.Sequential(*stacked)
+
+
+class StackedAgent(Agent):
+    """K checkpoints of `Agent` evaluated in one forward pass.
+
+    The envs are laid out checkpoint after checkpoint: env `i` is played by checkpoint
+    `i // num_envs_per_agent`. Observations of the K checkpoints are stacked along the
+    channel dimension and every layer runs as a grouped convolution, so the inherited
+    `get_action_and_value` works unchanged and routes each env to its own checkpoint.
+    """
+
+    def __init__(self, envs, agents, mapsize=16 * 16):
+        super(StackedAgent, self).__init__(envs, mapsize)
+        self.num_agents = len(agents)
+        # the leading / trailing `Transpose` of encoder and actor are replaced by the reshapes below
+        self.stacked_encoder = stack_sequential([agent.encoder[1:] for agent in agents])
+        self.stacked_actor = stack_sequential([agent.actor[:-1] for agent in agents])
+        self.stacked_critic = stack_sequential([agent.critic[1:] for agent in agents])
+        del self.encoder, self.actor, self.critic
+        self.encoder = self.encode
+        self.actor = self.act
+        self.critic = self.criticize
+
+    def encode(self, x):
+        # (K * n, h, w, c) -> (n, K * c, h, w)
+        _, h, w, c = x.shape
+        x = x.view(self.num_agents, -1, h, w, c).permute(1, 0, 4, 2, 3).reshape(-1, self.num_agents * c, h, w)
+        return self.stacked_encoder(x)
+
+    def act(self, hidden):
+        # (n, K * 78, h, w) -> (K * n, h, w, 78)
+        logits = self.stacked_actor(hidden)
+        n, kc, h, w = logits.shape
+        return logits.view(n, self.num_agents, kc // self.num_agents, h, w).permute(1, 0, 3, 4, 2).reshape(-1, h, w, kc // self.num_agents)
+
+    def criticize(self, hidden):
+        # (n, K * 256, 1, 1) -> (K * n, 1)
+        values = self.stacked_critic(hidden.view(hidden.shape[0], self.num_agents, -1))
+        return values.permute(1, 0, 2).reshape(-1, 1)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    experiment_name = f"{args.exp_name}__{args.seed}__{int(time.time())}"
+    device = torch.device("cuda" if torch.cuda.is_available() and args.cuda else "cpu")
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    torch.backends.cudnn.deterministic = args.torch_deterministic
+
+    num_agents = len(args.agent_model_paths)
+    args.num_envs = num_agents * args.num_envs_per_agent
+    env_agents = np.repeat(np.arange(num_agents), args.num_envs_per_agent)
+    env_ais = [args.ais[i % len(args.ais)] for i in range(args.num_envs_per_agent)] * num_agents
+    envs = MicroRTSGridModeVecEnv(
+        num_bot_envs=args.num_envs,
+        num_selfplay_envs=0,
+        partial_obs=args.partial_obs,
+        max_steps=5000,
+        render_theme=2,
+        ai2s=[eval(f"microrts_ai.{ai}") for ai in env_ais],
+        map_path="maps/16x16/basesWorkers16x16A.xml",
+        reward_weight=np.array([10.0, 1.0, 1.0, 0.2, 1.0, 4.0]),
+    )
+    envs = MicroRTSStatsRecorder(envs)
+    envs = VecMonitor(envs)
+    assert isinstance(envs.action_space, MultiDiscrete), "only MultiDiscrete action space is supported"
+
+    agents = []
+    for agent_model_path in args.agent_model_paths:
+        agent = Agent(envs)
+        agent.load_state_dict(torch.load(agent_model_path, map_location="cpu"))
+        agents += [agent]
+    agent = StackedAgent(envs, agents).to(device)
+    agent.eval()
+
+    # rows are [loss, tie, win] of every (checkpoint, opponent)
+    match_stats = np.zeros((num_agents, len(args.ais), 3))
+    # as in `paper/agent_eval.py`, every slot counts the first games it finishes, a fixed
+    # number of them, rather than a checkpoint counting its first finished games from any
+    # slot: short games are not over-represented and every checkpoint plays the same mix
+    # of opponents; the `num_eval_runs` games of a checkpoint are spread evenly over its slots
+    slot_quotas = np.tile([
+        args.num_eval_runs // args.num_envs_per_agent + (slot < args.num_eval_runs % args.num_envs_per_agent)
+        for slot in range(args.num_envs_per_agent)
+    ], num_agents)
+    slot_game_counts = np.zeros(args.num_envs, dtype=int)
+    env_ai_idxs = np.array([args.ais.index(ai) for ai in env_ais])
+    mapsize = 16 * 16
+    start_time = time.time()
+    next_obs = torch.Tensor(envs.reset()).to(device)
+    from jpype.types import JArray, JInt
+
+    while (slot_game_counts < slot_quotas).any():
+        with torch.no_grad():
+            action, _, _, invalid_action_masks, _ = agent.get_action_and_value(next_obs, envs=envs, device=device)
+        real_action = torch.cat(
+            [torch.stack([torch.arange(0, mapsize, device=device) for i in range(envs.num_envs)]).unsqueeze(2), action], 2
+        )
+        real_action = real_action.cpu().numpy()
+        valid_actions = real_action[invalid_action_masks[:, :, 0].bool().cpu().numpy()]
+        valid_actions_counts = invalid_action_masks[:, :, 0].sum(1).long().cpu().numpy()
+        java_valid_actions = []
+        valid_action_idx = 0
+        for env_idx, valid_action_count in enumerate(valid_actions_counts):
+            java_valid_action = []
+            for c in range(valid_action_count):
+                java_valid_action += [JArray(JInt)(valid_actions[valid_action_idx])]
+                valid_action_idx += 1
+            java_valid_actions += [JArray(JArray(JInt))(java_valid_action)]
+        java_valid_actions = JArray(JArray(JArray(JInt)))(java_valid_actions)
+
+        try:
+            next_obs, rs, ds, infos = envs.step(java_valid_actions)
+            next_obs = torch.Tensor(next_obs).to(device)
+        except Exception as e:
+            e.printStackTrace()
+            raise
+
+        for idx, info in enumerate(infos):
+            if "episode" in info.keys() and slot_game_counts[idx] < slot_quotas[idx]:
+                result = int(info["microrts_stats"]["WinLossRewardFunction"])
+                match_stats[env_agents[idx], env_ai_idxs[idx], result + 1] += 1
+                slot_game_counts[idx] += 1
+                print(args.agent_model_paths[env_agents[idx]], "against", env_ais[idx], result)
+
+    print(f"evaluated {num_agents} checkpoints in {time.time() - start_time:.1f}s")
+    rows = []
+    for k, agent_model_path in enumerate(args.agent_model_paths):
+        for j, ai in enumerate(args.ais):
+            loss, tie, win = match_stats[k, j]
+            rows += [[agent_model_path, ai, win, tie, loss]]
+            print(f"{agent_model_path} against {ai}: win={win:.0f} tie={tie:.0f} loss={loss:.0f}")
+    if args.prod_mode:
+        import wandb
+
+        wandb.init(
+            project=args.wandb_project_name,
+            entity=args.wandb_entity,
+            config=vars(args),
+            name=experiment_name,
+            save_code=True,
+        )
+        wandb.log({"match_results": wandb.Table(data=rows, columns=["agent", "ai", "win", "tie", "loss"])})
+
+    envs.close()
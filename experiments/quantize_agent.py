@@ -0,0 +1,127 @@
+import argparse
+import os
+import time
+from distutils.util import strtobool
+
+import numpy as np
+import torch
+from gym_microrts import microrts_ai
+from gym_microrts.envs.new_vec_env import MicroRTSGridModeVecEnv
+from gym_microrts.exported_policy import GridnetPolicy, quantize_policy
+from stable_baselines3.common.vec_env import VecMonitor
+
+from new_ppo_gridnet import Agent, MicroRTSStatsRecorder
+
+
+def parse_args():
+    # fmt: off
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--agent-model-path', type=str, default="agent_sota.pt",
+        help="the path to the agent's state dict")
+    parser.add_argument('--output', type=str, default=None,
+        help='the TorchScript file of the int8 policy (defaults to the model path with `.int8.ts`)')
+    parser.add_argument('--seed', type=int, default=1,
+        help='seed of the experiment')
+    parser.add_argument('--partial-obs', type=lambda x: bool(strtobool(x)), default=False, nargs='?', const=True,
+        help='if toggled, the game will have partial observability')
+    parser.add_argument('--ais', nargs='+', default=["coacAI", "workerRushAI", "lightRushAI"],
+        help='the built-in ais the calibration and evaluation games are played against')
+    parser.add_argument('--num-calibration-steps', type=int, default=256,
+        help='the number of steps of every env recorded to calibrate and check the int8 policy')
+    parser.add_argument('--quantize-actor', type=lambda x: bool(strtobool(x)), default=True, nargs='?', const=True,
+        help='if toggled, the actor\'s transposed convolutions also run in int8, otherwise only the encoder and critic')
+    parser.add_argument('--num-eval-games', type=int, default=30,
+        help='the number of games the fp32 and int8 policies each play to compare win rates (0 to skip)')
+    args = parser.parse_args()
+    if args.output is None:
+        args.output = os.path.splitext(args.agent_model_path)[0] + ".int8.ts"
+    # fmt: on
+    return args
+
+
+def play(policy, envs, num_steps=None, num_games=None):
+    """Plays `policy` for `num_steps` steps or until `num_games` games are over; returns the
+    recorded observations and masks and the `WinLossRewardFunction` results."""
+    recorded_obs, recorded_masks, results = [], [], []
+    next_obs = torch.Tensor(envs.reset())
+    step = 0
+    while (num_steps is None or step < num_steps) and (num_games is None or len(results) < num_games):
+        masks = torch.tensor(np.array(envs.get_action_mask()))
+        if num_steps is not None:
+            recorded_obs += [next_obs]
+            recorded_masks += [masks.bool()]
+        with torch.no_grad():
+            action, _, _ = policy(next_obs, masks)
+        next_obs, _, _, infos = envs.step(action.numpy().reshape(envs.num_envs, -1))
+        next_obs = torch.Tensor(next_obs)
+        results += [info["microrts_stats"]["WinLossRewardFunction"] for info in infos if "episode" in info.keys()]
+        step += 1
+    if num_steps is None:
+        return None, None, results[:num_games]
+    return torch.cat(recorded_obs), torch.cat(recorded_masks), results
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    torch.manual_seed(args.seed)
+    np.random.seed(args.seed)
+    torch.set_num_threads(1)
+
+    envs = MicroRTSGridModeVecEnv(
+        num_selfplay_envs=0,
+        num_bot_envs=len(args.ais),
+        partial_obs=args.partial_obs,
+        max_steps=5000,
+        render_theme=2,
+        ai2s=[eval(f"microrts_ai.{ai}") for ai in args.ais],
+        map_paths=["maps/16x16/basesWorkers16x16A.xml"],
+        reward_weight=np.array([10.0, 1.0, 1.0, 4.0, 4.0, 4.0, 0.2, 0.2, 1.0]),
+    )
+    envs = MicroRTSStatsRecorder(envs)
+    envs = VecMonitor(envs)
+    h, w, _ = envs.observation_space.shape
+    nvec = envs.action_plane_space.nvec
+    agent = Agent(envs, mapsize=h * w)
+    agent.load_state_dict(torch.load(args.agent_model_path, map_location="cpu"))
+    agent.eval()
+    fp32_policy = GridnetPolicy(agent, nvec)
+    fp32_policy.eval()
+
+    # calibrate on the observations the fp32 policy actually meets in games
+    obs, masks, _ = play(fp32_policy, envs, num_steps=args.num_calibration_steps)
+    int8_policy = quantize_policy(fp32_policy, obs, masks, quantize_actor=args.quantize_actor)
+    int8_policy = torch.jit.script(int8_policy)
+    int8_policy.save(args.output)
+    print(f"quantized {args.agent_model_path} to {args.output} on {len(obs)} observations")
+
+    # action agreement of the greedy policies on the cells with a source unit
+    fp32_policy.greedy = True
+    int8_policy.greedy = True
+    with torch.no_grad():
+        fp32_action, _, fp32_value = fp32_policy(obs, masks)
+        int8_action, _, int8_value = int8_policy(obs, masks)
+    fp32_policy.greedy = False
+    int8_policy.greedy = False
+    unit_cells = masks[:, :, : nvec[0]].any(2)
+    agreement = (fp32_action == int8_action)[unit_cells]
+    print(f"action agreement: {agreement.all(1).float().mean().item():.4f} of units, per component",
+          " ".join(f"{rate:.4f}" for rate in agreement.float().mean(0).tolist()))
+    print(f"max value difference: {(fp32_value - int8_value).abs().max().item():.4f}")
+
+    # inference speed on one core
+    batch_obs, batch_masks = obs[: envs.num_envs * 8], masks[: envs.num_envs * 8]
+    for name, policy in [("fp32", fp32_policy), ("int8", int8_policy)]:
+        with torch.no_grad():
+            policy(batch_obs, batch_masks)
+            start = time.perf_counter()
+            for _ in range(10):
+                policy(batch_obs, batch_masks)
+        print(f"{name}: {(time.perf_counter() - start) / 10 * 1e3:.2f} ms per batch of {len(batch_obs)}")
+
+    if args.num_eval_games > 0:
+        for name, policy in [("fp32", fp32_policy), ("int8", int8_policy)]:
+            _, _, results = play(policy, envs, num_games=args.num_eval_games)
+            results = np.array(results)
+            print(f"{name}: win={np.mean(results == 1):.3f} tie={np.mean(results == 0):.3f} loss={np.mean(results == -1):.3f}",
+                  f"over {len(results)} games against {args.ais}")
+    envs.close()
@@ -0,0 +1,23 @@
+from statistics import NormalDist
+
+import numpy as np
+
+
+def win_rate_decided(match_stats, precision, confidence, max_games):
+    """Sequential stopping rule for a matchup with `match_stats` = [loss, tie, win].
+
+    Returns True once the Wilson interval of the score rate (a tie counts as half a
+    win) is at most `precision` wide on each side. The matchup is checked after every
+    game, so the confidence is Bonferroni-corrected over the `max_games` possible looks.
+    With few looks only one-sided matchups stop early: at `confidence=0.95` and
+    `max_games=10`, a sweep is decided after 8 games for `precision=0.25`, while no
+    matchup is decided for `precision=0.15`.
+    """
+    loss, tie, win = match_stats
+    n = loss + tie + win
+    if n == 0 or precision <= 0:
+        return False
+    p = (win + 0.5 * tie) / n
+    z = NormalDist().inv_cdf(1 - (1 - confidence) / (2 * max_games))
+    half_width = z / (1 + z ** 2 / n) * np.sqrt(p * (1 - p) / n + z ** 2 / (4 * n ** 2))
+    return half_width <= precision
@@ -0,0 +1,64 @@
+import numpy as np
+import torch
+
+
+class MaskedMultiCategorical:
+    """Masked multi-discrete distribution over the gridnet action components.
+
+    Equivalent to one masked `Categorical` per component of `nvec` (invalid logits set
+    to -1e8, invalid entries excluded from the entropy), but computed in one pass over
+    the `(batch, sum(nvec))` logits: element-wise work (masking, normalization, Gumbel
+    noise, `p * log(p)`) runs on the whole tensor, and per-component reductions run on
+    views that group consecutive components of equal size, e.g. the four 4-way
+    parameters of `[6, 4, 4, 4, 4, 7, 49]` are reduced as one `(batch, 4, 4)` view.
+
+    :param logits: `(batch, sum(nvec))` unnormalized logits
+    :param masks: `(batch, sum(nvec))` masks, non-zero for valid entries
+    :param nvec: the number of choices of each component, e.g. `envs.action_plane_space.nvec`
+    """
+
+    def __init__(self, logits, masks, nvec):
+        self.nvec = np.asarray(nvec)
+        self.masks = masks.bool()
+        self.invalid = ~self.masks
+        offsets = np.concatenate(([0], np.cumsum(self.nvec)[:-1]))
+        self.offsets = torch.as_tensor(offsets, device=logits.device)
+        # (start, num_components, num_choices) of every run of equally sized components
+        self.runs = []
+        for offset, n in zip(offsets, self.nvec):
+            if len(self.runs) > 0 and self.runs[-1][2] == n:
+                self.runs[-1][1] += 1
+            else:
+                self.runs += [[offset, 1, n]]
+
+        # a component without any valid choice stays uniform over its own choices
+        logits = logits.masked_fill(self.invalid, -1e8)
+        self.logits = torch.cat([
+            (run - run.logsumexp(-1, keepdim=True)).flatten(1) for run in self._split(logits)
+        ], 1)
+
+    def _split(self, x):
+        return [x[:, start : start + k * n].view(x.shape[0], k, n) for start, k, n in self.runs]
+
+    @property
+    def probs(self):
+        return self.logits.exp()
+
+    def sample(self):
+        """Returns `(batch, len(nvec))` actions drawn with the Gumbel-max trick."""
+        with torch.no_grad():
+            uniform = torch.rand_like(self.logits).clamp_(min=torch.finfo(self.logits.dtype).tiny, max=1.0)
+            noisy_logits = self.logits - (-uniform.log()).log()
+            return torch.cat([run.argmax(-1) for run in self._split(noisy_logits)], 1)
+
+    def log_prob(self, action):
+        """Returns the `(batch, len(nvec))` log-probabilities of `(batch, len(nvec))` actions."""
+        return self.logits.gather(1, action.long() + self.offsets)
+
+    def entropy(self):
+        """Returns the `(batch, len(nvec))` entropies, counting valid choices only."""
+        # invalid entries are zeroed before `exp`: they do not count, and exponentials of
+        # logits around -1e8 take a slow path on CPU
+        valid_logits = self.logits.masked_fill(self.invalid, 0.0)
+        p_log_p = (valid_logits * valid_logits.exp()).masked_fill(self.invalid, 0.0)
+        return -torch.cat([run.sum(-1) for run in self._split(p_log_p)], 1)
@@ -8,6 +8,9 @@ from PIL import Image
 import gym
 import gym_microrts
 from gym_microrts import microrts_ai
+from gym_microrts.envs.sharded_client import ShardedVecClient
+from gym_microrts.jvm_telemetry import jvm_telemetry
+from gym_microrts.profiling import PhaseTimers, wrap_span
 
 import jpype
 from jpype.imports import registerDomain
@@ -27,7 +30,33 @@ class MicroRTSGridModeVecEnv:
     Create a baselines VecEnv environment from a gym3 environment.
 
     :param env: gym3 environment to adapt
+    :param num_threads: the games are split over this many vec clients stepped in parallel, each
+        with an even share of the self-play pairs and of the bot envs (see `ShardedVecClient` for
+        the Java `Unit.next_ID` counter the clients share)
+    :param bot_threads: the least number of vec clients the bot envs are split over
+    :param bot_time_budget_ms: the time budget per action of the search-based bots
+        (`AIWithComputationBudget`), in milliseconds; `None` keeps the bots' own budgets
+    :param bot_iterations_budget: the iterations budget per action of the search-based bots
+    :param delta_obs: keep the encoded observations in a persistent buffer and, on every step,
+        only re-encode the cells whose raw values changed (`reset` encodes full frames); the
+        returned array is that buffer, so it is overwritten by the next step
+    :param obs_features: the observation feature groups to encode, out of `obs_feature_names`
+        (`visibility` needs `partial_obs`); `None` encodes them all
+    :param torch_outputs: return the observations as a float32 `torch.Tensor` that shares memory
+        with the buffer they are encoded into, so they need no copy or dtype conversion; the
+        tensor is overwritten by the next step
+    :param pin_memory: allocate that buffer in pinned memory, for non-blocking copies to the GPU
     """
+    # the observation feature groups, in the order of the raw observation planes
+    obs_feature_names = ["hp", "resources", "owner", "unit_type", "action", "visibility"]
+    # the methods `timers` and `profile` instrument, by phase
+    phase_methods = [
+        ("action_conversion", "_convert_actions"),
+        ("game_step", "_game_step"),
+        ("reward_conversion", "_convert_rewards"),
+        ("obs_encoding", "_encode_all_obs"),
+        ("mask_fetch", "get_action_mask"),
+    ]
 
     def __init__(self,
         num_selfplay_envs,
@@ -38,7 +67,17 @@ class MicroRTSGridModeVecEnv:
         frame_skip=0,
         ai2s=[],
         map_paths=["maps/10x10/basesTwoWorkers10x10.xml"],
-        reward_weight=np.array([0.0, 1.0, 0.0, 0.0, 0.0, 5.0])):
+        reward_weight=np.array([0.0, 1.0, 0.0, 0.0, 0.0, 5.0]),
+        timers=False,
+        profile=False,
+        num_threads=1,
+        bot_threads=1,
+        bot_time_budget_ms=None,
+        bot_iterations_budget=None,
+        delta_obs=False,
+        obs_features=None,
+        torch_outputs=False,
+        pin_memory=False):
 
         self.num_selfplay_envs = num_selfplay_envs
         self.num_bot_envs = num_bot_envs
@@ -55,6 +94,14 @@ class MicroRTSGridModeVecEnv:
         else:
             assert len(map_paths) == self.num_envs, "if multiple maps are provided, they should be provided for each environment"
         self.reward_weight = reward_weight
+        self.num_threads = num_threads
+        self.bot_threads = bot_threads
+        self.bot_time_budget_ms = bot_time_budget_ms
+        self.bot_iterations_budget = bot_iterations_budget
+        self.delta_obs = delta_obs
+        self.obs_features = obs_features
+        self.torch_outputs = torch_outputs
+        self.pin_memory = pin_memory
 
         # read map
         self.microrts_path = os.path.join(gym_microrts.__path__[0], 'microrts')
@@ -77,18 +124,19 @@ class MicroRTSGridModeVecEnv:
         # start microrts client
         from rts.units import UnitTypeTable
         self.real_utt = UnitTypeTable()
-        from ai.rewardfunction import RewardFunctionInterface, WinLossRewardFunction, ResourceGatherRewardFunction, AttackRewardFunction, ProduceWorkerRewardFunction, ProduceLightRewardFunction, ProduceHeavyRewardFunction, ProduceRangedRewardFunction, ProduceBaseRewardFunction, ProduceBarracksRewardFunction
-        self.rfs = JArray(RewardFunctionInterface)([
-            WinLossRewardFunction(), 
-            ResourceGatherRewardFunction(),  
-            ProduceWorkerRewardFunction(),
-            ProduceLightRewardFunction(),
-            ProduceHeavyRewardFunction(),
-            ProduceRangedRewardFunction(),
-            ProduceBaseRewardFunction(),
-            ProduceBarracksRewardFunction(),
-            AttackRewardFunction(),
-        ])
+        from ai.rewardfunction import WinLossRewardFunction, ResourceGatherRewardFunction, AttackRewardFunction, ProduceWorkerRewardFunction, ProduceLightRewardFunction, ProduceHeavyRewardFunction, ProduceRangedRewardFunction, ProduceBaseRewardFunction, ProduceBarracksRewardFunction
+        self.reward_function_types = [
+            WinLossRewardFunction, 
+            ResourceGatherRewardFunction,  
+            ProduceWorkerRewardFunction,
+            ProduceLightRewardFunction,
+            ProduceHeavyRewardFunction,
+            ProduceRangedRewardFunction,
+            ProduceBaseRewardFunction,
+            ProduceBarracksRewardFunction,
+            AttackRewardFunction,
+        ]
+        self.rfs = self._new_reward_functions()
         self.start_client()
 
         # computed properties
@@ -98,6 +146,15 @@ class MicroRTSGridModeVecEnv:
         self.num_planes = [5, 5, 3, len(self.utt['unitTypes'])+1, 6]
         if partial_obs:
             self.num_planes = [5, 5, 3, len(self.utt['unitTypes'])+1, 6, 2]
+        # the raw observation planes of the selected feature groups; `None` keeps them all
+        self.obs_feature_idxs = None
+        if obs_features is not None:
+            feature_names = self.obs_feature_names[:len(self.num_planes)]
+            assert len(obs_features) > 0, "at least one observation feature should be selected"
+            for feature in obs_features:
+                assert feature in feature_names, f"unknown observation feature {feature}, the features are {feature_names}"
+            self.obs_feature_idxs = [i for i, feature in enumerate(feature_names) if feature in obs_features]
+            self.num_planes = [self.num_planes[i] for i in self.obs_feature_idxs]
         self.observation_space = gym.spaces.Box(low=0.0,
             high=1.0,
             shape=(self.height, self.width,
@@ -108,29 +165,107 @@ class MicroRTSGridModeVecEnv:
         self.action_plane_space = gym.spaces.MultiDiscrete([6, 4, 4, 4, 4, len(self.utt['unitTypes']), 7 * 7])
         self.source_unit_idxs = np.stack([np.arange(0, self.height*self.width) for i in range(self.num_envs)])
         self.source_unit_idxs = self.source_unit_idxs.reshape((self.source_unit_idxs.shape + (1,)))
+
+        # the persistent buffers of the delta mode and of `torch_outputs`: the encoded observations
+        # and the raw observations they were encoded from (`None` until the next full frame)
+        self.plane_offsets = np.cumsum([0] + self.num_planes[:-1])
+        obs_shape = (self.num_envs, self.height, self.width, sum(self.num_planes))
+        if torch_outputs:
+            import torch
+            self.obs_tensor = torch.zeros(obs_shape, dtype=torch.float32)
+            if pin_memory:
+                self.obs_tensor = self.obs_tensor.pin_memory()
+            self.obs_buffer = self.obs_tensor.numpy()
+        else:
+            assert not pin_memory, "`pin_memory` needs `torch_outputs`"
+            self.obs_buffer = np.zeros(obs_shape, dtype=np.int)
+        self.raw_obs = None
+
+        # opt-in per-phase timers (see `stats`) and profiler ranges named `microrts.<phase>` (see
+        # `gym_microrts.profiling.set_span_callback`); without them the methods are left untouched
+        self.timers = PhaseTimers() if timers else None
+        for phase, method in self.phase_methods:
+            if timers:
+                setattr(self, method, self.timers.wrap(phase, getattr(self, method)))
+            if profile:
+                setattr(self, method, wrap_span(f"microrts.{phase}", getattr(self, method)))
         
     def start_client(self):
 
         from ts import JNIGridnetVecClient as Client
-        from ai.core import AI
-        self.vec_client = Client(
-            self.num_selfplay_envs,
-            self.num_bot_envs,
-            self.max_steps,
-            self.rfs,
-            os.path.expanduser(self.microrts_path),
-            self.map_paths,
-            JArray(AI)([ai2(self.real_utt) for ai2 in self.ai2s]),
-            self.real_utt,
-            self.partial_obs,
-        )
+        from ai.core import AI, AIWithComputationBudget
+        bots = [ai2(self.real_utt) for ai2 in self.ai2s]
+        for bot in bots:
+            # scripted bots have no budget to set
+            if isinstance(bot, AIWithComputationBudget):
+                if self.bot_time_budget_ms is not None:
+                    bot.setTimeBudget(int(self.bot_time_budget_ms))
+                if self.bot_iterations_budget is not None:
+                    bot.setIterationsBudget(int(self.bot_iterations_budget))
+
+        layout = self._client_layout()
+        clients = []
+        for i, (selfplay_start, selfplay_end, bot_start, bot_end) in enumerate(layout):
+            bot_map_paths = self.map_paths[self.num_selfplay_envs + bot_start : self.num_selfplay_envs + bot_end]
+            clients += [Client(
+                selfplay_end - selfplay_start,
+                bot_end - bot_start,
+                self.max_steps,
+                # the reward functions hold the rewards of the game they last computed, so the
+                # clients, stepped concurrently, cannot share them
+                self.rfs if i == 0 else self._new_reward_functions(),
+                os.path.expanduser(self.microrts_path),
+                list(self.map_paths[selfplay_start:selfplay_end]) + list(bot_map_paths),
+                JArray(AI)(bots[bot_start:bot_end]),
+                self.real_utt,
+                self.partial_obs,
+            )]
+        if len(clients) == 1:
+            self.vec_client = clients[0]
+        else:
+            self.vec_client = ShardedVecClient(clients, [
+                list(range(selfplay_start, selfplay_end)) + list(range(self.num_selfplay_envs + bot_start, self.num_selfplay_envs + bot_end))
+                for selfplay_start, selfplay_end, bot_start, bot_end in layout
+            ])
         self.render_client = self.vec_client.selfPlayClients[0] if len(self.vec_client.selfPlayClients) > 0 else self.vec_client.clients[0]
         # get the unit type table
         self.utt = json.loads(str(self.render_client.sendUTT()))
 
+    def _new_reward_functions(self):
+        from ai.rewardfunction import RewardFunctionInterface
+        return JArray(RewardFunctionInterface)([rf() for rf in self.reward_function_types])
+
+    def _client_layout(self):
+        """Returns the `(selfplay_start, selfplay_end, bot_start, bot_end)` envs of every vec client."""
+        num_clients = max(self.num_threads, self.bot_threads)
+        # the two players of a self-play game share a client
+        pair_splits = np.array_split(np.arange(self.num_selfplay_envs // 2), num_clients)
+        bot_splits = np.array_split(np.arange(self.num_bot_envs), num_clients)
+        layout = []
+        for pairs, bot_envs in zip(pair_splits, bot_splits):
+            if len(pairs) + len(bot_envs) > 0:
+                selfplay = (2 * int(pairs[0]), 2 * int(pairs[-1]) + 2) if len(pairs) > 0 else (0, 0)
+                bots = (int(bot_envs[0]), int(bot_envs[-1]) + 1) if len(bot_envs) > 0 else (0, 0)
+                layout += [selfplay + bots]
+        return layout
+
     def reset(self):
         responses = self.vec_client.reset([0 for _ in range(self.num_envs)])
-        raw_obs, reward, done, info = np.array(responses.observation), np.array(responses.reward), np.array(responses.done), {}
+        self.raw_obs = None
+        return self._encode_all_obs(responses)
+
+    def _encode_all_obs(self, responses):
+        raw_obs = np.array(responses.observation)
+        if self.obs_feature_idxs is not None:
+            raw_obs = raw_obs[:, self.obs_feature_idxs]
+        if self.torch_outputs:
+            # encodes all cells into the tensor's buffer unless in the delta mode
+            if not self.delta_obs:
+                self.raw_obs = None
+            self._patch_obs(raw_obs)
+            return self.obs_tensor
+        if self.delta_obs:
+            return self._patch_obs(raw_obs)
         obs = []
         for ro in raw_obs:
             obs += [self._encode_obs(ro)]
@@ -146,7 +281,27 @@ class MicroRTSGridModeVecEnv:
             obs_planes[np.arange(len(obs_planes)),obs[i]+sum(self.num_planes[:i])] = 1
         return obs_planes.reshape(self.height, self.width, -1)
 
+    def _patch_obs(self, raw_obs):
+        """Re-encodes the cells whose raw values changed since the last step into `obs_buffer`,
+        or all cells after a reset; the cost scales with the number of changed cells."""
+        raw_obs = raw_obs.reshape(self.num_envs, len(self.num_planes), -1).clip(0, np.array([self.num_planes]).T-1)
+        if self.raw_obs is None:
+            changed = np.ones((self.num_envs, self.height * self.width), dtype=bool)
+        else:
+            changed = (raw_obs != self.raw_obs).any(1)
+        env_idxs, cell_idxs = np.nonzero(changed)
+        obs_planes = self.obs_buffer.reshape(self.num_envs, self.height * self.width, -1)
+        obs_planes[env_idxs, cell_idxs] = 0
+        # the new values of the changed cells, shape (num_changed_cells, num_groups)
+        values = raw_obs[env_idxs, :, cell_idxs]
+        obs_planes[env_idxs[:,None], cell_idxs[:,None], values + self.plane_offsets] = 1
+        self.raw_obs = raw_obs
+        return self.obs_buffer
+
     def step_async(self, actions):
+        self.actions = self._convert_actions(actions)
+
+    def _convert_actions(self, actions):
         actions = actions.reshape((self.num_envs, self.width*self.height, -1))
         actions = np.concatenate((self.source_unit_idxs, actions), 2) # specify source unit
         actions = actions[np.where(self.source_unit_mask==1)] # valid actions
@@ -159,18 +314,20 @@ class MicroRTSGridModeVecEnv:
                 java_valid_action += [JArray(JInt)(actions[action_idx])]
                 action_idx += 1
             java_actions += [JArray(JArray(JInt))(java_valid_action)]
-        java_actions = JArray(JArray(JArray(JInt)))(java_actions)
-        
-        self.actions = java_actions
+        return JArray(JArray(JArray(JInt)))(java_actions)
 
     def step_wait(self):
-        responses = self.vec_client.gameStep(self.actions, [0 for _ in range(self.num_envs)])
-        raw_obs, reward, done = np.array(responses.observation), np.array(responses.reward), np.array(responses.done)
-        obs = []
-        for ro in raw_obs:
-            obs += [self._encode_obs(ro)]
+        responses = self._game_step()
+        reward, done = self._convert_rewards(responses)
+        obs = self._encode_all_obs(responses)
         infos = [{"raw_rewards": item} for item in reward]
-        return np.array(obs), reward @ self.reward_weight, done[:,0], infos
+        return obs, reward @ self.reward_weight, done[:,0], infos
+
+    def _game_step(self):
+        return self.vec_client.gameStep(self.actions, [0 for _ in range(self.num_envs)])
+
+    def _convert_rewards(self, responses):
+        return np.array(responses.reward), np.array(responses.done)
 
     def step(self, ac):
         self.step_async(ac)
@@ -207,6 +364,88 @@ class MicroRTSGridModeVecEnv:
         action_type_and_parameter_mask = action_mask[:,:,:,1:].reshape(self.num_envs, self.height*self.width, -1)
         return action_type_and_parameter_mask
 
+    def stats(self):
+        """Returns the count, total and percentiles of the wall time of every phase of the steps
+        (`action_conversion`, `game_step`, `reward_conversion`, `obs_encoding` and `mask_fetch`)
+        since the env was created or `reset_stats` was called; needs `timers=True`."""
+        assert self.timers is not None, "create the env with `timers=True` to time its phases"
+        return self.timers.stats()
+
+    def reset_stats(self):
+        assert self.timers is not None, "create the env with `timers=True` to time its phases"
+        self.timers.reset()
+
+    def telemetry(self):
+        """Returns the GC, heap, JIT and thread metrics of the JVM the envs run in, see
+        `gym_microrts.jvm_telemetry.jvm_telemetry`; call it from the thread that steps the env.
+        The thread CPU time includes the threads that step the shards of `num_threads > 1`."""
+        return jvm_telemetry(getattr(self.vec_client, "java_thread_ids", ()))
+
+class MicroRTSEntityVecEnv(MicroRTSGridModeVecEnv):
+    """
+    The games of `MicroRTSGridModeVecEnv` with observations and actions per unit rather than per
+    cell, so their size scales with the number of units rather than the map area.
+
+    The observation of every env is a `(max_entities, len(entity_feature_names))` array of its
+    units (resources included) in cell order, padded with zeros; `num_entities` holds the number
+    of units of every env. The features are the raw values of the observation planes, not
+    one-hot encoded. `get_action_mask` returns the `(num_envs, max_entities, 78)` masks of the
+    units, zeros for the padding, and `step` takes the `(num_envs, max_entities, 7)` actions of
+    the units, in the order of the last observation. Units beyond `max_entities` are dropped
+    and get no actions. With `torch_outputs`, the observations are int32 tensors.
+
+    :param max_entities: the number of units the observations and actions have room for
+    """
+    entity_feature_names = ["x", "y", "unit_type", "hp", "owner", "resources", "action"]
+
+    def __init__(self, *args, max_entities=128, **kwargs):
+        assert not kwargs.get("delta_obs") and kwargs.get("obs_features") is None, "`delta_obs` and `obs_features` only apply to grid observations"
+        assert not kwargs.get("pin_memory"), "`pin_memory` only applies to grid observations"
+        super().__init__(*args, **kwargs)
+        self.max_entities = max_entities
+        self.num_entities = np.zeros(self.num_envs, dtype=np.int32)
+        self.entity_cells = np.zeros((self.num_envs, max_entities), dtype=np.int64)
+        self.entity_mask = np.zeros((self.num_envs, max_entities), dtype=bool)
+        self.observation_space = gym.spaces.Box(low=0,
+            high=np.iinfo(np.int32).max,
+            shape=(max_entities, len(self.entity_feature_names)),
+            dtype=np.int32)
+        self.action_space = gym.spaces.MultiDiscrete(np.array([self.action_plane_space.nvec] * max_entities).flatten())
+
+    def _encode_all_obs(self, responses):
+        raw_obs = np.array(responses.observation).reshape(self.num_envs, -1, self.height * self.width)
+        # [0]hp, [1]resources, [2]owner, [3]unit_type, [4]action
+        occupied = raw_obs[:, 3] > 0
+        # the occupied cells first, each in cell order
+        cells = np.argsort(~occupied, axis=1, kind="stable")[:, :self.max_entities]
+        self.entity_cells[:] = 0
+        self.entity_cells[:, :cells.shape[1]] = cells
+        self.num_entities = np.minimum(occupied.sum(1), self.max_entities).astype(np.int32)
+        self.entity_mask = np.arange(self.max_entities) < self.num_entities[:, None]
+
+        entities = np.stack([
+            self.entity_cells % self.width,
+            self.entity_cells // self.width,
+        ] + [np.take_along_axis(raw_obs[:, plane], self.entity_cells, 1) for plane in [3, 0, 2, 1, 4]], -1)
+        entities[~self.entity_mask] = 0
+        if self.torch_outputs:
+            import torch
+            return torch.from_numpy(entities.astype(np.int32))
+        return entities.astype(np.int32)
+
+    def get_action_mask(self):
+        action_mask = super().get_action_mask()
+        entity_action_mask = np.take_along_axis(action_mask, self.entity_cells[:, :, None], 1)
+        entity_action_mask[~self.entity_mask] = 0
+        return entity_action_mask
+
+    def step_async(self, actions):
+        actions = actions.reshape((self.num_envs, self.max_entities, -1))
+        grid_actions = np.zeros((self.num_envs, self.height * self.width, actions.shape[-1]), dtype=actions.dtype)
+        env_idxs, entity_idxs = np.nonzero(self.entity_mask)
+        grid_actions[env_idxs, self.entity_cells[env_idxs, entity_idxs]] = actions[env_idxs, entity_idxs]
+        super().step_async(grid_actions)
+
 class MicroRTSBotVecEnv(MicroRTSGridModeVecEnv):
     metadata = {
         'render.modes': ['human', 'rgb_array'],
@@ -0,0 +1,77 @@
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import numpy as np
+from jpype.types import JArray, JInt
+
+
+class ShardedVecClient:
+    """Steps envs split over several `JNIGridnetVecClient`s concurrently, one thread per client.
+
+    It stands in for a single vec client: `reset`, `gameStep` and `getMasks` take and return the
+    envs of all shards in the env order, and `selfPlayClients` / `clients` list the game clients
+    of all shards. JPype releases the GIL while a thread runs Java code, so the shards' games (and
+    their bots) run on separate cores. Every game only depends on its own state and bots, and
+    every client has its own reward functions, so the results of an env do not depend on how
+    the envs are sharded.
+
+    The one state the shards share is the static `Unit.next_ID` counter of the Java engine, which
+    is not atomic, so concurrent unit creation can hand the same id to units of different games.
+    This is harmless for the games: a game is only ever stepped by its shard's thread, which sees
+    its own increments, so ids stay unique and increasing in creation order within a game, and
+    units are only looked up by id within their game. The id values themselves do depend on the
+    sharding, so a bot whose behaviour depends on absolute unit ids (rather than on their order)
+    can play differently than with `num_threads=1`. `java_thread_ids` holds the Java ids of the threads stepping the
+    shards, for `gym_microrts.jvm_telemetry.jvm_telemetry` to count their CPU time.
+
+    :param clients: the vec clients
+    :param env_ids: the env indices of the envs of each client, in the order of `clients`
+    """
+
+    def __init__(self, clients, env_ids):
+        self.shards = clients
+        self.env_ids = env_ids
+        # the position of every env in the concatenated outputs of the shards
+        self.order = np.argsort(np.concatenate(env_ids))
+        self.java_thread_ids = []
+        self.pool = ThreadPoolExecutor(max_workers=len(clients), initializer=self._register_thread)
+        self.selfPlayClients = [client for shard in clients for client in shard.selfPlayClients]
+        self.clients = [client for shard in clients for client in shard.clients]
+
+    def _register_thread(self):
+        from java.lang import Thread
+
+        self.java_thread_ids.append(int(Thread.currentThread().getId()))
+
+    def _map(self, fn):
+        return list(self.pool.map(fn, range(len(self.shards))))
+
+    def _concatenate(self, outputs):
+        return np.concatenate(outputs)[self.order]
+
+    def _concatenate_responses(self, responses):
+        return SimpleNamespace(
+            observation=self._concatenate([np.array(response.observation) for response in responses]),
+            reward=self._concatenate([np.array(response.reward) for response in responses]),
+            done=self._concatenate([np.array(response.done) for response in responses]),
+        )
+
+    def reset(self, players):
+        return self._concatenate_responses(
+            self._map(lambda i: self.shards[i].reset([players[env] for env in self.env_ids[i]]))
+        )
+
+    def gameStep(self, actions, players):
+        def step(i):
+            shard_actions = JArray(JArray(JArray(JInt)))([actions[env] for env in self.env_ids[i]])
+            return self.shards[i].gameStep(shard_actions, [players[env] for env in self.env_ids[i]])
+
+        return self._concatenate_responses(self._map(step))
+
+    def getMasks(self, player):
+        return self._concatenate(self._map(lambda i: np.array(self.shards[i].getMasks(player))))
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+        self.pool.shutdown()
@@ -122,6 +122,17 @@ class MicroRTSGridModeVecEnv:
         # get the unit type table
         self.utt = json.loads(str(self.render_client.sendUTT()))
 
+    def swap_ais(self, ai2s):
+        """Replace the bots of the bot environments without restarting the JVM.
+
+        The number of environments stays the same so that wrappers such as
+        `VecMonitor` keep working; call `reset()` afterwards.
+        """
+        assert self.num_bot_envs == len(ai2s), "for each environment, a microrts ai should be provided"
+        self.vec_client.close()
+        self.ai2s = ai2s
+        self.start_client()
+
     def reset(self):
         responses = self.vec_client.reset([0 for _ in range(self.num_envs)])
         raw_obs, reward, done, info = np.array(responses.observation), np.array(responses.reward), np.array(responses.done), {}
@@ -266,6 +277,18 @@ class MicroRTSBotVecEnv(MicroRTSGridModeVecEnv):
         # get the unit type table
         self.utt = json.loads(str(self.render_client.sendUTT()))
 
+    def swap_ais(self, ai1s, ai2s):
+        """Replace the bots of every environment without restarting the JVM.
+
+        The number of environments stays the same so that wrappers such as
+        `VecMonitor` keep working; call `reset()` afterwards.
+        """
+        assert len(ai1s) == len(ai2s) == self.num_envs, "for each environment, a microrts ai should be provided"
+        self.vec_client.close()
+        self.ai1s = ai1s
+        self.ai2s = ai2s
+        self.start_client()
+
     def reset(self):
         responses = self.vec_client.reset([0 for _ in range(self.num_envs)])
         raw_obs, reward, done, info = np.ones((self.num_envs,2)), np.array(responses.reward), np.array(responses.done), {}
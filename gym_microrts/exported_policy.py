@@ -0,0 +1,108 @@
+import copy
+from typing import List, Tuple
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+# files `load_policy` reads, as opposed to the `.pt` state dicts of the training scripts
+EXPORTED_POLICY_EXTENSIONS = (".ts", ".onnx")
+
+
+class GridnetPolicy(nn.Module):
+    """Inference-only copy of a gridnet `Agent` that only depends on `torch.nn`, so it can be
+    scripted or exported to ONNX and loaded without the experiment that trained it.
+
+    `forward(obs, masks)` takes `(n, h, w, c)` observations and `(n, h * w, sum(nvec))` action
+    masks and returns the `(n, h * w, len(nvec))` actions sampled from the masked policy with
+    the Gumbel-max trick (or its argmax if `greedy`), their `(n,)` log-probabilities and the
+    `(n, 1)` values.
+    """
+
+    splits: List[Tuple[int, int]]
+
+    def __init__(self, agent, nvec, greedy=False):
+        super(GridnetPolicy, self).__init__()
+        # the experiments' `Transpose` layers are replaced by the permutes of `forward`
+        self.encoder = nn.Sequential(*[layer for layer in agent.encoder if type(layer).__module__.startswith("torch.nn")])
+        self.actor = nn.Sequential(*[layer for layer in agent.actor if type(layer).__module__.startswith("torch.nn")])
+        self.critic = agent.critic
+        offsets = np.concatenate(([0], np.cumsum(nvec)))
+        self.splits = [(int(start), int(end)) for start, end in zip(offsets[:-1], offsets[1:])]
+        self.num_mask_entries = int(offsets[-1])
+        self.greedy = greedy
+
+    def forward(self, obs, masks):
+        hidden = self.encoder(obs.permute(0, 3, 1, 2))
+        logits = self.actor(hidden).permute(0, 2, 3, 1).reshape(-1, self.num_mask_entries)
+        logits = logits.masked_fill(masks.reshape(-1, self.num_mask_entries) == 0, -1e8)
+        if self.greedy:
+            noise = torch.zeros_like(logits)
+        else:
+            uniform = torch.rand_like(logits).clamp(min=1e-20, max=1.0)
+            noise = -torch.log(-torch.log(uniform))
+        actions = []
+        logprobs = []
+        for start, end in self.splits:
+            log_probs = logits[:, start:end] - torch.logsumexp(logits[:, start:end], 1, keepdim=True)
+            action = (log_probs + noise[:, start:end]).argmax(1)
+            actions.append(action)
+            logprobs.append(log_probs.gather(1, action.unsqueeze(1)).squeeze(1))
+        action = torch.stack(actions, 1).view(obs.shape[0], -1, len(self.splits))
+        logprob = torch.stack(logprobs, 1).view(obs.shape[0], -1).sum(1)
+        return action, logprob, self.critic(hidden)
+
+
+def quantize_policy(policy, calibration_obs, calibration_masks, batch_size=64, backend="fbgemm", quantize_actor=True):
+    """Post-training static int8 quantization of a `GridnetPolicy` for CPU inference.
+
+    The encoder, critic and, if `quantize_actor` and torch has a quantized `ConvTranspose2d`,
+    the actor run in int8; activation ranges are calibrated on recorded `(n, h, w, c)` observations and their
+    `(n, h * w, sum(nvec))` masks. Sampling stays in fp32. The result can be scripted and
+    loaded with `load_policy` like any exported policy.
+    """
+    torch.backends.quantized.engine = backend
+    model = copy.deepcopy(policy).cpu().eval()
+    quantize_actor = quantize_actor and hasattr(torch.nn.quantized, "ConvTranspose2d")
+    model.qconfig = torch.quantization.get_default_qconfig(backend)
+    if quantize_actor:
+        model.encoder = nn.Sequential(torch.quantization.QuantStub(), *model.encoder)
+        model.actor = nn.Sequential(*model.actor, torch.quantization.DeQuantStub())
+        model.critic = nn.Sequential(*model.critic, torch.quantization.DeQuantStub())
+        # transposed convolutions only support per-tensor weight scales
+        model.actor.qconfig = torch.quantization.default_qconfig
+    else:
+        model.encoder = nn.Sequential(torch.quantization.QuantStub(), *model.encoder, torch.quantization.DeQuantStub())
+        model.actor.qconfig = model.critic.qconfig = None
+    torch.quantization.prepare(model, inplace=True)
+    with torch.no_grad():
+        for start in range(0, len(calibration_obs), batch_size):
+            model(calibration_obs[start : start + batch_size], calibration_masks[start : start + batch_size])
+    torch.quantization.convert(model, inplace=True)
+    return model
+
+
+class OnnxPolicy:
+    """Runs a `GridnetPolicy` exported to ONNX with onnxruntime on the CPU."""
+
+    def __init__(self, path):
+        import onnxruntime
+
+        self.session = onnxruntime.InferenceSession(path, providers=["CPUExecutionProvider"])
+
+    def __call__(self, obs, masks):
+        obs = obs.cpu().numpy() if isinstance(obs, torch.Tensor) else obs
+        masks = masks.cpu().numpy() if isinstance(masks, torch.Tensor) else masks
+        outputs = self.session.run(None, {"obs": np.asarray(obs, dtype=np.float32), "masks": np.asarray(masks, dtype=bool)})
+        return tuple(torch.from_numpy(output) for output in outputs)
+
+
+def load_policy(path, device="cpu"):
+    """Loads a policy exported by `experiments/export_agent.py`: a TorchScript `.ts` file or an
+    `.onnx` file (CPU only, needs `onnxruntime`). Both are called as `policy(obs, masks)` and
+    return `(action, logprob, value)` tensors, see `GridnetPolicy`."""
+    if path.endswith(".onnx"):
+        return OnnxPolicy(path)
+    policy = torch.jit.load(path, map_location=device)
+    policy.eval()
+    return policy
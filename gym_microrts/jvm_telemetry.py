@@ -0,0 +1,55 @@
+def jvm_telemetry(thread_ids=()):
+    """Reads the JMX MBeans of the running JVM and returns flat metrics, ready to log.
+
+    All times are cumulative milliseconds since the JVM started, so their rate between two
+    calls is the share of wall time spent in GC or JIT compilation; sizes are in MB.
+
+    - `jvm/heap_used_mb`, `jvm/heap_committed_mb`, `jvm/heap_max_mb` (-1 if unbounded)
+    - `jvm/non_heap_used_mb`
+    - `jvm/gc_count`, `jvm/gc_time_ms` and `jvm/gc/<collector>/count`, `.../time_ms`
+    - `jvm/jit_time_ms` (-1 if the JVM does not report it)
+    - `jvm/thread_count`, `jvm/uptime_ms`
+    - `jvm/thread_cpu_time_ms`, the CPU time of the calling thread and of the Java threads
+      `thread_ids`: called from the thread that steps the envs, with the ids of the threads that
+      step their shards, it is the JVM work of `gameStep` (bots included), excluding waits
+    """
+    from java.lang.management import ManagementFactory
+
+    to_mb = 1.0 / (1 << 20)
+    memory = ManagementFactory.getMemoryMXBean()
+    heap = memory.getHeapMemoryUsage()
+    metrics = {
+        "jvm/heap_used_mb": int(heap.getUsed()) * to_mb,
+        "jvm/heap_committed_mb": int(heap.getCommitted()) * to_mb,
+        "jvm/heap_max_mb": int(heap.getMax()) * to_mb if int(heap.getMax()) >= 0 else -1,
+        "jvm/non_heap_used_mb": int(memory.getNonHeapMemoryUsage().getUsed()) * to_mb,
+    }
+
+    gc_count, gc_time = 0, 0
+    for gc in ManagementFactory.getGarbageCollectorMXBeans():
+        name = str(gc.getName()).replace(" ", "_")
+        # -1 when a collector does not report a value
+        count, time_ms = max(int(gc.getCollectionCount()), 0), max(int(gc.getCollectionTime()), 0)
+        metrics[f"jvm/gc/{name}/count"] = count
+        metrics[f"jvm/gc/{name}/time_ms"] = time_ms
+        gc_count += count
+        gc_time += time_ms
+    metrics["jvm/gc_count"] = gc_count
+    metrics["jvm/gc_time_ms"] = gc_time
+
+    compilation = ManagementFactory.getCompilationMXBean()
+    if compilation is not None and compilation.isCompilationTimeMonitoringSupported():
+        metrics["jvm/jit_time_ms"] = int(compilation.getTotalCompilationTime())
+    else:
+        metrics["jvm/jit_time_ms"] = -1
+
+    threads = ManagementFactory.getThreadMXBean()
+    metrics["jvm/thread_count"] = int(threads.getThreadCount())
+    if threads.isCurrentThreadCpuTimeSupported():
+        cpu_time = int(threads.getCurrentThreadCpuTime())
+        for thread_id in thread_ids:
+            # -1 once a thread has ended
+            cpu_time += max(int(threads.getThreadCpuTime(thread_id)), 0)
+        metrics["jvm/thread_cpu_time_ms"] = cpu_time / 1e6
+    metrics["jvm/uptime_ms"] = int(ManagementFactory.getRuntimeMXBean().getUptime())
+    return metrics
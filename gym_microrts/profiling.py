@@ -0,0 +1,137 @@
+import contextlib
+import os
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+_span_callback = None
+_no_span = contextlib.nullcontext()
+
+
+def set_span_callback(callback):
+    """Makes `span(name)` return `callback(name)`, a context manager around a named range.
+
+    `torch.profiler.record_function` puts the ranges of the env, the rollout buffer and
+    the agents on the timeline of a torch profiler trace; any other callable works, e.g. to
+    count calls or to feed another tracer. `None` turns the spans off again.
+    """
+    global _span_callback
+    _span_callback = callback
+
+
+def span(name):
+    """Context manager around the range `name`; does nothing without a span callback."""
+    if _span_callback is None:
+        return _no_span
+    return _span_callback(name)
+
+
+def wrap_span(name, fn):
+    """Returns `fn` run inside `span(name)`."""
+
+    def spanned(*args, **kwargs):
+        with span(name):
+            return fn(*args, **kwargs)
+
+    return spanned
+
+
+class TorchProfile:
+    """Records the torch ops and the `span` ranges into the Chrome trace `trace_path`.
+
+    Uses `torch.profiler.profile` and `torch.profiler.record_function`, or their
+    `torch.autograd.profiler` counterparts on torch versions without `torch.profiler`. `stop`
+    does nothing once the profile is stopped, so it can end the profiled updates and also run in
+    a `finally` for runs that end or fail before them.
+    """
+
+    def __init__(self, trace_path, use_cuda=False):
+        self.trace_path = trace_path
+        self.use_cuda = use_cuda
+        self.profiler = None
+
+    def start(self):
+        import torch
+
+        if hasattr(torch, "profiler"):
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if self.use_cuda:
+                activities += [torch.profiler.ProfilerActivity.CUDA]
+            self.profiler = torch.profiler.profile(activities=activities)
+            set_span_callback(torch.profiler.record_function)
+        else:
+            self.profiler = torch.autograd.profiler.profile(use_cuda=self.use_cuda)
+            set_span_callback(torch.autograd.profiler.record_function)
+        self.profiler.__enter__()
+
+    def stop(self):
+        if self.profiler is None:
+            return
+        profiler, self.profiler = self.profiler, None
+        try:
+            profiler.__exit__(None, None, None)
+        finally:
+            set_span_callback(None)
+        os.makedirs(os.path.dirname(self.trace_path) or ".", exist_ok=True)
+        profiler.export_chrome_trace(self.trace_path)
+        print(profiler.key_averages().table(sort_by="self_cpu_time_total", row_limit=30))
+        print(f"profiler trace saved to {self.trace_path}")
+
+
+class PhaseTimers:
+    """Accumulates the wall time spent in named phases of a hot path.
+
+    `wrap(name, fn)` returns `fn` timed as phase `name`. Objects swap their methods for the
+    wrapped ones when timing is enabled, so nothing is timed (and nothing is paid) otherwise.
+    Counts and totals cover every call since the last `reset`; percentiles cover the last
+    `window` calls of each phase.
+    """
+
+    def __init__(self, window=10000):
+        self.window = window
+        self.counts = OrderedDict()
+        self.totals = OrderedDict()
+        self.samples = OrderedDict()
+
+    def add_phase(self, name):
+        if name not in self.counts:
+            self.counts[name] = 0
+            self.totals[name] = 0.0
+            self.samples[name] = np.zeros(self.window)
+
+    def wrap(self, name, fn):
+        self.add_phase(name)
+        counts, totals, samples, window = self.counts, self.totals, self.samples, self.window
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                samples[name][counts[name] % window] = elapsed
+                counts[name] += 1
+                totals[name] += elapsed
+
+        return timed
+
+    def reset(self):
+        for name in self.counts:
+            self.counts[name] = 0
+            self.totals[name] = 0.0
+
+    def stats(self):
+        """Returns `{phase: {"count", "total_s", "mean_ms", "p50_ms", "p95_ms", "p99_ms"}}`."""
+        stats = OrderedDict()
+        for name, count in self.counts.items():
+            recent = self.samples[name][: min(count, self.window)] * 1e3
+            stats[name] = {
+                "count": count,
+                "total_s": self.totals[name],
+                "mean_ms": self.totals[name] / count * 1e3 if count > 0 else 0.0,
+                "p50_ms": float(np.percentile(recent, 50)) if count > 0 else 0.0,
+                "p95_ms": float(np.percentile(recent, 95)) if count > 0 else 0.0,
+                "p99_ms": float(np.percentile(recent, 99)) if count > 0 else 0.0,
+            }
+        return stats
@@ -0,0 +1,31 @@
+import numpy as np
+
+
+class RandomMaskedPolicy:
+    """Samples uniformly random valid actions for every env and cell at once with NumPy.
+
+    `policy(masks)` takes the `(num_envs, h * w, sum(nvec))` masks of `get_action_mask` and
+    returns `(num_envs, h * w, len(nvec))` actions that `step` accepts after a
+    `reshape(num_envs, -1)`. Every component picks one of its valid choices with equal
+    probability, or 0 when none is valid (the env ignores the cells without a source unit).
+    It needs no torch, which makes it a baseline for the raw SPS of the simulator and a filler
+    opponent for self-play envs.
+
+    :param nvec: the number of choices of each action component, `envs.action_plane_space.nvec`
+    :param seed: the seed of the policy's `np.random.Generator`
+    """
+
+    def __init__(self, nvec, seed=None):
+        self.nvec = np.asarray(nvec)
+        offsets = np.concatenate(([0], np.cumsum(self.nvec)))
+        self.splits = list(zip(offsets[:-1], offsets[1:]))
+        self.rng = np.random.default_rng(seed)
+
+    def __call__(self, masks):
+        masks = np.asarray(masks)
+        # the argmax of uniform noise over the valid choices is a uniform valid choice
+        scores = np.where(masks != 0, self.rng.random(masks.shape, dtype=np.float32), np.float32(-1.0))
+        actions = np.empty(masks.shape[:-1] + (len(self.nvec),), dtype=np.int32)
+        for i, (start, end) in enumerate(self.splits):
+            actions[..., i] = scores[..., start:end].argmax(-1)
+        return actions
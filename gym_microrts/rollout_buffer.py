@@ -0,0 +1,227 @@
+import queue
+import threading
+
+import numpy as np
+import torch
+from gym_microrts.profiling import span
+
+BIT_WEIGHTS = [128, 64, 32, 16, 8, 4, 2, 1]
+
+
+@torch.jit.script
+def discounted_cumsum(deltas, discounts):
+    """Returns `x` with `x[t] = deltas[t] + discounts[t] * x[t + 1]` and `x[T] = 0`."""
+    out = torch.empty_like(deltas)
+    running = torch.zeros_like(deltas[0])
+    for t in range(deltas.shape[0] - 1, -1, -1):
+        running = deltas[t] + discounts[t] * running
+        out[t] = running
+    return out
+
+
+def compute_gae(rewards, values, dones, last_value, next_done, gamma, gae_lambda=0.95, gae=True):
+    """Returns the `(advantages, returns)` of a `(num_steps, num_envs)` rollout.
+
+    `dones[t]` flags that the observation of step `t` starts a new episode, as stored by the
+    PPO scripts, so the value after step `t` is cut by `dones[t + 1]` (or `next_done` for
+    the last step). Without `gae`, the returns are the discounted rewards bootstrapped from
+    `last_value`, i.e. GAE with `gae_lambda=1`.
+    """
+    if not gae:
+        gae_lambda = 1.0
+    with span("compute_gae"):
+        next_nonterminal = 1.0 - torch.cat([dones[1:], next_done.view(1, -1)])
+        next_values = torch.cat([values[1:], last_value.view(1, -1)])
+        deltas = rewards + gamma * next_values * next_nonterminal - values
+        advantages = discounted_cumsum(deltas, gamma * gae_lambda * next_nonterminal)
+        return advantages, advantages + values
+
+
+def compute_vtrace(
+    behaviour_logprobs, target_logprobs, rewards, values, dones, last_value, next_done, gamma, rho_bar=1.0, c_bar=1.0
+):
+    """Returns the V-trace value targets and policy-gradient advantages of a `(num_steps, num_envs)`
+    rollout collected by a behaviour policy that lags the learner (Espeholt et al., 2018).
+
+    Same `dones` convention as `compute_gae`; with `target_logprobs == behaviour_logprobs`, the
+    targets are the `gae_lambda=1` returns.
+    """
+    with span("compute_vtrace"):
+        rhos = (target_logprobs - behaviour_logprobs).exp()
+        clipped_rhos = rhos.clamp(max=rho_bar)
+        cs = rhos.clamp(max=c_bar)
+        next_nonterminal = 1.0 - torch.cat([dones[1:], next_done.view(1, -1)])
+        next_values = torch.cat([values[1:], last_value.view(1, -1)])
+        deltas = clipped_rhos * (rewards + gamma * next_values * next_nonterminal - values)
+        vs = values + discounted_cumsum(deltas, gamma * cs * next_nonterminal)
+        next_vs = torch.cat([vs[1:], last_value.view(1, -1)])
+        pg_advantages = clipped_rhos * (rewards + gamma * next_vs * next_nonterminal - values)
+        return vs, pg_advantages
+
+
+def pack_bits(x):
+    """Packs the last dimension of a 0/1 tensor into `uint8`, eight entries per byte."""
+    n = x.shape[-1]
+    x = x.to(torch.uint8)
+    if n % 8 != 0:
+        x = torch.cat([x, x.new_zeros(x.shape[:-1] + (8 - n % 8,))], -1)
+    weights = torch.tensor(BIT_WEIGHTS, dtype=torch.uint8, device=x.device)
+    return (x.view(x.shape[:-1] + (x.shape[-1] // 8, 8)) * weights).sum(-1, dtype=torch.uint8)
+
+
+def unpack_bits(x, n):
+    """Inverse of `pack_bits`: returns the first `n` entries of the last dimension as `bool`."""
+    weights = torch.tensor(BIT_WEIGHTS, dtype=torch.uint8, device=x.device)
+    bits = (x.unsqueeze(-1) // weights) % 2
+    return bits.view(x.shape[:-1] + (x.shape[-1] * 8,))[..., :n].bool()
+
+
+class RolloutBuffer:
+    """Rollout storage of the gridnet PPO scripts in compact dtypes.
+
+    Observations (one-hot planes) and action masks are bit-packed and actions are stored as
+    `int8`; `minibatch` converts the selected samples back to the float observations, `bool`
+    masks and `long` actions the agent consumes. Log-probabilities, rewards, dones and values
+    stay `(num_steps, num_envs)` float tensors that the scripts index directly.
+
+    With `sparse=True`, actions and masks are only stored for the source-unit cells passed to
+    `add` (see `Agent.get_sparse_action_and_value`), sample after sample, so every sample owns
+    a contiguous range of unit rows.
+
+    :param obs_shape: the `(h, w, c)` observation shape
+    :param nvec: the number of choices of each action component of a cell
+    :param storage_device: where the compact tensors live, `device` by default; keep them on the
+        CPU to gather minibatches there with `prefetch_minibatches`
+    """
+
+    def __init__(self, num_steps, num_envs, obs_shape, nvec, device=None, sparse=False, storage_device=None):
+        self.num_steps = num_steps
+        self.num_envs = num_envs
+        self.obs_shape = tuple(obs_shape)
+        self.nvec = np.asarray(nvec)
+        self.mapsize = self.obs_shape[0] * self.obs_shape[1]
+        self.device = device
+        self.storage_device = device if storage_device is None else storage_device
+        self.sparse = sparse
+        self.num_mask_bytes = -(-int(self.nvec.sum()) // 8)
+
+        step_shape = (num_steps, num_envs)
+        self.obs = torch.zeros(step_shape + self.obs_shape[:-1] + (-(-self.obs_shape[-1] // 8),), dtype=torch.uint8, device=self.storage_device)
+        self.logprobs = torch.zeros(step_shape, device=device)
+        self.rewards = torch.zeros(step_shape, device=device)
+        self.dones = torch.zeros(step_shape, device=device)
+        self.values = torch.zeros(step_shape, device=device)
+        if sparse:
+            self.reset()
+        else:
+            self.actions = torch.zeros(step_shape + (self.mapsize, len(self.nvec)), dtype=torch.int8, device=self.storage_device)
+            self.masks = torch.zeros(step_shape + (self.mapsize, self.num_mask_bytes), dtype=torch.uint8, device=self.storage_device)
+
+    def reset(self):
+        """Drops the unit rows of the previous rollout; only needed with `sparse=True`."""
+        if self.sparse:
+            self.unit_idxs, self.unit_actions, self.unit_masks = [], [], []
+            self.unit_starts = self.unit_counts = None
+
+    def add(self, step, obs, done, value, logprob, actions, masks, unit_idxs=None):
+        """Stores the samples of `step`.
+
+        :param obs: the `(num_envs, h, w, c)` observations
+        :param actions: the `(num_envs, mapsize, len(nvec))` actions, or the `(num_units, len(nvec))`
+            actions of the cells `unit_idxs` if `sparse`
+        :param masks: the action masks, shaped like `actions` with `sum(nvec)` entries per cell
+        :param unit_idxs: with `sparse`, the flat indices of the units' cells into the
+            `num_envs * mapsize` cells of the step
+        """
+        with span("rollout_buffer.add"):
+            self.obs[step] = pack_bits(obs)
+            self.dones[step] = done
+            self.values[step] = value
+            self.logprobs[step] = logprob
+            if self.sparse:
+                self.unit_idxs += [unit_idxs.to(self.storage_device) + step * self.num_envs * self.mapsize]
+                self.unit_actions += [actions.to(self.storage_device, torch.int8)]
+                self.unit_masks += [pack_bits(masks).to(self.storage_device)]
+            else:
+                self.actions[step] = actions.view(self.actions.shape[1:])
+                self.masks[step] = pack_bits(masks).view(self.masks.shape[1:])
+
+    def finish(self):
+        """Indexes the unit rows of a full rollout; call it before `minibatch` with `sparse=True`."""
+        if self.sparse:
+            self.unit_idxs = torch.cat(self.unit_idxs)
+            self.unit_actions = torch.cat(self.unit_actions)
+            self.unit_masks = torch.cat(self.unit_masks)
+            self.unit_counts = torch.bincount(self.unit_idxs // self.mapsize, minlength=self.num_steps * self.num_envs)
+            self.unit_starts = torch.cumsum(self.unit_counts, 0) - self.unit_counts
+
+    def minibatch(self, minibatch_ind):
+        """Returns the float observations, `long` actions and `bool` masks of the samples
+        `minibatch_ind` (indices into the flattened `num_steps * num_envs` samples), plus the
+        units' flat cell indices into the minibatch's `len(minibatch_ind) * mapsize` cells if
+        `sparse`, or `None`. The tensors are on `storage_device`."""
+        with span("rollout_buffer.minibatch"):
+            minibatch_ind = torch.as_tensor(minibatch_ind, device=self.obs.device)
+            obs = unpack_bits(self.obs.view((-1,) + self.obs.shape[2:])[minibatch_ind], self.obs_shape[-1]).float()
+            num_mask_entries = int(self.nvec.sum())
+            if not self.sparse:
+                actions = self.actions.view((-1,) + self.actions.shape[2:])[minibatch_ind].long()
+                masks = unpack_bits(self.masks.view((-1,) + self.masks.shape[2:])[minibatch_ind], num_mask_entries)
+                return obs, actions, masks, None
+            counts = self.unit_counts[minibatch_ind]
+            minibatch_starts = torch.cumsum(counts, 0) - counts
+            offsets = torch.arange(int(counts.sum()), device=counts.device) - torch.repeat_interleave(minibatch_starts, counts)
+            rows = torch.repeat_interleave(self.unit_starts[minibatch_ind], counts) + offsets
+            minibatch_envs = torch.repeat_interleave(torch.arange(len(minibatch_ind), device=counts.device), counts)
+            unit_idxs = minibatch_envs * self.mapsize + self.unit_idxs[rows] % self.mapsize
+            return obs, self.unit_actions[rows].long(), unpack_bits(self.unit_masks[rows], num_mask_entries), unit_idxs
+
+
+def prefetch_minibatches(rollouts, minibatch_inds, device=None, num_prefetch=2):
+    """Yields `rollouts.minibatch(minibatch_ind)` for every index array of `minibatch_inds`
+    while a background thread gathers and unpacks the next `num_prefetch` ones.
+
+    With a CUDA `device`, the minibatches are gathered on `rollouts.storage_device`, pinned
+    and copied asynchronously, so the learner does not wait on memory-bound gathers.
+    """
+    device = torch.device(device) if device is not None else None
+    minibatches = queue.Queue(maxsize=num_prefetch)
+    stop = threading.Event()
+
+    def to_device(x):
+        if x is None or device is None or x.device == device:
+            return x
+        if device.type == "cuda" and x.device.type == "cpu":
+            return x.pin_memory().to(device, non_blocking=True)
+        return x.to(device)
+
+    def put(item):
+        # gives up once the consumer stopped, so an abandoned queue never blocks the thread
+        while not stop.is_set():
+            try:
+                minibatches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def gather():
+        try:
+            for minibatch_ind in minibatch_inds:
+                minibatch = tuple(to_device(x) for x in rollouts.minibatch(minibatch_ind))
+                if not put((minibatch, None)):
+                    return
+        except Exception as e:
+            put((None, e))
+
+    thread = threading.Thread(target=gather, daemon=True)
+    thread.start()
+    try:
+        for _ in range(len(minibatch_inds)):
+            minibatch, error = minibatches.get()
+            if error is not None:
+                raise error
+            yield minibatch
+    finally:
+        stop.set()
+        thread.join()
@@ -0,0 +1,67 @@
+import torch
+from gym_microrts.rollout_buffer import compute_gae
+
+# reference: the step-by-step loops of the PPO scripts
+def reference(rewards, values, dones, last_value, next_done, gamma, gae_lambda, gae):
+    num_steps = len(rewards)
+    if gae:
+        advantages = torch.zeros_like(rewards)
+        lastgaelam = 0
+        for t in reversed(range(num_steps)):
+            if t == num_steps - 1:
+                nextnonterminal = 1.0 - next_done
+                nextvalues = last_value
+            else:
+                nextnonterminal = 1.0 - dones[t + 1]
+                nextvalues = values[t + 1]
+            delta = rewards[t] + gamma * nextvalues * nextnonterminal - values[t]
+            advantages[t] = lastgaelam = delta + gamma * gae_lambda * nextnonterminal * lastgaelam
+        returns = advantages + values
+    else:
+        returns = torch.zeros_like(rewards)
+        for t in reversed(range(num_steps)):
+            if t == num_steps - 1:
+                nextnonterminal = 1.0 - next_done
+                next_return = last_value
+            else:
+                nextnonterminal = 1.0 - dones[t + 1]
+                next_return = returns[t + 1]
+            returns[t] = rewards[t] + gamma * nextnonterminal * next_return
+        advantages = returns - values
+    return advantages, returns
+
+torch.manual_seed(0)
+num_steps, num_envs = 64, 8
+rewards = torch.randn(num_steps, num_envs)
+values = torch.randn(num_steps, num_envs)
+dones = (torch.rand(num_steps, num_envs) < 0.05).float()
+last_value = torch.randn(1, num_envs)
+next_done = torch.tensor([1.0, 0, 0, 0, 1, 0, 0, 0])
+
+for gae in [True, False]:
+    advantages, returns = compute_gae(rewards, values, dones, last_value, next_done, 0.99, 0.95, gae)
+    expected_advantages, expected_returns = reference(rewards, values, dones, last_value, next_done, 0.99, 0.95, gae)
+    assert torch.allclose(advantages, expected_advantages, atol=1e-4)
+    assert torch.allclose(returns, expected_returns, atol=1e-4)
+
+# nothing leaks across an episode boundary: the step before a done only sees its own reward
+advantages, returns = compute_gae(
+    torch.ones(3, 1), torch.zeros(3, 1), torch.tensor([[0.0], [0.0], [1.0]]), torch.full((1, 1), 100.0),
+    torch.zeros(1), 0.5, 1.0
+)
+assert torch.allclose(returns.flatten(), torch.tensor([1.5, 1.0, 51.0]))
+
+# on-policy V-trace targets are the lambda=1 returns, and off-policy corrections are clipped
+from gym_microrts.rollout_buffer import compute_vtrace
+
+logprobs = torch.randn(num_steps, num_envs)
+vs, pg_advantages = compute_vtrace(logprobs, logprobs, rewards, values, dones, last_value, next_done, 0.99)
+_, expected_returns = reference(rewards, values, dones, last_value, next_done, 0.99, 1.0, False)
+assert torch.allclose(vs, expected_returns, atol=1e-4)
+next_vs = torch.cat([vs[1:], last_value])
+next_nonterminal = 1.0 - torch.cat([dones[1:], next_done.view(1, -1)])
+assert torch.allclose(pg_advantages, rewards + 0.99 * next_vs * next_nonterminal - values, atol=1e-4)
+vs, pg_advantages = compute_vtrace(logprobs, logprobs + 5.0, rewards, values, dones, last_value, next_done, 0.99)
+assert torch.allclose(vs, expected_returns, atol=1e-4)
+vs, pg_advantages = compute_vtrace(logprobs, logprobs - 1e3, rewards, values, dones, last_value, next_done, 0.99)
+assert torch.allclose(vs, values) and torch.allclose(pg_advantages, torch.zeros_like(pg_advantages))
@@ -0,0 +1,33 @@
+import numpy as np
+from gym_microrts import microrts_ai
+from gym_microrts.envs.new_vec_env import MicroRTSGridModeVecEnv
+from gym_microrts.random_policy import RandomMaskedPolicy
+
+# the same games with observations encoded in full and patched with the changed cells must match,
+# including across the games that end and restart
+ais = [microrts_ai.workerRushAI, microrts_ai.lightRushAI]
+envs = [
+    MicroRTSGridModeVecEnv(
+        num_selfplay_envs=2,
+        num_bot_envs=len(ais),
+        partial_obs=partial_obs,
+        max_steps=200,
+        ai2s=ais,
+        map_paths=["maps/16x16/basesWorkers16x16.xml"],
+        reward_weight=np.array([10.0, 1.0, 1.0, 0.2, 1.0, 4.0, 0.0, 0.0, 0.0]),
+        delta_obs=delta_obs,
+    )
+    for partial_obs in [False, True]
+    for delta_obs in [False, True]
+]
+policies = [RandomMaskedPolicy(env.action_plane_space.nvec, seed=0) for env in envs]
+obs = [env.reset() for env in envs]
+assert (obs[0] == obs[1]).all() and (obs[2] == obs[3]).all()
+for step in range(500):
+    masks = [env.get_action_mask() for env in envs]
+    obs = [env.step(policy(mask).reshape(env.num_envs, -1))[0] for env, policy, mask in zip(envs, policies, masks)]
+    assert (obs[0] == obs[1]).all() and (obs[2] == obs[3]).all()
+    if step == 250:
+        obs = [env.reset() for env in envs]
+        assert (obs[0] == obs[1]).all() and (obs[2] == obs[3]).all()
+envs[0].close()
@@ -0,0 +1,37 @@
+import numpy as np
+from gym_microrts import microrts_ai
+from gym_microrts.envs.new_vec_env import MicroRTSEntityVecEnv, MicroRTSGridModeVecEnv
+from gym_microrts.random_policy import RandomMaskedPolicy
+
+# the same games played with unit actions and with those actions put on the units' cells must
+# match, and the units must be the occupied cells of the grid observations
+kwargs = dict(
+    num_selfplay_envs=2,
+    num_bot_envs=1,
+    max_steps=2000,
+    ai2s=[microrts_ai.workerRushAI],
+    map_paths=["maps/16x16/basesWorkers16x16.xml"],
+    reward_weight=np.array([10.0, 1.0, 1.0, 0.2, 1.0, 4.0, 0.0, 0.0, 0.0]),
+)
+grid_envs = MicroRTSGridModeVecEnv(**kwargs)
+entity_envs = MicroRTSEntityVecEnv(max_entities=64, **kwargs)
+policy = RandomMaskedPolicy(entity_envs.action_plane_space.nvec, seed=0)
+hw = grid_envs.height * grid_envs.width
+unit_type_planes = slice(sum(grid_envs.num_planes[:3]), sum(grid_envs.num_planes[:4]))
+grid_obs, entity_obs = grid_envs.reset(), entity_envs.reset()
+for _ in range(300):
+    grid_masks, entity_masks = grid_envs.get_action_mask(), entity_envs.get_action_mask()
+    grid_actions = np.zeros((grid_envs.num_envs, hw, 7), dtype=np.int32)
+    entity_actions = policy(entity_masks)
+    for env in range(grid_envs.num_envs):
+        num_entities = entity_envs.num_entities[env]
+        cells = entity_obs[env, :num_entities, 1] * grid_envs.width + entity_obs[env, :num_entities, 0]
+        occupied = grid_obs[env].reshape(hw, -1)[:, unit_type_planes].argmax(1) > 0
+        assert (cells == np.nonzero(occupied)[0]).all()
+        assert (entity_masks[env, :num_entities] == grid_masks[env, cells]).all()
+        assert not entity_masks[env, num_entities:].any() and not entity_obs[env, num_entities:].any()
+        grid_actions[env, cells] = entity_actions[env, :num_entities]
+    grid_obs, grid_rewards, grid_dones, _ = grid_envs.step(grid_actions.reshape(grid_envs.num_envs, -1))
+    entity_obs, entity_rewards, entity_dones, _ = entity_envs.step(entity_actions.reshape(entity_envs.num_envs, -1))
+    assert (grid_rewards == entity_rewards).all() and (grid_dones == entity_dones).all()
+grid_envs.close()
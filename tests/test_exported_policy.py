@@ -0,0 +1,67 @@
+import os
+import tempfile
+
+import numpy as np
+import torch
+import torch.nn as nn
+from gym_microrts.exported_policy import GridnetPolicy, load_policy
+
+# a small agent laid out like the experiments' gridnet `Agent`, with its own `Transpose`
+class Transpose(nn.Module):
+    def __init__(self, permutation):
+        super().__init__()
+        self.permutation = permutation
+
+    def forward(self, x):
+        return x.permute(self.permutation)
+
+torch.manual_seed(0)
+nvec = np.array([6, 4, 4, 4, 4, 7, 49])
+agent = nn.Module()
+agent.encoder = nn.Sequential(Transpose((0, 3, 1, 2)), nn.Conv2d(27, 8, 3, padding=1), nn.MaxPool2d(3, stride=2, padding=1), nn.ReLU())
+agent.actor = nn.Sequential(nn.ConvTranspose2d(8, int(nvec.sum()), 3, stride=2, padding=1, output_padding=1), Transpose((0, 2, 3, 1)))
+agent.critic = nn.Sequential(nn.AdaptiveAvgPool2d(1), nn.Flatten(), nn.Linear(8, 1))
+
+obs = (torch.rand(5, 8, 8, 27) > 0.8).float()
+masks = torch.rand(5, 64, nvec.sum()) > 0.5
+logits = agent.actor(agent.encoder(obs)).reshape(-1, nvec.sum())
+expected_value = agent.critic(agent.encoder(obs))
+split_logits = torch.split(logits.masked_fill(~masks.view(-1, nvec.sum()), -1e8), nvec.tolist(), 1)
+split_masks = torch.split(masks.view(-1, nvec.sum()), nvec.tolist(), 1)
+
+with tempfile.TemporaryDirectory() as directory:
+    path = os.path.join(directory, "agent.ts")
+    torch.jit.script(GridnetPolicy(agent, nvec, greedy=True)).save(path)
+    action, logprob, value = load_policy(path)(obs, masks)
+    # greedy actions are the most likely valid choices, with their log-probabilities
+    # normalized as `Categorical` does
+    expected_action = torch.stack([l.argmax(1) for l in split_logits], 1).view(5, 64, len(nvec))
+    expected_logprob = sum(
+        (l - l.logsumexp(1, keepdim=True)).gather(1, a.unsqueeze(1)).squeeze(1)
+        for (l, a) in zip(split_logits, expected_action.view(-1, len(nvec)).T)
+    )
+    assert (action == expected_action).all()
+    assert torch.allclose(logprob, expected_logprob.view(5, 64).sum(1), atol=1e-4)
+    assert torch.allclose(value, expected_value, atol=1e-6)
+
+    torch.jit.script(GridnetPolicy(agent, nvec)).save(path)
+    action, _, _ = load_policy(path)(obs, masks)
+    # sampled actions are valid wherever a valid choice exists
+    for (m, a) in zip(split_masks, action.view(-1, len(nvec)).T):
+        assert (m.gather(1, a.unsqueeze(1)).squeeze(1) | ~m.any(1)).all()
+
+# the int8 policy keeps the fp32 policy's greedy actions on most cells and stays scriptable
+from gym_microrts.exported_policy import quantize_policy
+
+calibration_obs = (torch.rand(64, 8, 8, 27) > 0.8).float()
+calibration_masks = torch.rand(64, 64, nvec.sum()) > 0.5
+fp32_policy = GridnetPolicy(agent, nvec, greedy=True)
+int8_policy = quantize_policy(fp32_policy, calibration_obs, calibration_masks)
+with tempfile.TemporaryDirectory() as directory:
+    path = os.path.join(directory, "agent.int8.ts")
+    torch.jit.script(int8_policy).save(path)
+    action, _, value = load_policy(path)(obs, masks)
+with torch.no_grad():
+    expected_action, _, expected_value = fp32_policy(obs, masks)
+assert (action == expected_action).all(2).float().mean() > 0.8
+assert torch.allclose(value, expected_value, atol=0.1)
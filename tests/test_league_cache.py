@@ -0,0 +1,44 @@
+import os
+import random
+import sys
+import tempfile
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "experiments"))
+from league_ratings import LeagueRatings
+from match_cache import MatchCache
+
+# a league run records the games of its jobs as they finish; rebuilding its ratings from the
+# cache must reproduce the same leaderboard and match histories
+random.seed(0)
+ais = ["workerRushAI", "lightRushAI", "coacAI", "agent.pt"]
+settings = ("maps/16x16/basesWorkers16x16.xml", 5000, False)
+match_ups = [(p0, p1) for p0 in ais[:3] for p1 in ais[:3] if p0 != p1] + [("agent.pt", p1) for p1 in ais[:3]]
+match_up_games = {match_up: 5 if match_up[0] != "agent.pt" else 10 for match_up in match_ups}
+
+with tempfile.TemporaryDirectory() as tmp:
+    cache = MatchCache(os.path.join(tmp, "cache.sqlite"))
+    live = LeagueRatings(ais)
+    remaining_games = dict(match_up_games)
+    while sum(remaining_games.values()) > 0:
+        # jobs of a few games of a few matchups, finishing in any order
+        pending = [match_up for match_up in remaining_games if remaining_games[match_up] > 0]
+        job = random.sample(pending, min(len(pending), random.randint(1, 2)))
+        for p0, p1 in job:
+            results = [random.choice([-1.0, 0.0, 1.0]) for _ in range(min(3, remaining_games[(p0, p1)]))]
+            remaining_games[(p0, p1)] -= len(results)
+            cache.add(p0, p1, *settings, results)
+            for item in results:
+                live.record(p0, p1, item)
+
+    rebuilt = LeagueRatings(ais)
+    cached_games = []
+    for (p0, p1), num_games in match_up_games.items():
+        cached = cache.games(p0, p1, *settings, num_matches=num_games)
+        assert len(cached) == num_games
+        cached_games += [(order, p0, p1, item) for order, item in cached]
+    rebuilt.replay(cached_games)
+    cache.close()
+
+for ai in ais:
+    assert (rebuilt.ratings[ai].mu, rebuilt.ratings[ai].sigma) == (live.ratings[ai].mu, live.ratings[ai].sigma)
+assert rebuilt.match_historys == live.match_historys
@@ -0,0 +1,50 @@
+import torch
+import numpy as np
+from torch.distributions.categorical import Categorical
+from gym_microrts.distributions import MaskedMultiCategorical
+
+# reference: one masked categorical per action component, as in `experiments/new_ppo_gridnet.py`
+class CategoricalMasked(Categorical):
+
+    def __init__(self, probs=None, logits=None, validate_args=None, masks=[]):
+        self.masks = masks.bool()
+        logits = torch.where(self.masks, logits, torch.tensor(-1e+8))
+        super(CategoricalMasked, self).__init__(probs, logits, validate_args)
+
+    def entropy(self):
+        p_log_p = self.logits * self.probs
+        p_log_p = torch.where(self.masks, p_log_p, torch.tensor(0.))
+        return -p_log_p.sum(-1)
+
+torch.manual_seed(0)
+nvec = np.array([6, 4, 4, 4, 4, 7, 49])
+logits = torch.randn(512, nvec.sum(), requires_grad=True)
+masks = torch.rand(512, nvec.sum()) > 0.5
+masks[0] = False # a row without any valid choice
+
+split_logits = torch.split(logits, nvec.tolist(), dim=1)
+split_masks = torch.split(masks, nvec.tolist(), dim=1)
+categoricals = [CategoricalMasked(logits=l, masks=m) for (l, m) in zip(split_logits, split_masks)]
+mmc = MaskedMultiCategorical(logits, masks, nvec)
+
+# sampled actions are valid whenever a valid choice exists, and inside the component otherwise
+action = mmc.sample()
+assert action.shape == (512, len(nvec))
+assert (action < torch.tensor(nvec)).all()
+split_valid = torch.stack([m.gather(1, a.unsqueeze(1)).squeeze(1) for (m, a) in zip(split_masks, action.T)]).T
+has_valid = torch.stack([m.any(1) for m in split_masks]).T
+assert (split_valid | ~has_valid).all()
+
+# log-probabilities and entropies match the per-component distributions
+expected_logprob = torch.stack([c.log_prob(a) for (c, a) in zip(categoricals, action.T)]).T
+expected_entropy = torch.stack([c.entropy() for c in categoricals]).T
+assert torch.allclose(mmc.log_prob(action), expected_logprob, atol=1e-4)
+assert torch.allclose(mmc.entropy(), expected_entropy, atol=1e-4)
+
+# gradients are finite and match the reference
+(mmc.log_prob(action).sum() + mmc.entropy().sum()).backward()
+grad = logits.grad.clone()
+logits.grad = None
+(expected_logprob.sum() + expected_entropy.sum()).backward()
+assert torch.isfinite(grad).all()
+assert torch.allclose(grad, logits.grad, atol=1e-4)
@@ -0,0 +1,24 @@
+import numpy as np
+from gym_microrts.envs.new_vec_env import MicroRTSGridModeVecEnv
+
+# the observations of selected feature groups must be the planes of those groups in the full
+# observations
+features = ["owner", "unit_type", "visibility"]
+envs = [
+    MicroRTSGridModeVecEnv(
+        num_selfplay_envs=2,
+        num_bot_envs=0,
+        partial_obs=True,
+        max_steps=2000,
+        map_paths=["maps/16x16/basesWorkers16x16.xml"],
+        reward_weight=np.array([10.0, 1.0, 1.0, 0.2, 1.0, 4.0, 0.0, 0.0, 0.0]),
+        obs_features=obs_features,
+    )
+    for obs_features in [None, features]
+]
+assert envs[1].observation_space.shape[-1] == sum(envs[1].num_planes) == 3 + len(envs[1].utt['unitTypes']) + 1 + 2
+offsets = np.cumsum([0] + envs[0].num_planes)
+idxs = [envs[0].obs_feature_names.index(feature) for feature in features]
+obs = [env.reset() for env in envs]
+assert (np.concatenate([obs[0][..., offsets[i]:offsets[i + 1]] for i in idxs], -1) == obs[1]).all()
+envs[0].close()
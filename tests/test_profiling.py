@@ -0,0 +1,62 @@
+import contextlib
+import os
+import tempfile
+import time
+import torch
+import gym_microrts.profiling as profiling
+from gym_microrts.profiling import PhaseTimers, TorchProfile, set_span_callback, span, wrap_span
+
+timers = PhaseTimers(window=4)
+sleep = timers.wrap("sleep", time.sleep)
+add = timers.wrap("add", lambda a, b=0: a + b)
+
+# wrapped functions return what the originals return
+assert add(1, b=2) == 3
+for _ in range(6):
+    sleep(0.001)
+
+stats = timers.stats()
+assert list(stats) == ["sleep", "add"]
+assert stats["sleep"]["count"] == 6 and stats["add"]["count"] == 1
+assert stats["sleep"]["total_s"] >= 0.006
+assert 1.0 <= stats["sleep"]["p50_ms"] <= stats["sleep"]["p95_ms"] <= stats["sleep"]["p99_ms"]
+
+# calls that raise are still timed
+fail = timers.wrap("fail", lambda: 1 / 0)
+try:
+    fail()
+except ZeroDivisionError:
+    pass
+assert timers.stats()["fail"]["count"] == 1
+
+timers.reset()
+assert all(phase["count"] == 0 and phase["total_s"] == 0.0 for phase in timers.stats().values())
+
+# spans do nothing without a callback and call it with their names otherwise
+names = []
+
+@contextlib.contextmanager
+def record(name):
+    names.append(name)
+    yield
+
+with span("off"):
+    pass
+set_span_callback(record)
+with span("on"):
+    pass
+assert wrap_span("wrapped", lambda x: x + 1)(1) == 2
+set_span_callback(None)
+assert names == ["on", "wrapped"]
+
+# the torch profile puts the spans in its trace, turns them off again and only stops once
+trace_path = os.path.join(tempfile.mkdtemp(), "run", "trace.json")
+profile = TorchProfile(trace_path)
+profile.start()
+with span("agent.forward"):
+    torch.ones(4).sum()
+profile.stop()
+profile.stop()
+assert profiling._span_callback is None
+with open(trace_path) as f:
+    assert "agent.forward" in f.read()
@@ -0,0 +1,30 @@
+import numpy as np
+from gym_microrts.random_policy import RandomMaskedPolicy
+
+nvec = np.array([6, 4, 4, 4, 4, 7, 49])
+offsets = np.concatenate(([0], np.cumsum(nvec)))
+rng = np.random.default_rng(0)
+masks = (rng.random((4, 256, nvec.sum())) > 0.5).astype(np.int32)
+masks[0, 0] = 0 # a cell without any valid choice
+
+policy = RandomMaskedPolicy(nvec, seed=0)
+actions = policy(masks)
+assert actions.shape == (4, 256, len(nvec))
+assert (actions >= 0).all() and (actions < nvec).all()
+assert (actions[0, 0] == 0).all()
+
+# every sampled choice is valid whenever the component has a valid choice
+for i in range(len(nvec)):
+    component = masks[..., offsets[i]:offsets[i + 1]]
+    chosen = np.take_along_axis(component, actions[..., i:i + 1], -1)[..., 0]
+    assert (chosen == 1)[component.any(-1)].all()
+
+# the valid choices are picked uniformly
+masks = np.zeros((1, 20000, nvec.sum()), dtype=np.int32)
+masks[..., [1, 3, 4]] = 1
+counts = np.bincount(policy(masks)[0, :, 0], minlength=6)
+assert (counts[[0, 2, 5]] == 0).all()
+assert np.allclose(counts[[1, 3, 4]] / 20000, 1 / 3, atol=0.02)
+
+# the same seed samples the same actions
+assert (RandomMaskedPolicy(nvec, seed=1)(masks) == RandomMaskedPolicy(nvec, seed=1)(masks)).all()
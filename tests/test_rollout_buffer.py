@@ -0,0 +1,82 @@
+import time
+import torch
+import numpy as np
+from gym_microrts.rollout_buffer import RolloutBuffer, pack_bits, unpack_bits, prefetch_minibatches
+
+torch.manual_seed(0)
+nvec = np.array([6, 4, 4, 4, 4, 7, 49])
+num_steps, num_envs, obs_shape = 4, 3, (8, 8, 27)
+mapsize = 8 * 8
+
+# bit-packing round-trips any number of entries
+for n in [1, 8, 27, 78]:
+    x = torch.rand(5, 6, n) > 0.5
+    assert pack_bits(x).shape == (5, 6, -(-n // 8))
+    assert (unpack_bits(pack_bits(x), n) == x).all()
+
+obs = (torch.rand((num_steps, num_envs) + obs_shape) > 0.5).float()
+masks = torch.rand(num_steps, num_envs, mapsize, nvec.sum()) > 0.5
+actions = torch.stack([torch.randint(0, n, (num_steps, num_envs, mapsize)) for n in nvec], -1)
+minibatch_ind = np.array([7, 0, 11, 3, 5])
+
+# dense storage returns the minibatch as stored
+rollouts = RolloutBuffer(num_steps, num_envs, obs_shape, nvec)
+for step in range(num_steps):
+    rollouts.add(step, obs[step], torch.zeros(num_envs), torch.zeros(num_envs), torch.zeros(num_envs), actions[step], masks[step])
+rollouts.finish()
+mb_obs, mb_actions, mb_masks, mb_unit_idxs = rollouts.minibatch(minibatch_ind)
+assert mb_obs.dtype == torch.float32 and (mb_obs == obs.view((-1,) + obs_shape)[minibatch_ind]).all()
+assert mb_actions.dtype == torch.long and (mb_actions == actions.view(-1, mapsize, len(nvec))[minibatch_ind]).all()
+assert (mb_masks == masks.view(-1, mapsize, nvec.sum())[minibatch_ind]).all()
+assert mb_unit_idxs is None
+
+# sparse storage returns the units of the minibatch's samples, with their cells in the minibatch
+source_unit_mask = torch.rand(num_steps, num_envs * mapsize) < 0.1
+source_unit_mask[1] = False # a step without any unit
+rollouts = RolloutBuffer(num_steps, num_envs, obs_shape, nvec, sparse=True)
+for _ in range(2): # the buffer is reused across rollouts
+    rollouts.reset()
+    for step in range(num_steps):
+        unit_idxs = source_unit_mask[step].nonzero().flatten()
+        rollouts.add(
+            step, obs[step], torch.zeros(num_envs), torch.zeros(num_envs), torch.zeros(num_envs),
+            actions[step].view(-1, len(nvec))[unit_idxs], masks[step].view(-1, nvec.sum())[unit_idxs], unit_idxs,
+        )
+    rollouts.finish()
+mb_obs, mb_actions, mb_masks, mb_unit_idxs = rollouts.minibatch(minibatch_ind)
+mb_source_unit_mask = source_unit_mask.view(-1, mapsize)[minibatch_ind].flatten()
+assert (mb_unit_idxs == mb_source_unit_mask.nonzero().flatten()).all()
+assert (mb_actions == actions.view(-1, mapsize, len(nvec))[minibatch_ind].view(-1, len(nvec))[mb_unit_idxs]).all()
+assert (mb_masks == masks.view(-1, mapsize, nvec.sum())[minibatch_ind].view(-1, nvec.sum())[mb_unit_idxs]).all()
+
+# prefetched minibatches are the ones `minibatch` returns, in order
+minibatch_inds = [np.random.permutation(num_steps * num_envs)[:5] for _ in range(4)]
+for minibatch_ind, minibatch in zip(minibatch_inds, prefetch_minibatches(rollouts, minibatch_inds)):
+    for x, expected in zip(minibatch, rollouts.minibatch(minibatch_ind)):
+        assert (x == expected).all()
+
+# a gather error reaches the consumer, and one raised while the queue is full does not keep
+# the prefetch thread (and the consumer joining it) waiting once the consumer stops early
+class FailingRollouts:
+    def __init__(self, fail_at):
+        self.calls = 0
+        self.fail_at = fail_at
+
+    def minibatch(self, minibatch_ind):
+        self.calls += 1
+        if self.calls == self.fail_at:
+            raise ValueError("gather failed")
+        return (torch.zeros(1),)
+
+try:
+    list(prefetch_minibatches(FailingRollouts(fail_at=2), minibatch_inds))
+    assert False
+except ValueError:
+    pass
+
+failing_rollouts = FailingRollouts(fail_at=3)
+minibatch_iter = prefetch_minibatches(failing_rollouts, minibatch_inds, num_prefetch=1)
+next(minibatch_iter)
+while failing_rollouts.calls < 3:
+    time.sleep(0.01)
+minibatch_iter.close()
@@ -0,0 +1,35 @@
+import numpy as np
+from gym_microrts import microrts_ai
+from gym_microrts.envs.new_vec_env import MicroRTSGridModeVecEnv
+from gym_microrts.random_policy import RandomMaskedPolicy
+
+# the same games played by one vec client, by bot envs split over three and by all envs split
+# over two must match, down to the raw rewards of every env: the clients are stepped
+# concurrently, so rewards leaking between them would break this
+ais = [microrts_ai.workerRushAI, microrts_ai.lightRushAI, microrts_ai.workerRushAI, microrts_ai.lightRushAI]
+envs = [
+    MicroRTSGridModeVecEnv(
+        num_selfplay_envs=2,
+        num_bot_envs=len(ais),
+        max_steps=2000,
+        ai2s=ais,
+        map_paths=["maps/16x16/basesWorkers16x16.xml"],
+        reward_weight=np.array([10.0, 1.0, 1.0, 0.2, 1.0, 4.0, 0.0, 0.0, 0.0]),
+        num_threads=num_threads,
+        bot_threads=bot_threads,
+    )
+    for num_threads, bot_threads in [(1, 1), (1, 3), (2, 1)]
+]
+policies = [RandomMaskedPolicy(env.action_plane_space.nvec, seed=0) for env in envs]
+obs = [env.reset() for env in envs]
+assert all((obs[0] == o).all() for o in obs[1:])
+for _ in range(300):
+    masks = [env.get_action_mask() for env in envs]
+    assert all((masks[0] == m).all() for m in masks[1:])
+    results = [env.step(policy(mask).reshape(env.num_envs, -1)) for env, policy, mask in zip(envs, policies, masks)]
+    for result in results[1:]:
+        for expected, actual in zip(results[0][:3], result[:3]):
+            assert (expected == actual).all()
+        for expected, actual in zip(results[0][3], result[3]):
+            assert (expected["raw_rewards"] == actual["raw_rewards"]).all()
+envs[0].close()
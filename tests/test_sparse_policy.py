@@ -0,0 +1,42 @@
+import torch
+import numpy as np
+from gym_microrts.distributions import MaskedMultiCategorical
+
+# the dense policy of `experiments/new_ppo_gridnet.py` evaluates every cell, the sparse
+# one (`--sparse-policy`) only the cells with a source unit; both must give the same PPO
+# ratios and entropies
+torch.manual_seed(0)
+nvec = np.array([6, 4, 4, 4, 4, 7, 49])
+num_envs, mapsize = 4, 49
+old_logits = torch.randn(num_envs * mapsize, nvec.sum())
+new_logits = old_logits + 0.1 * torch.randn(num_envs * mapsize, nvec.sum())
+masks = torch.rand(num_envs * mapsize, nvec.sum()) > 0.5
+has_unit = torch.rand(num_envs * mapsize) > 0.7
+masks[~has_unit] = False # sourceless cells have no valid action
+unit_idxs = has_unit.nonzero().flatten()
+unit_envs = unit_idxs // mapsize
+
+actions = MaskedMultiCategorical(old_logits, masks, nvec).sample()
+
+def dense(logits):
+    mmc = MaskedMultiCategorical(logits, masks, nvec)
+    logprob = mmc.log_prob(actions).view(num_envs, -1).sum(1)
+    entropy = mmc.entropy().view(num_envs, -1).sum(1)
+    return logprob, entropy
+
+def sparse(logits):
+    mmc = MaskedMultiCategorical(logits[unit_idxs], masks[unit_idxs], nvec)
+    logprob = torch.zeros(num_envs).index_add_(0, unit_envs, mmc.log_prob(actions[unit_idxs]).sum(1))
+    entropy = torch.zeros(num_envs).index_add_(0, unit_envs, mmc.entropy().sum(1))
+    return logprob, entropy
+
+dense_old, _ = dense(old_logits)
+dense_new, dense_entropy = dense(new_logits)
+sparse_old, _ = sparse(old_logits)
+sparse_new, sparse_entropy = sparse(new_logits)
+
+# the sourceless cells add a log-probability that does not depend on the logits ...
+assert torch.allclose(dense_new - sparse_new, dense_old - sparse_old, atol=1e-4)
+# ... which cancels in the ratio
+assert torch.allclose((dense_new - dense_old).exp(), (sparse_new - sparse_old).exp(), atol=1e-4)
+assert torch.allclose(dense_entropy, sparse_entropy, atol=1e-4)
@@ -0,0 +1,53 @@
+import os
+import sys
+from types import SimpleNamespace
+
+import torch
+import torch.nn as nn
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "experiments"))
+from ppo_gridnet import Agent
+from ppo_gridnet_multi_eval import StackedAgent, StackedLinear, stack_conv
+
+# K checkpoints merged into one network must compute what each checkpoint computes on its own envs
+torch.manual_seed(0)
+num_agents, num_envs_per_agent, h, w, c = 3, 2, 16, 16, 27
+
+
+def randomize_biases(module):
+    # `layer_init` zeroes the biases, which would hide a misplaced bias
+    for m in module.modules():
+        if isinstance(m, (nn.Conv2d, nn.ConvTranspose2d, nn.Linear)):
+            m.bias.data.normal_()
+    return module
+
+
+for conv_class, kwargs in [
+    (nn.Conv2d, dict(kernel_size=3, padding=1)),
+    (nn.ConvTranspose2d, dict(kernel_size=3, stride=2, padding=1, output_padding=1)),
+]:
+    layers = [randomize_biases(conv_class(8, 4, **kwargs)) for _ in range(num_agents)]
+    xs = [torch.randn(5, 8, 6, 6) for _ in range(num_agents)]
+    stacked = stack_conv(layers)(torch.cat(xs, 1))
+    assert torch.allclose(stacked, torch.cat([layer(x) for layer, x in zip(layers, xs)], 1), atol=3e-5)
+
+layers = [randomize_biases(nn.Linear(8, 4)) for _ in range(num_agents)]
+xs = [torch.randn(5, 8) for _ in range(num_agents)]
+stacked = StackedLinear(layers)(torch.stack(xs, 1))
+assert torch.allclose(stacked, torch.stack([layer(x) for layer, x in zip(layers, xs)], 1), atol=3e-5)
+
+envs = SimpleNamespace(observation_space=SimpleNamespace(shape=(h, w, c)))
+agents = [randomize_biases(Agent(envs)) for _ in range(num_agents)]
+stacked_agent = StackedAgent(envs, agents)
+# envs are laid out checkpoint after checkpoint
+obs = torch.rand(num_agents * num_envs_per_agent, h, w, c)
+agent_obs = obs.view(num_agents, num_envs_per_agent, h, w, c)
+with torch.no_grad():
+    hidden = stacked_agent.encoder(obs)
+    logits = stacked_agent.actor(hidden)
+    values = stacked_agent.critic(hidden)
+    expected_logits = torch.cat([agent.actor(agent.encoder(x)) for agent, x in zip(agents, agent_obs)])
+    expected_values = torch.cat([agent.critic(agent.encoder(x)) for agent, x in zip(agents, agent_obs)])
+assert logits.shape == expected_logits.shape and values.shape == expected_values.shape
+assert torch.allclose(logits, expected_logits, atol=3e-5)
+assert torch.allclose(values, expected_values, atol=3e-5)
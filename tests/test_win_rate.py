@@ -0,0 +1,19 @@
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "experiments"))
+from win_rate import win_rate_decided
+
+# [loss, tie, win]: a sweep is decided before the last of 10 games, a split matchup is not
+assert win_rate_decided([0, 0, 8], 0.25, 0.95, 10)
+assert win_rate_decided([10, 0, 0], 0.25, 0.95, 10)
+assert not win_rate_decided([0, 0, 7], 0.25, 0.95, 10)
+assert not win_rate_decided([5, 0, 5], 0.25, 0.95, 10)
+assert not win_rate_decided([0, 10, 0], 0.25, 0.95, 10)
+# more games decide a split matchup, and more looks need more games
+assert win_rate_decided([17, 0, 17], 0.25, 0.95, 50)
+assert not win_rate_decided([0, 0, 8], 0.25, 0.95, 1000)
+# no games or no precision never decide
+assert not win_rate_decided([0, 0, 0], 0.25, 0.95, 10)
+assert not win_rate_decided([0, 0, 10], 0, 0.95, 10)
+assert not win_rate_decided([0, 0, 1000], 0, 0.95, 10)